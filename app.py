@@ -1,11 +1,7 @@
 import os
 from dotenv import load_dotenv
 import google.generativeai as genai
-import torch
-from transformers import AutoTokenizer
-from inference.model import Transformer, ModelArgs
-from inference.generate import generate
-import json
+from inference.generate import generate, model_pool, deepseek_pool_key
 import gradio as gr
 
 # Sicurezza pipeline: header, sanitizzazione, prompt guard, rate limit, output
@@ -29,28 +25,6 @@ genai.configure(api_key=GOOGLE_API_KEY)
 # Configurazione del modello Gemini
 gemini_model = genai.GenerativeModel('gemini-pro')
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-# Configurazione del modello DeepSeek (lazy loading + fallback)
-_deepseek_model = None
-_tokenizer = None
-
-def _load_deepseek_model(model_path: str, config_path: str):
-    global _deepseek_model, _tokenizer
-    if _deepseek_model is not None and _tokenizer is not None:
-        return _deepseek_model, _tokenizer
-    try:
-        with open(config_path, "r", encoding="utf-8") as f:
-            args = ModelArgs(**json.load(f))
-        torch.set_default_dtype(torch.bfloat16)
-        if device.type == "cuda":
-            torch.set_default_device("cuda")
-        _deepseek_model = Transformer(args).to(device)
-        _tokenizer = AutoTokenizer.from_pretrained(model_path)
-    except Exception:
-        _deepseek_model, _tokenizer = None, None
-    return _deepseek_model, _tokenizer
-
 # Branding e percorsi FractalNova
 PROJECT_NAME = "FractalNova"
 APP_TITLE = f"{PROJECT_NAME} - Generazione libri con IA"
@@ -73,20 +47,20 @@ def generate_text(prompt, style, content_type, temperature, max_new_tokens):
 
     # DeepSeek (best-effort)
     ds_text = None
-    model, tok = _load_deepseek_model(DEFAULT_MODEL_PATH, DEFAULT_CONFIG_PATH)
-    if model is not None and tok is not None:
-        try:
-            input_ids = tok.encode(prompt)
-            out_ids = generate(
-                model,
-                [input_ids],
-                int(max_new_tokens),
-                tok.eos_token_id if tok.eos_token_id is not None else -1,
-                float(temperature),
-            )[0]
-            ds_text = tok.decode(out_ids)
-        except Exception:
-            ds_text = None
+    with model_pool.use(deepseek_pool_key(DEFAULT_MODEL_PATH, DEFAULT_CONFIG_PATH), default=(None, None)) as (model, tok):
+        if model is not None and tok is not None:
+            try:
+                input_ids = tok.encode(prompt)
+                out_ids = generate(
+                    model,
+                    [input_ids],
+                    int(max_new_tokens),
+                    tok.eos_token_id if tok.eos_token_id is not None else -1,
+                    float(temperature),
+                )[0]
+                ds_text = tok.decode(out_ids)
+            except Exception:
+                ds_text = None
 
     out = gemini_response.text or ""
     if ds_text:
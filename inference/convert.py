@@ -1,11 +1,21 @@
+import hashlib
+import json
+import math
 import os
 import shutil
+import struct
+import threading
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from glob import glob
-from tqdm import tqdm, trange
+from tqdm import tqdm
 
 import torch
-from safetensors.torch import safe_open, save_file
+from safetensors.torch import safe_open
+
+from manifest import write_manifest
 
 
 mapping = {
@@ -30,60 +40,362 @@ mapping = {
 }
 
 
-def main(hf_ckpt_path, save_path, n_experts, mp):
+def stage_layers(n_layers, stage, n_stages):
+    """
+    Computes the contiguous range of layers owned by a pipeline stage.
+
+    Mirrors `model.stage_layers`, kept here so that conversion does not need triton.
+
+    Args:
+        n_layers (int): Total number of transformer layers.
+        stage (int): Index of the pipeline stage.
+        n_stages (int): Number of pipeline stages.
+
+    Returns:
+        Tuple[int, int]: The (start, end) layer indices, end exclusive.
+    """
+    per_stage, remainder = divmod(n_layers, n_stages)
+    start = stage * per_stage + min(stage, remainder)
+    return start, start + per_stage + (1 if stage < remainder else 0)
+
+
+def count_layers(file_paths):
+    """
+    Counts the transformer layers present in the HF checkpoint files.
+
+    Args:
+        file_paths (List[str]): Paths of the input safetensors files.
+
+    Returns:
+        int: Number of layers, excluding the skipped MTP layer.
+    """
+    layer_ids = set()
+    for file_path in file_paths:
+        with safe_open(file_path, framework="pt", device="cpu") as f:
+            for name in f.keys():
+                if name.startswith("model.layers.") and "model.layers.61" not in name:
+                    layer_ids.add(int(name.split(".")[2]))
+    return max(layer_ids) + 1
+
+
+def pipeline_stage(name, n_layers, pp):
+    """
+    Returns the pipeline stage that owns a converted tensor.
+
+    Args:
+        name (str): Converted tensor name.
+        n_layers (int): Total number of transformer layers.
+        pp (int): Number of pipeline stages.
+
+    Returns:
+        int: Index of the owning stage.
+    """
+    if name.startswith("embed."):
+        return 0
+    if not name.startswith("layers."):
+        return pp - 1
+    layer_id = int(name.split(".")[1])
+    for stage in range(pp):
+        start, end = stage_layers(n_layers, stage, pp)
+        if start <= layer_id < end:
+            return stage
+    raise ValueError(f"Layer {layer_id} is out of range for {n_layers} layers")
+
+
+def convert_name(name):
+    """
+    Maps an HF tensor name to its converted name and the dimension it is split on.
+
+    Args:
+        name (str): HF tensor name.
+
+    Returns:
+        Tuple[str, Optional[int]]: Converted name and split dimension (None when replicated).
+    """
+    if name.startswith("model."):
+        name = name[len("model."):]
+    name = name.replace("self_attn", "attn")
+    name = name.replace("mlp", "ffn")
+    name = name.replace("weight_scale_inv", "scale")
+    name = name.replace("e_score_correction_bias", "bias")
+    key = name.split(".")[-2]
+    assert key in mapping, f"Key {key} not found in mapping"
+    new_key, dim = mapping[key]
+    return name.replace(key, new_key), dim
+
+
+def shard_targets(name, shape, dim, mp, n_local_experts):
+    """
+    Lists the model-parallel ranks that receive a converted tensor.
+
+    Args:
+        name (str): Converted tensor name.
+        shape (List[int]): Shape of the full tensor.
+        dim (Optional[int]): Split dimension from `mapping`.
+        mp (int): Model parallelism factor.
+        n_local_experts (int): Routed experts per rank.
+
+    Returns:
+        List[Tuple[int, Optional[int]]]: (rank, shard index along `dim`, or None for the whole tensor).
+    """
+    if "experts" in name and "shared_experts" not in name:
+        return [(int(name.split(".")[-3]) // n_local_experts, None)]
+    if dim is None or mp == 1:
+        return [(i, None) for i in range(mp)]
+    assert shape[dim] % mp == 0, f"Dimension {dim} must be divisible by {mp}"
+    return [(i, i) for i in range(mp)]
+
+
+DTYPE_SIZES = {
+    "F64": 8, "F32": 4, "F16": 2, "BF16": 2, "F8_E4M3": 1, "F8_E5M2": 1,
+    "I64": 8, "I32": 4, "I16": 2, "I8": 1, "U8": 1, "BOOL": 1,
+}
+
+
+class ByteBudget:
+    """
+    Bounds the bytes of tensors held in memory at once by a pool of workers.
+
+    A request larger than the whole budget is admitted alone, so progress is
+    always possible.
+    """
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.in_use = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def hold(self, nbytes):
+        with self._cond:
+            self._cond.wait_for(lambda: self.in_use == 0 or self.in_use + nbytes <= self.budget_bytes)
+            self.in_use += nbytes
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_use -= nbytes
+                self._cond.notify_all()
+
+
+class ShardWriter:
+    """
+    Writes safetensors files whose layout is fixed up front, tensor by tensor and from several threads.
+
+    The header of every file is computed from the tensor names, dtypes and
+    shapes alone (sorted as `safetensors` does, so tensors stay aligned), the
+    files are created at their final size as `<path>.partial`, and tensors are
+    written at their offsets as they are produced, so nothing has to be kept
+    in memory until the end. Completed units of work (e.g. input files) are
+    recorded in a journal; a run restarted with the same layout skips them.
+    `close` renames the files to their final names.
+
+    Attributes:
+        done (Set[str]): Units already written, including those of a resumed run.
+        written_bytes (int): Bytes written by this run.
+    """
+    def __init__(self, paths, layouts, journal_path=None):
+        """
+        Lays out and opens the output files, resuming a previous run when the journal matches.
+
+        Args:
+            paths (List[str]): Final paths of the output files.
+            layouts (List[Dict[str, Tuple[str, List[int]]]]): Per file, the dtype (safetensors name)
+                and shape of every tensor.
+            journal_path (str, optional): Path of the progress journal; without one every run starts over.
+        """
+        self.paths = paths
+        self.journal_path = journal_path
+        self.offsets = []
+        self.written_bytes = 0
+        self._lock = threading.Lock()
+        headers = []
+        for layout in layouts:
+            header, offsets, offset = {"__metadata__": {"format": "pt"}}, {}, 0
+            for name in sorted(layout, key=lambda k: (-DTYPE_SIZES[layout[k][0]], k)):
+                dtype, shape = layout[name]
+                end = offset + DTYPE_SIZES[dtype] * math.prod(shape)
+                header[name] = {"dtype": dtype, "shape": list(shape), "data_offsets": [offset, end]}
+                offsets[name] = offset
+                offset = end
+            data = json.dumps(header, separators=(",", ":")).encode()
+            data += b" " * (-len(data) % 8)
+            headers.append((struct.pack("<Q", len(data)) + data, offset))
+            self.offsets.append({k: v + 8 + len(data) for k, v in offsets.items()})
+        plan_id = hashlib.sha256(b"".join(h for h, _ in headers)).hexdigest()
+        self.done = set()
+        journal = {}
+        if journal_path and os.path.exists(journal_path):
+            with open(journal_path, encoding="utf-8") as f:
+                journal = json.load(f)
+        resume = journal.get("plan") == plan_id and all(
+            os.path.exists(p + ".partial") and os.path.getsize(p + ".partial") == len(h) + n
+            for p, (h, n) in zip(paths, headers)
+        )
+        self._fds = []
+        for path, (header, n_data) in zip(paths, headers):
+            if resume:
+                fd = os.open(path + ".partial", os.O_WRONLY)
+            else:
+                fd = os.open(path + ".partial", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                os.ftruncate(fd, len(header) + n_data)
+                os.pwrite(fd, header, 0)
+            self._fds.append(fd)
+        self.plan_id = plan_id
+        if resume:
+            self.done = set(journal.get("done", []))
+        elif journal_path:
+            self._save_journal()
+
+    def write(self, i, name, tensor, start=0):
+        """
+        Writes one tensor of file `i` at its offset.
+
+        Args:
+            i (int): Index of the output file.
+            name (str): Tensor name.
+            tensor (torch.Tensor): Tensor matching the declared dtype and shape, or a run of its
+                leading-dimension rows when `start` is given.
+            start (int, optional): Byte offset of `tensor` within the declared tensor. Defaults to 0.
+        """
+        data = memoryview(tensor.contiguous().reshape(-1).view(torch.uint8).numpy())
+        fd, offset = self._fds[i], self.offsets[i][name] + start
+        while data:
+            n = os.pwrite(fd, data, offset)
+            data, offset = data[n:], offset + n
+        with self._lock:
+            self.written_bytes += tensor.numel() * tensor.element_size()
+
+    def _save_journal(self):
+        tmp = self.journal_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"plan": self.plan_id, "done": sorted(self.done)}, f)
+        os.replace(tmp, self.journal_path)
+
+    def mark_done(self, unit):
+        """
+        Records a unit of work as written, once its bytes are on disk.
+
+        Args:
+            unit (str): Name of the unit, e.g. the input file.
+        """
+        for fd in self._fds:
+            os.fsync(fd)
+        with self._lock:
+            self.done.add(unit)
+            if self.journal_path:
+                self._save_journal()
+
+    def close(self):
+        """Closes the files, gives them their final names and removes the journal."""
+        for fd, path in zip(self._fds, self.paths):
+            os.fsync(fd)
+            os.close(fd)
+            os.replace(path + ".partial", path)
+        if self.journal_path:
+            os.remove(self.journal_path)
+
+
+def main(hf_ckpt_path, save_path, n_experts, mp, pp=1, workers=4, buffer_gb=8.):
     """
     Converts and saves model checkpoint files into a specified format.
 
+    With `pp > 1` the checkpoint is split by layers instead: stage `i` gets the
+    layers of `stage_layers(n_layers, i, pp)` (plus the embedding on the first
+    stage and the norm and head on the last one) in `model{i}-pp{pp}.safetensors`.
+
+    The output layout is planned from the input headers, then `workers`
+    threads convert the input files in parallel and write every tensor into
+    its shard as soon as it is read, holding at most `buffer_gb` of tensors in
+    memory. An interrupted conversion resumes from the files it completed.
+    Finally `checkpoint.manifest.json` records the digests of the output,
+    which the loaders check before reading the shards.
+
     Args:
         hf_ckpt_path (str): Path to the directory containing the input checkpoint files.
         save_path (str): Path to the directory where the converted checkpoint files will be saved.
         n_experts (int): Total number of experts in the model.
         mp (int): Model parallelism factor.
+        pp (int, optional): Pipeline parallelism factor. Defaults to 1.
+        workers (int, optional): Input files converted in parallel. Defaults to 4.
+        buffer_gb (float, optional): Maximum GB of tensors held in memory. Defaults to 8.
         
     Returns:
         None
     """
     torch.set_num_threads(8)
+    assert mp == 1 or pp == 1, "Tensor and pipeline parallelism cannot be combined"
     n_local_experts = n_experts // mp
-    state_dicts = [{} for _ in range(mp)]
+    file_paths = sorted(glob(os.path.join(hf_ckpt_path, "*.safetensors")))
+    n_layers = count_layers(file_paths) if pp > 1 else 0
+    shard_tag, n_shards = ("pp", pp) if pp > 1 else ("mp", mp)
 
-    for file_path in tqdm(glob(os.path.join(hf_ckpt_path, "*.safetensors"))):
+    # plan: where every tensor goes, from the headers only
+    layouts = [{} for _ in range(n_shards)]
+    plans = {}
+    for file_path in file_paths:
+        plan = plans[file_path] = []
         with safe_open(file_path, framework="pt", device="cpu") as f:
             for name in f.keys():
                 if "model.layers.61" in name:
                     continue
-                param: torch.Tensor = f.get_tensor(name)
-                if name.startswith("model."):
-                    name = name[len("model."):]
-                name = name.replace("self_attn", "attn")
-                name = name.replace("mlp", "ffn")
-                name = name.replace("weight_scale_inv", "scale")
-                name = name.replace("e_score_correction_bias", "bias")
-                key = name.split(".")[-2]
-                assert key in mapping, f"Key {key} not found in mapping"
-                new_key, dim = mapping[key]
-                name = name.replace(key, new_key)
-                for i in range(mp):
-                    new_param = param
-                    if "experts" in name and "shared_experts" not in name:
-                        idx = int(name.split(".")[-3])
-                        if idx < i * n_local_experts or idx >= (i + 1) * n_local_experts:
-                            continue
-                    elif dim is not None:
-                        assert param.size(dim) % mp == 0, f"Dimension {dim} must be divisible by {mp}"
-                        shard_size = param.size(dim) // mp
-                        new_param = param.narrow(dim, i * shard_size, shard_size).contiguous()
-                    state_dicts[i][name] = new_param
+                tensor_slice = f.get_slice(name)
+                dtype, shape = tensor_slice.get_dtype(), tensor_slice.get_shape()
+                new_name, dim = convert_name(name)
+                if pp > 1:
+                    targets = [(pipeline_stage(new_name, n_layers, pp), None)]
+                else:
+                    targets = shard_targets(new_name, shape, dim, mp, n_local_experts)
+                for i, shard in targets:
+                    shard_shape = list(shape)
+                    if shard is not None:
+                        shard_shape[dim] //= mp
+                    layouts[i][new_name] = (dtype, shard_shape)
+                plan.append((name, new_name, dim, targets, DTYPE_SIZES[dtype] * math.prod(shape)))
 
     os.makedirs(save_path, exist_ok=True)
+    paths = [os.path.join(save_path, f"model{i}-{shard_tag}{n_shards}.safetensors") for i in range(n_shards)]
+    writer = ShardWriter(paths, layouts, os.path.join(save_path, ".convert-progress.json"))
+    budget = ByteBudget(int(buffer_gb * 2 ** 30))
+    todo = [p for p in file_paths if os.path.basename(p) not in writer.done]
+    if len(todo) < len(file_paths):
+        print(f"Resuming: {len(file_paths) - len(todo)} of {len(file_paths)} files already converted")
+
+    def convert_file(file_path):
+        read_bytes = 0
+        with safe_open(file_path, framework="pt", device="cpu") as f:
+            for name, new_name, dim, targets, nbytes in plans[file_path]:
+                with budget.hold(nbytes):
+                    param: torch.Tensor = f.get_tensor(name)
+                    for i, shard in targets:
+                        new_param = param
+                        if shard is not None:
+                            shard_size = param.size(dim) // mp
+                            new_param = param.narrow(dim, shard * shard_size, shard_size)
+                        writer.write(i, new_name, new_param)
+                    del param
+                read_bytes += nbytes
+        writer.mark_done(os.path.basename(file_path))
+        return read_bytes
 
-    for i in trange(mp):
-        save_file(state_dicts[i], os.path.join(save_path, f"model{i}-mp{mp}.safetensors"))
+    start, read_bytes = time.perf_counter(), 0
+    with ThreadPoolExecutor(max_workers=workers) as pool, tqdm(total=len(todo)) as bar:
+        for future in as_completed([pool.submit(convert_file, p) for p in todo]):
+            read_bytes += future.result()
+            bar.set_postfix_str(f"{read_bytes / 2 ** 30 / max(time.perf_counter() - start, 1e-9):.2f} GB/s read")
+            bar.update()
+    writer.close()
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f"Read {read_bytes / 2 ** 30:.1f} GB and wrote {writer.written_bytes / 2 ** 30:.1f} GB in {elapsed:.1f}s "
+          f"({read_bytes / 2 ** 30 / elapsed:.2f} GB/s read, {writer.written_bytes / 2 ** 30 / elapsed:.2f} GB/s written)")
 
     for file_path in glob(os.path.join(hf_ckpt_path, "*token*")):
         new_file_path = os.path.join(save_path, os.path.basename(file_path))
         shutil.copyfile(file_path, new_file_path)
 
+    start = time.perf_counter()
+    manifest = write_manifest(save_path)
+    print(f"Wrote checkpoint.manifest.json for {len(manifest['files'])} files in {time.perf_counter() - start:.1f}s")
+
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -91,6 +403,10 @@ if __name__ == "__main__":
     parser.add_argument("--save-path", type=str, required=True)
     parser.add_argument("--n-experts", type=int, required=True)
     parser.add_argument("--model-parallel", type=int, required=True)
+    parser.add_argument("--pipeline-parallel", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--buffer-gb", type=float, default=8.)
     args = parser.parse_args()
     assert args.n_experts % args.model_parallel == 0, "Number of experts must be divisible by model parallelism"
-    main(args.hf_ckpt_path, args.save_path, args.n_experts, args.model_parallel)
+    main(args.hf_ckpt_path, args.save_path, args.n_experts, args.model_parallel, args.pipeline_parallel,
+         args.workers, args.buffer_gb)
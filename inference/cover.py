@@ -0,0 +1,251 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+from manifest import verify_checkpoint
+from model_pool import ModelPool
+
+
+def _schedule(model_id: str, kind: str) -> Tuple[int, float]:
+    # distilled checkpoints are trained for a handful of steps and without guidance
+    if kind == "sd":
+        return 1, 0.
+    if "schnell" in model_id.lower():
+        return 4, 0.
+    return 28, 3.5
+
+
+class CoverService:
+    """
+    Generates book covers with a text-to-image pipeline kept loaded across calls.
+
+    The pipeline (FLUX, or `fallback_id` when FLUX cannot be loaded or fails
+    to render) lives in the shared `ModelPool` under `pool_key`, so it is
+    loaded once and counts against the same memory budget as the text models. Every call renders its
+    variants in one batched denoising run at `preview_size`, each from its own
+    seed; the selected variant is then refined at `size` with an
+    image-to-image pass that reuses the pipeline's components and keeps the
+    preview's composition. Prompt embeddings are cached per prompt, so the
+    text encoders run once per title/genre. Only the final cover is written
+    to `output_dir` unless `save_previews` is set.
+
+    Attributes:
+        size (int): Side of the final cover in pixels.
+        preview_size (int): Side of the preview variants in pixels.
+        timings (Dict[str, float]): Seconds spent in each phase of the last call.
+    """
+    def __init__(self, pool: ModelPool, model_id: str, fallback_id: str = "stabilityai/sd-turbo",
+                 pool_key: str = "flux", size: int = 1024, preview_size: int = 512,
+                 steps: Optional[int] = None, refine_strength: float = 0.6,
+                 embed_cache_size: int = 32, output_dir: str = "book_covers", save_previews: bool = False):
+        """
+        Initializes the service; nothing is loaded until the first cover.
+
+        Args:
+            pool (ModelPool): Pool owning the pipeline.
+            model_id (str): FLUX checkpoint; a local directory is checked against its manifest first.
+            fallback_id (str, optional): Stable Diffusion checkpoint used when FLUX fails to load or
+                to render; kept in the pool under `pool_key` + ":fallback". Defaults to "stabilityai/sd-turbo".
+            pool_key (str, optional): Key of the pipeline in the pool. Defaults to "flux".
+            size (int, optional): Side of the final cover in pixels. Defaults to 1024.
+            preview_size (int, optional): Side of the preview variants in pixels. Defaults to 512.
+            steps (int, optional): Denoising steps; defaults to what the checkpoint was trained for.
+            refine_strength (float, optional): Share of the schedule re-run by the final
+                image-to-image pass. Defaults to 0.6.
+            embed_cache_size (int, optional): Number of prompts whose embeddings are kept. Defaults to 32.
+            output_dir (str, optional): Directory of the saved images. Defaults to "book_covers".
+            save_previews (bool, optional): Also save the previews next to the final cover. Defaults to False.
+        """
+        self.pool = pool
+        self.model_id = model_id
+        self.fallback_id = fallback_id
+        self.pool_key = pool_key
+        self.size = size
+        self.preview_size = preview_size
+        self.steps_override = steps
+        self.refine_strength = refine_strength
+        self.embed_cache_size = embed_cache_size
+        self.output_dir = output_dir
+        self.save_previews = save_previews
+        self.fallback_key = f"{pool_key}:fallback"
+        self.timings: Dict[str, float] = {}
+        self._embeds: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+        self._img2img: Dict[int, Any] = {}
+        self._lock = threading.Lock()
+        pool.register(pool_key, self._load)
+        pool.register(self.fallback_key, self._load_fallback)
+
+    @staticmethod
+    def _ready(pipe, kind: str) -> Tuple[Any, str]:
+        if torch.cuda.is_available():
+            pipe = pipe.to("cuda")
+        pipe.set_progress_bar_config(disable=True)
+        return pipe, kind
+
+    def _load_fallback(self) -> Tuple[Any, str]:
+        from diffusers import StableDiffusionPipeline
+        return self._ready(StableDiffusionPipeline.from_pretrained(self.fallback_id), "sd")
+
+    def _load(self) -> Tuple[Any, str]:
+        dtype = torch.bfloat16 if torch.cuda.is_available() else torch.float32
+        try:
+            if os.path.isdir(self.model_id):
+                verify_checkpoint(self.model_id, mode=os.getenv("CHECKPOINT_VERIFY", "fast"))
+            from diffusers import FluxPipeline
+            return self._ready(FluxPipeline.from_pretrained(self.model_id, torch_dtype=dtype), "flux")
+        except Exception:
+            return self._load_fallback()
+
+    def schedule(self, kind: str) -> Tuple[int, int, float]:
+        """
+        Returns the preview steps, final steps and guidance scale for a pipeline kind.
+
+        Args:
+            kind (str): "flux" or "sd".
+
+        Returns:
+            Tuple[int, int, float]: Preview steps, final steps and guidance scale.
+        """
+        steps, guidance = _schedule(self.model_id, kind)
+        steps = self.steps_override or steps
+        return min(max(steps // 4, 4), steps), steps, guidance
+
+    @staticmethod
+    def prompt(title: str, genre: Optional[str], kind: str) -> str:
+        """Builds the cover prompt for a title and genre."""
+        if kind == "sd":
+            return f"Book cover, professional layout, title '{title}', {genre or ''}"
+        return (
+            f"Copertina di libro professionale per il titolo: '{title}'. "
+            f"Stile coerente con il contenuto: {genre or ''}. "
+            f"Tema, atmosfera e simboli chiave tratti dal libro: usa elementi evocativi, tipografia leggibile, layout editoriale."
+        )
+
+    def _embeddings(self, pipe, kind: str, prompt: str, guidance: float) -> Dict[str, Any]:
+        key = (kind, prompt)
+        if key in self._embeds:
+            self._embeds.move_to_end(key)
+            return self._embeds[key]
+        device = pipe._execution_device
+        with torch.inference_mode():
+            if kind == "flux":
+                prompt_embeds, pooled, _ = pipe.encode_prompt(prompt=prompt, prompt_2=None, device=device)
+                embeds = {"prompt_embeds": prompt_embeds, "pooled_prompt_embeds": pooled}
+            else:
+                prompt_embeds, negative = pipe.encode_prompt(prompt, device, 1, guidance > 1)
+                embeds = {"prompt_embeds": prompt_embeds}
+                if negative is not None:
+                    embeds["negative_prompt_embeds"] = negative
+        self._embeds[key] = embeds
+        if len(self._embeds) > self.embed_cache_size:
+            self._embeds.popitem(last=False)
+        return embeds
+
+    def _refiner(self, pipe):
+        # image-to-image view over the same components, built once per loaded pipeline
+        refiner = self._img2img.get(id(pipe))
+        if refiner is None:
+            from diffusers import AutoPipelineForImage2Image
+            self._img2img = {id(pipe): AutoPipelineForImage2Image.from_pipe(pipe)}
+            refiner = self._img2img[id(pipe)]
+        return refiner
+
+    def _save(self, image, title: str, suffix: str) -> str:
+        os.makedirs(self.output_dir, exist_ok=True)
+        safe_title = "".join(c for c in title if c.isalnum() or c in (' ', '-', '_')).rstrip()
+        path = os.path.join(self.output_dir, f"cover_{safe_title}_{datetime.now().strftime('%Y%m%d_%H%M%S')}{suffix}.png")
+        image.save(path)
+        return path
+
+    def _render(self, pipe, kind: str, title: str, genre: Optional[str], seeds: List[int], final: bool,
+                select: int) -> Tuple[List[Any], Any, Dict[str, float]]:
+        timings = {}
+        start = time.perf_counter()
+        preview_steps, steps, guidance = self.schedule(kind)
+        embeds = self._embeddings(pipe, kind, self.prompt(title, genre, kind), guidance)
+        timings["encode"] = time.perf_counter() - start
+        device = pipe._execution_device
+        start = time.perf_counter()
+        previews = pipe(
+            **embeds,
+            num_images_per_prompt=len(seeds),
+            height=self.preview_size,
+            width=self.preview_size,
+            num_inference_steps=preview_steps,
+            guidance_scale=guidance,
+            generator=[torch.Generator(device).manual_seed(s) for s in seeds],
+        ).images
+        timings["preview"] = time.perf_counter() - start
+        cover = None
+        if final and kind == "sd":
+            # sd-turbo renders at its native size in one step: the preview is the cover
+            cover = previews[select]
+        elif final:
+            start = time.perf_counter()
+            image = previews[select].resize((self.size, self.size))
+            generator = torch.Generator(device).manual_seed(seeds[select])
+            try:
+                cover = self._refiner(pipe)(
+                    **embeds,
+                    image=image,
+                    strength=self.refine_strength,
+                    height=self.size,
+                    width=self.size,
+                    num_inference_steps=max(steps, int(1 / self.refine_strength) + 1),
+                    guidance_scale=guidance,
+                    generator=generator,
+                ).images[0]
+            except Exception:
+                # no image-to-image variant for this pipeline: render the seed at full size
+                cover = pipe(**embeds, height=self.size, width=self.size, num_inference_steps=steps,
+                             guidance_scale=guidance, generator=generator).images[0]
+            timings["final"] = time.perf_counter() - start
+        return previews, cover, timings
+
+    def generate(self, title: str, genre: Optional[str] = None, variants: int = 1, final: bool = True,
+                 select: int = 0, seed: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Renders `variants` previews in one batch and, optionally, the final cover of one of them.
+
+        If FLUX fails while rendering (e.g. out of memory), the call is
+        rendered again with the Stable Diffusion fallback.
+
+        Args:
+            title (str): Book title.
+            genre (str, optional): Book genre.
+            variants (int, optional): Number of preview variants. Defaults to 1.
+            final (bool, optional): Refine the selected variant at full size. Defaults to True.
+            select (int, optional): Index of the variant to refine. Defaults to 0.
+            seed (int, optional): Seed of the first variant; the others use the following seeds.
+
+        Returns:
+            Dict[str, Any]: Paths of the `previews` (saved with `save_previews` or without `final`),
+            path of the `final` cover (None without `final`), the `seeds` used and the `timings` in seconds.
+        """
+        seed = int(time.time()) if seed is None else seed
+        seeds = [seed + i for i in range(variants)]
+        failed = None
+        with self.pool.use(self.pool_key) as (pipe, kind), self._lock:
+            try:
+                previews, cover, timings = self._render(pipe, kind, title, genre, seeds, final, select)
+            except Exception as e:
+                if kind != "flux":
+                    raise
+                failed = e
+        if failed is not None:
+            print(f"cover: {self.model_id} failed ({failed}), falling back to {self.fallback_id}")
+            with self.pool.use(self.fallback_key) as (pipe, kind), self._lock:
+                previews, cover, timings = self._render(pipe, kind, title, genre, seeds, final, select)
+        self.timings = timings
+        save_previews = self.save_previews or not final
+        return {
+            "previews": [self._save(image, title, f"_v{i}") for i, image in enumerate(previews)] if save_previews else [],
+            "final": self._save(cover, title, "") if cover is not None else None,
+            "seeds": seeds,
+            "timings": {k: round(v, 3) for k, v in timings.items()},
+        }
@@ -0,0 +1,354 @@
+import glob
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+import torch
+
+
+def _parse_cpulist(text: str) -> List[int]:
+    cores = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-")
+            cores.extend(range(int(lo), int(hi) + 1))
+        else:
+            cores.append(int(part))
+    return cores
+
+
+def available_cores() -> List[int]:
+    """
+    Returns the cores this process may run on.
+
+    Returns:
+        List[int]: Sorted core ids.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cpu_topology(physical_only: bool = True) -> Dict[int, List[int]]:
+    """
+    Groups the available cores by NUMA node.
+
+    Reads `/sys/devices/system/node`; hosts without it are reported as a
+    single node. With `physical_only`, SMT siblings are dropped so every
+    physical core appears once, which is what matmul-bound threads want.
+
+    Args:
+        physical_only (bool, optional): Keep one hardware thread per physical core. Defaults to True.
+
+    Returns:
+        Dict[int, List[int]]: Core ids per NUMA node.
+    """
+    cores = set(available_cores())
+    if physical_only:
+        for core in sorted(cores):
+            path = f"/sys/devices/system/cpu/cpu{core}/topology/thread_siblings_list"
+            if core in cores and os.path.exists(path):
+                with open(path) as f:
+                    cores -= set(_parse_cpulist(f.read())) - {core}
+    nodes = {}
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")):
+        node = int(os.path.basename(os.path.dirname(path))[4:])
+        with open(path) as f:
+            node_cores = sorted(cores.intersection(_parse_cpulist(f.read())))
+        if node_cores:
+            nodes[node] = node_cores
+    return nodes or {0: sorted(cores)}
+
+
+def partition_cores(n_workers: int, topology: Optional[Dict[int, List[int]]] = None) -> List[List[int]]:
+    """
+    Splits the cores into `n_workers` disjoint groups that do not straddle NUMA nodes when avoidable.
+
+    Workers are spread over the nodes in proportion to their core counts and
+    every node's cores are divided among its workers. With more workers than
+    cores, groups are reused round-robin.
+
+    Args:
+        n_workers (int): Number of groups.
+        topology (Dict[int, List[int]], optional): Output of `cpu_topology`. Defaults to the current host.
+
+    Returns:
+        List[List[int]]: Core ids per worker.
+    """
+    if n_workers <= 0:
+        return []
+    topology = topology or cpu_topology()
+    nodes = [topology[n] for n in sorted(topology)]
+    if n_workers < len(nodes):
+        # fewer workers than nodes: give each worker whole nodes
+        groups = [[] for _ in range(n_workers)]
+        for i, node_cores in enumerate(nodes):
+            groups[i % n_workers].extend(node_cores)
+        return groups
+    total = sum(len(c) for c in nodes)
+    workers_per_node = [max(n_workers * len(c) // total, 1) for c in nodes]
+    while sum(workers_per_node) < n_workers:
+        i = max(range(len(nodes)), key=lambda j: len(nodes[j]) / workers_per_node[j])
+        workers_per_node[i] += 1
+    while sum(workers_per_node) > n_workers:
+        i = max(range(len(nodes)), key=lambda j: workers_per_node[j])
+        workers_per_node[i] -= 1
+    groups = []
+    for node_cores, n in zip(nodes, workers_per_node):
+        if n > len(node_cores):
+            groups.extend([node_cores[w % len(node_cores)]] for w in range(n))
+            continue
+        for w in range(n):
+            groups.append(node_cores[w * len(node_cores) // n:(w + 1) * len(node_cores) // n])
+    return groups
+
+
+def pin_cores(cores: List[int], intra_op_threads: Optional[int] = None, inter_op_threads: Optional[int] = None) -> None:
+    """
+    Pins the calling thread to `cores` and sets the PyTorch thread counts.
+
+    On Linux both the affinity and the OpenMP thread count apply to the
+    calling thread, and the intra-op workers it spawns inherit the affinity.
+
+    Args:
+        cores (List[int]): Cores to run on.
+        intra_op_threads (int, optional): Intra-op threads. Defaults to one per core.
+        inter_op_threads (int, optional): Inter-op threads; only takes effect before the first parallel op.
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(intra_op_threads or len(cores))
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            pass
+
+
+def pin_cpu_rank(local_rank: int, local_world_size: int) -> List[int]:
+    """
+    Pins the current process to its share of the cores of this host.
+
+    The physical cores are partitioned NUMA-aware into `local_world_size`
+    groups and rank `local_rank` gets its own group, so that ranks sharing a
+    host do not migrate across sockets or oversubscribe each other.
+
+    Args:
+        local_rank (int): Rank of the process on this host.
+        local_world_size (int): Number of ranks launched on this host.
+
+    Returns:
+        List[int]: The cores assigned to this rank.
+    """
+    assigned = partition_cores(local_world_size)[local_rank % local_world_size]
+    pin_cores(assigned, inter_op_threads=1)
+    return assigned
+
+
+class CpuTuner:
+    """
+    Shares the cores of the host among the models loaded in one process.
+
+    By default (`shared`) every registered role (e.g. "qwen", "llama") may use
+    all cores and `use` blocks run one at a time, so each generation gets the
+    whole machine and a concurrent request waits instead of changing the
+    thread count underneath the running one. Otherwise every role gets a
+    disjoint NUMA-aware group of cores, recomputed whenever a role is added
+    or removed, and blocks of different roles run in parallel, each on its
+    own group with the affinity and OpenMP thread count of its own thread;
+    only blocks of the same role wait for each other. `use(role)` pins the
+    calling thread for the duration of a generation. With `autotune`, the
+    first registration of a role benchmarks its `bench_fn` at a few thread
+    counts within its group and keeps the fastest; results are cached per
+    host in `cache_path` so the benchmark runs once.
+
+    Attributes:
+        groups (Dict[str, List[int]]): Cores assigned to each role.
+        threads (Dict[str, int]): Intra-op threads used by each role.
+        results (Dict[str, Dict[str, float]]): Tokens per second by thread count, per benchmarked role.
+    """
+    def __init__(self, autotune: bool = False, cache_path: str = "", shared: bool = True):
+        """
+        Initializes the tuner.
+
+        Args:
+            autotune (bool, optional): Benchmark thread counts when a role is registered. Defaults to False.
+            cache_path (str, optional): JSON file caching benchmark results. Defaults to none.
+            shared (bool, optional): Give every role all cores and run one generation at a time,
+                instead of a disjoint group per role with generations of different roles in
+                parallel. Defaults to True.
+        """
+        self.autotune = autotune
+        self.cache_path = cache_path
+        self.shared = shared
+        self.groups: Dict[str, List[int]] = {}
+        self.threads: Dict[str, int] = {}
+        self.results: Dict[str, Dict[str, float]] = {}
+        self._roles: List[str] = []
+        self._lock = threading.Lock()
+        # reentrant so that `benchmark` and nested blocks of the same thread do not deadlock;
+        # one for all roles when shared, else one per role
+        self._use_lock = threading.RLock()
+        self._role_locks: Dict[str, threading.RLock] = {}
+
+    def _repartition(self) -> None:
+        if self.shared:
+            cores = [c for node in cpu_topology().values() for c in node]
+            groups = [cores] * len(self._roles)
+        else:
+            groups = partition_cores(len(self._roles))
+        for role, cores in zip(self._roles, groups):
+            self.groups[role] = cores
+            if role not in self.results:
+                self.threads[role] = len(cores)
+            else:
+                self.threads[role] = min(self.threads[role], len(cores))
+
+    def _cache_key(self, role: str) -> str:
+        return f"{socket.gethostname()}:{role}:{len(self.groups[role])}"
+
+    def register(self, role: str, bench_fn: Optional[Callable[[], int]] = None) -> None:
+        """
+        Assigns cores to a role and, with `autotune`, picks its thread count.
+
+        Args:
+            role (str): Name of the model.
+            bench_fn (Callable[[], int], optional): Runs a short generation and returns the
+                number of tokens produced; required for autotuning.
+        """
+        with self._lock:
+            if role not in self._roles:
+                self._roles.append(role)
+            self._repartition()
+        if self.autotune and bench_fn is not None:
+            self.benchmark(role, bench_fn)
+
+    def unregister(self, role: str) -> None:
+        """
+        Frees the cores of a role, e.g. when its model is unloaded, and shares them among the others.
+
+        Args:
+            role (str): Name of the model; unknown roles are ignored.
+        """
+        with self._lock:
+            if role not in self._roles:
+                return
+            self._roles.remove(role)
+            self.groups.pop(role, None)
+            self.threads.pop(role, None)
+            self.results.pop(role, None)
+            if self._roles:
+                self._repartition()
+
+    def benchmark(self, role: str, bench_fn: Callable[[], int], candidates: Optional[List[int]] = None) -> int:
+        """
+        Measures tokens per second at several thread counts and keeps the fastest.
+
+        Args:
+            role (str): Registered role.
+            bench_fn (Callable[[], int]): Runs a short generation and returns the number of tokens produced.
+            candidates (List[int], optional): Thread counts to try. Defaults to 1/4, 1/2, 3/4 and all
+                cores of the role's group.
+
+        Returns:
+            int: The selected thread count.
+        """
+        key = self._cache_key(role)
+        cached = self._load_cache().get(key)
+        if cached is not None:
+            self.results[role] = cached["tokens_per_s"]
+            self.threads[role] = cached["threads"]
+            return self.threads[role]
+        n_cores = len(self.groups[role])
+        candidates = candidates or sorted({max(n_cores * k // 4, 1) for k in (1, 2, 3, 4)})
+        results = {}
+        with self.use(role):
+            bench_fn()  # warmup
+            for n in candidates:
+                torch.set_num_threads(n)
+                start = time.perf_counter()
+                tokens = bench_fn()
+                results[str(n)] = tokens / max(time.perf_counter() - start, 1e-9)
+        best = max(results, key=results.get)
+        self.results[role] = results
+        self.threads[role] = int(best)
+        self._save_cache(key, {"threads": int(best), "tokens_per_s": results})
+        return int(best)
+
+    def _load_cache(self) -> Dict:
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_cache(self, key: str, value: Dict) -> None:
+        if not self.cache_path:
+            return
+        data = self._load_cache()
+        data[key] = value
+        with open(self.cache_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+
+    @contextmanager
+    def use(self, role: str) -> Iterator[None]:
+        """
+        Pins the calling thread to the role's cores and thread count while the block runs.
+
+        Roles that were never registered (e.g. models running on GPU) are left untouched.
+        When `shared`, blocks of all roles are serialized; otherwise only blocks of the same role.
+
+        Args:
+            role (str): Registered role.
+        """
+        if role not in self.groups:
+            yield
+            return
+        if self.shared:
+            lock = self._use_lock
+        else:
+            with self._lock:
+                lock = self._role_locks.setdefault(role, threading.RLock())
+        with lock:
+            cores = self.groups.get(role)
+            if cores is None:  # unregistered while waiting
+                yield
+                return
+            previous_threads = torch.get_num_threads()
+            previous_cores = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else None
+            pin_cores(cores, self.threads.get(role, len(cores)))
+            try:
+                yield
+            finally:
+                torch.set_num_threads(previous_threads)
+                if previous_cores is not None:
+                    os.sched_setaffinity(0, previous_cores)
+
+    def report(self) -> List[str]:
+        """
+        Describes the current assignment.
+
+        Returns:
+            List[str]: One line per role with its cores, threads and benchmark results.
+        """
+        lines = []
+        for role in self._roles:
+            cores = self.groups[role]
+            line = f"{role}: cores {cores[0]}-{cores[-1]} ({len(cores)}), {self.threads[role]} threads"
+            if role in self.results:
+                line += ", " + ", ".join(f"{n}t={tps:.1f} tok/s" for n, tps in self.results[role].items())
+            lines.append(line)
+        return lines
+
+
+if __name__ == "__main__":
+    for node, cores in cpu_topology().items():
+        print(f"node {node}: {len(cores)} physical cores {cores}")
@@ -0,0 +1,273 @@
+import math
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Literal, Optional, Sequence, Tuple, Union
+
+import torch
+from transformers import StoppingCriteria
+
+
+_HASH_BASE = 1_000_003
+_HASH_MOD = (1 << 61) - 1
+
+
+class _SequenceState:
+    __slots__ = ("tokens", "hash", "seen", "period", "run", "window", "counts", "clogc", "resamples")
+
+    def __init__(self):
+        self.tokens: List[int] = []
+        self.hash = 0
+        self.seen: Dict[int, int] = {}
+        self.period = 0
+        self.run = 0
+        self.window = deque()
+        self.counts: Dict[int, int] = {}
+        self.clogc = 0.
+        self.resamples = 0
+
+
+def _clogc(c: int) -> float:
+    return c * math.log(c) if c > 1 else 0.
+
+
+class DegenerationDetector:
+    """
+    Detects generations stuck in a loop or in a low-entropy run, one token at a time.
+
+    Every sequence keeps a rolling hash of its last `ngram` tokens and the
+    last position of every hash seen. When the current n-gram reappears
+    within `max_period` tokens, its distance becomes the candidate period and
+    each following token is compared with the one a period earlier; once
+    `min_repeats` copies of the cycle are in place the sequence is flagged.
+    A sliding window of `window` tokens maintains the token entropy
+    incrementally and flags runs whose entropy drops below `min_entropy`.
+    All updates are O(1) per token.
+
+    On a flag the sequence is either stopped, with the repeated copies cut
+    from `keep`, or (`action="resample"`) the token that would continue the
+    cycle is banned for the next step, up to `max_resamples` times.
+
+    Attributes:
+        stopped (List[bool]): Whether each sequence has been stopped.
+        reasons (List[Optional[str]]): "cycle" or "low_entropy" for stopped sequences.
+        keep (List[int]): Number of generated tokens worth keeping per sequence.
+    """
+    def __init__(self, n_sequences: int, max_new_tokens: int, ngram: int = 4, max_period: int = 64,
+                 min_repeats: int = 3, min_run: int = 16, window: int = 128, min_entropy: float = 1.5,
+                 action: Literal["stop", "resample"] = "stop", max_resamples: int = 2):
+        """
+        Initializes the detector.
+
+        Args:
+            n_sequences (int): Number of sequences in the batch.
+            max_new_tokens (int): Generation budget per sequence, used to count the tokens saved.
+            ngram (int, optional): Length of the hashed n-grams. Defaults to 4.
+            max_period (int, optional): Longest cycle detected, in tokens. Defaults to 64.
+            min_repeats (int, optional): Copies of a cycle that flag a sequence. Defaults to 3.
+            min_run (int, optional): Minimum number of repeated tokens that flag a sequence. Defaults to 16.
+            window (int, optional): Tokens in the entropy window. Defaults to 128.
+            min_entropy (float, optional): Entropy (nats) below which a full window is flagged. Defaults to 1.5.
+            action (Literal["stop", "resample"], optional): What to do on a flag. Defaults to "stop".
+            max_resamples (int, optional): Resamples before a sequence is stopped anyway. Defaults to 2.
+        """
+        self.max_new_tokens = max_new_tokens
+        self.ngram = ngram
+        self.max_period = max_period
+        self.min_repeats = min_repeats
+        self.min_run = min_run
+        self.window = window
+        self.min_entropy = min_entropy
+        self.action = action
+        self.max_resamples = max_resamples
+        self._drop = pow(_HASH_BASE, ngram - 1, _HASH_MOD)
+        self._states = [_SequenceState() for _ in range(n_sequences)]
+        self._bans: Dict[int, int] = {}
+        self.stopped = [False] * n_sequences
+        self.reasons: List[Optional[str]] = [None] * n_sequences
+        self.keep = [0] * n_sequences
+
+    def _update(self, state: _SequenceState, token: int) -> Optional[str]:
+        tokens = state.tokens
+        tokens.append(token)
+        t = len(tokens) - 1
+        # repetition: follow the current period, or look for a new one via the n-gram hash
+        if state.period and tokens[t] == tokens[t - state.period]:
+            state.run += 1
+        else:
+            state.period = state.run = 0
+        if t >= self.ngram:
+            state.hash = (state.hash - tokens[t - self.ngram] * self._drop) % _HASH_MOD
+        state.hash = (state.hash * _HASH_BASE + token) % _HASH_MOD
+        if t + 1 >= self.ngram:
+            p = state.seen.get(state.hash)
+            if not state.period and p is not None and t - p <= self.max_period and \
+                    tokens[p - self.ngram + 1:p + 1] == tokens[t - self.ngram + 1:t + 1]:
+                state.period, state.run = t - p, self.ngram
+            state.seen[state.hash] = t
+        # entropy of the sliding window
+        c = state.counts.get(token, 0)
+        state.counts[token] = c + 1
+        state.clogc += _clogc(c + 1) - _clogc(c)
+        state.window.append(token)
+        if len(state.window) > self.window:
+            old = state.window.popleft()
+            c = state.counts[old]
+            state.clogc += _clogc(c - 1) - _clogc(c)
+            if c == 1:
+                del state.counts[old]
+            else:
+                state.counts[old] = c - 1
+        if state.period and state.run >= max(state.period * (self.min_repeats - 1), self.min_run):
+            return "cycle"
+        if len(state.window) == self.window and math.log(self.window) - state.clogc / self.window < self.min_entropy:
+            return "low_entropy"
+        return None
+
+    def step(self, token_ids: Sequence[int], active: Optional[Sequence[bool]] = None) -> List[int]:
+        """
+        Feeds the next generated token of every active sequence.
+
+        Args:
+            token_ids (Sequence[int]): Next token of every sequence.
+            active (Sequence[bool], optional): Which sequences generated a token. Defaults to all.
+
+        Returns:
+            List[int]: Indices of the sequences stopped at this step.
+        """
+        newly_stopped = []
+        for i, token in enumerate(token_ids):
+            if self.stopped[i] or (active is not None and not active[i]):
+                continue
+            state = self._states[i]
+            reason = self._update(state, token)
+            if reason is None:
+                continue
+            if self.action == "resample" and state.resamples < self.max_resamples:
+                state.resamples += 1
+                if reason == "cycle":
+                    self._bans[i] = state.tokens[len(state.tokens) - state.period]
+                state.period = state.run = 0
+                state.window.clear()
+                state.counts.clear()
+                state.clogc = 0.
+                continue
+            self.stopped[i] = True
+            self.reasons[i] = reason
+            self.keep[i] = len(state.tokens) - (state.run if reason == "cycle" else 0)
+            newly_stopped.append(i)
+        return newly_stopped
+
+    def pop_bans(self) -> List[Tuple[int, int]]:
+        """
+        Returns and clears the tokens to ban at the next step.
+
+        Returns:
+            List[Tuple[int, int]]: (sequence index, token id) pairs.
+        """
+        bans = list(self._bans.items())
+        self._bans.clear()
+        return bans
+
+    def report(self) -> Dict:
+        """
+        Summarizes what the detector did.
+
+        Returns:
+            Dict: Sequences, stopped sequences by reason, tokens generated and tokens saved
+            (budget left when a sequence was stopped, plus the repeated tokens cut).
+        """
+        generated = [len(s.tokens) for s in self._states]
+        saved = sum(self.max_new_tokens - self.keep[i] for i in range(len(generated)) if self.stopped[i])
+        reasons = {}
+        for reason in self.reasons:
+            if reason is not None:
+                reasons[reason] = reasons.get(reason, 0) + 1
+        return {
+            "sequences": len(self._states),
+            "stopped": sum(self.stopped),
+            "reasons": reasons,
+            "tokens_generated": sum(generated),
+            "tokens_saved": saved,
+            "resamples": sum(s.resamples for s in self._states),
+        }
+
+
+class DegenerationCriteria(StoppingCriteria):
+    """
+    Stops a Hugging Face `model.generate` call when `DegenerationDetector` flags it.
+
+    Only the stop action applies here; the tokens worth keeping are
+    `detector.keep`. Rows that emitted EOS are not fed any more, so the
+    padding that follows them is never mistaken for a loop.
+    """
+    def __init__(self, detector: DegenerationDetector, prompt_len: int,
+                 eos_token_id: Optional[Union[int, Sequence[int]]] = None):
+        """
+        Args:
+            detector (DegenerationDetector): Detector sized for the batch.
+            prompt_len (int): Length of the (padded) prompt, so only generated tokens are fed.
+            eos_token_id (Union[int, Sequence[int]], optional): Tokens finishing a row.
+        """
+        self.detector = detector
+        self.prompt_len = prompt_len
+        self.eos = set([eos_token_id] if isinstance(eos_token_id, int) else eos_token_id or [])
+        self.finished = [False] * len(detector.stopped)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if input_ids.shape[-1] > self.prompt_len:
+            tokens = input_ids[:, -1].tolist()
+            self.detector.step(tokens, [not done for done in self.finished])
+            for i, token in enumerate(tokens):
+                if token in self.eos:
+                    self.finished[i] = True
+        return torch.tensor(self.detector.stopped, dtype=torch.bool, device=input_ids.device)
+
+
+class DegenerationStats:
+    """
+    Accumulates detector reports per call site, process-wide and per tracking scope.
+
+    `track()` opens a scope in the calling thread (e.g. one web request) and
+    yields a dict that collects the reports recorded in it.
+    """
+    def __init__(self):
+        self.totals: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @staticmethod
+    def _add(into: Dict[str, Dict[str, int]], name: str, report: Dict) -> None:
+        row = into.setdefault(name, {"calls": 0, "stopped": 0, "tokens_generated": 0, "tokens_saved": 0})
+        row["calls"] += 1
+        for key in ("stopped", "tokens_generated", "tokens_saved"):
+            row[key] += report[key]
+
+    def record(self, name: str, detector: DegenerationDetector) -> Dict:
+        """
+        Adds the report of a finished call.
+
+        Args:
+            name (str): Call site, e.g. "qwen".
+            detector (DegenerationDetector): Detector of the call.
+
+        Returns:
+            Dict: The detector's report.
+        """
+        report = detector.report()
+        with self._lock:
+            self._add(self.totals, name, report)
+        for scope in getattr(self._local, "scopes", []):
+            self._add(scope, name, report)
+        return report
+
+    @contextmanager
+    def track(self) -> Iterator[Dict[str, Dict[str, int]]]:
+        """Yields a dict collecting the reports recorded by this thread until the block exits."""
+        scopes = self._local.__dict__.setdefault("scopes", [])
+        scope: Dict[str, Dict[str, int]] = {}
+        scopes.append(scope)
+        try:
+            yield scope
+        finally:
+            scopes.remove(scope)
@@ -0,0 +1,165 @@
+import math
+import time
+from typing import Callable, Dict, Optional, Set
+
+import torch
+from torch import nn
+from safetensors import safe_open
+
+
+block_size = 128  # mirrors `model.block_size`, kept here so that CPU dequantization does not need triton
+
+
+def dequant_tile(x: torch.Tensor, s: torch.Tensor, block_size: int = block_size) -> torch.Tensor:
+    """
+    Dequantizes FP8 weights with their block scales in plain PyTorch, e.g. on CPU where Triton is unavailable.
+
+    Args:
+        x (torch.Tensor): Quantized weights of shape (M, N).
+        s (torch.Tensor): Scales of shape (ceil(M / block_size), ceil(N / block_size)).
+        block_size (int, optional): Side of the quantization blocks. Defaults to 128.
+
+    Returns:
+        torch.Tensor: The float32 weights of shape (M, N).
+    """
+    M, N = x.shape
+    y = x.to(torch.float32)
+    # broadcast every scale over its block of columns without materializing it per element
+    n_blocks = math.ceil(N / block_size)
+    pad = n_blocks * block_size - N
+    if pad:
+        y = torch.nn.functional.pad(y, (0, pad))
+    y = y.view(M, n_blocks, block_size) * s.to(torch.float32).repeat_interleave(block_size, 0)[:M, :, None]
+    return y.view(M, -1)[:, :N]
+
+
+def dequantize(x: torch.Tensor, s: torch.Tensor, block_size: int = block_size) -> torch.Tensor:
+    """
+    Dequantizes FP8 weights with the Triton kernel on CUDA and with `dequant_tile` elsewhere.
+
+    Args:
+        x (torch.Tensor): Quantized weights of shape (M, N).
+        s (torch.Tensor): Scales of shape (ceil(M / block_size), ceil(N / block_size)).
+        block_size (int, optional): Side of the quantization blocks. Defaults to 128.
+
+    Returns:
+        torch.Tensor: The dequantized weights, in the default dtype on CUDA and float32 elsewhere.
+    """
+    if x.is_cuda:
+        from kernel import weight_dequant
+        with torch.device(x.device):
+            return weight_dequant(x.contiguous(), s.to(x.device).contiguous(), block_size)
+    return dequant_tile(x, s, block_size)
+
+
+def read_param(get_tensor: Callable[[str], torch.Tensor], keys: Set[str], name: str,
+               dtype: torch.dtype, device: Optional[torch.device] = None) -> torch.Tensor:
+    """
+    Reads a parameter, dequantized when the checkpoint stores it in FP8 with a `scale` and `dtype` is wider.
+
+    Meant for small tensors such as single experts; whole layers go through `read_dequantized`.
+
+    Args:
+        get_tensor (Callable[[str], torch.Tensor]): Reads a tensor of the checkpoint by name.
+        keys (Set[str]): Names of the tensors in the checkpoint.
+        name (str): Parameter name.
+        dtype (torch.dtype): Dtype of the destination parameter.
+        device (torch.device, optional): Device to dequantize on. Defaults to the tensor's.
+
+    Returns:
+        torch.Tensor: The tensor, converted to `dtype` when it was dequantized.
+    """
+    tensor = get_tensor(name)
+    scale_name = name[:-len("weight")] + "scale"
+    if tensor.element_size() == 1 and torch.finfo(dtype).bits > 8 and scale_name in keys:
+        if device is not None:
+            tensor = tensor.to(device)
+        tensor = dequantize(tensor, get_tensor(scale_name)).to(dtype)
+    return tensor
+
+
+def read_dequantized(f, name: str, out: torch.Tensor, scale_name: str,
+                     block_size: int = block_size, tile_bytes: int = 64 << 20) -> None:
+    """
+    Reads an FP8 weight and its scales from a safetensors file and writes them dequantized into `out`.
+
+    The weight is read in tiles of whole row blocks, so at most `tile_bytes`
+    of float32 staging memory is used whatever the size of the weight. Tiles
+    headed to a CUDA tensor are dequantized by the Triton kernel, the others
+    by `dequant_tile`.
+
+    Args:
+        f: Open `safe_open` handle.
+        name (str): Name of the FP8 weight.
+        out (torch.Tensor): Destination, e.g. a bf16 `Linear.weight`, of the same shape.
+        scale_name (str): Name of the scale tensor.
+        block_size (int, optional): Side of the quantization blocks. Defaults to 128.
+        tile_bytes (int, optional): Staging memory per tile. Defaults to 64 MiB.
+    """
+    weight = f.get_slice(name)
+    scale = f.get_tensor(scale_name)
+    rows, cols = weight.get_shape()
+    step = max(tile_bytes // (cols * 4) // block_size, 1) * block_size
+    for r in range(0, rows, step):
+        tile = weight[r:r + step].to(out.device)
+        s = scale[r // block_size:math.ceil(min(r + step, rows) / block_size)]
+        out[r:r + step].copy_(dequantize(tile, s, block_size))
+
+
+def copy_param(f, keys: Set[str], name: str, param: torch.Tensor, **kwargs) -> bool:
+    """
+    Copies one tensor of a checkpoint into `param`, dequantizing it when the checkpoint is FP8 and `param` is not.
+
+    Args:
+        f: Open `safe_open` handle.
+        keys (Set[str]): Names of the tensors in the file.
+        name (str): Parameter name.
+        param (torch.Tensor): Destination.
+        **kwargs: Forwarded to `read_dequantized`.
+
+    Returns:
+        bool: Whether the tensor was dequantized.
+    """
+    scale_name = name[:-len("weight")] + "scale"
+    if name.endswith(".weight") and scale_name in keys and param.element_size() > 1:
+        read_dequantized(f, name, param, scale_name, **kwargs)
+        return True
+    param.copy_(f.get_tensor(name))
+    return False
+
+
+def load_checkpoint(model: nn.Module, ckpt_file: str, **kwargs) -> Dict[str, float]:
+    """
+    Loads a shard into `model`, turning FP8 weights into the model's dtype on the fly.
+
+    A model built with `dtype="bf16"` can load the FP8 shards written by
+    `convert.py` directly: every weight that has a `scale` in the file but
+    not in the model is dequantized block by block into its parameter, and
+    the scales themselves are consumed. Other tensors are copied as is, so
+    FP8 models and bf16 checkpoints load exactly as with `load_model`.
+
+    Args:
+        model (nn.Module): Model to fill.
+        ckpt_file (str): Path of the safetensors shard.
+        **kwargs: Forwarded to `read_dequantized`.
+
+    Returns:
+        Dict[str, float]: Number of tensors copied and dequantized, and seconds spent.
+
+    Raises:
+        KeyError: If a parameter of `model` is missing from the shard.
+    """
+    start = time.perf_counter()
+    stats = {"copied": 0, "dequantized": 0}
+    with safe_open(ckpt_file, framework="pt", device="cpu") as f:
+        keys = set(f.keys())
+        state_dict = model.state_dict()
+        missing = [name for name in state_dict if name not in keys]
+        if missing:
+            raise KeyError(f"Missing tensors in {ckpt_file}: {missing[:8]}{' ...' if len(missing) > 8 else ''}")
+        with torch.no_grad():
+            for name, param in state_dict.items():
+                dequantized = copy_param(f, keys, name, param, **kwargs)
+                stats["dequantized" if dequantized else "copied"] += 1
+    stats["seconds"] = time.perf_counter() - start
+    return stats
@@ -0,0 +1,153 @@
+from typing import Callable, List, Optional, Sequence
+
+
+class IncrementalDetokenizer:
+    """
+    Turns generated token ids into text one step at a time, for a batch of sequences.
+
+    Every sequence keeps two offsets into its ids: `prefix_offset` marks the
+    start of a short window already emitted as text and `read_offset` the end
+    of it. On each new token only the window plus the new ids are decoded, so
+    the cost per token does not grow with the output length. Text is emitted
+    only once it no longer ends with U+FFFD, which is what byte-fallback
+    tokenizers produce while a multi-byte UTF-8 character is split across
+    tokens; the pending bytes are kept until the character is complete.
+
+    Stop strings are searched only in the freshly emitted text plus the last
+    `len(longest stop) - 1` characters before it, so matches spanning two
+    steps are found without rescanning the whole output. Text passed to
+    `on_text` holds back a trailing partial match of a stop string, so a
+    streaming client never sees the beginning of a stop string.
+
+    Attributes:
+        texts (List[str]): Text emitted so far per sequence, cut before a stop string.
+        stopped (List[bool]): Whether a stop string has been found per sequence.
+        streamed (List[int]): Number of characters of `texts` passed to `on_text` per sequence.
+    """
+    def __init__(self, tokenizer, n_sequences: int, prompt_tokens: Optional[Sequence[Sequence[int]]] = None,
+                 stop: Sequence[str] = (), skip_special_tokens: bool = True,
+                 on_text: Optional[Callable[[int, str], None]] = None):
+        """
+        Initializes the detokenizer.
+
+        Args:
+            tokenizer: Hugging Face tokenizer used to decode.
+            n_sequences (int): Number of sequences in the batch.
+            prompt_tokens (Sequence[Sequence[int]], optional): Prompts of the sequences; their last
+                tokens seed the decoding window so leading spaces are rendered as in a full decode.
+            stop (Sequence[str], optional): Strings that end a sequence. Defaults to none.
+            skip_special_tokens (bool, optional): Whether to drop special tokens. Defaults to True.
+            on_text (Callable[[int, str], None], optional): Called with (sequence index, new text)
+                whenever text is emitted.
+        """
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.stop = [s for s in stop if s]
+        self.on_text = on_text
+        self._tail = max((len(s) for s in self.stop), default=1) - 1
+        self.ids: List[List[int]] = []
+        self.prefix_offsets: List[int] = []
+        self.read_offsets: List[int] = []
+        for i in range(n_sequences):
+            context = list(prompt_tokens[i][-6:]) if prompt_tokens is not None else []
+            self.ids.append(context)
+            self.prefix_offsets.append(max(len(context) - 5, 0))
+            self.read_offsets.append(len(context))
+        self.texts = [""] * n_sequences
+        self.stopped = [False] * n_sequences
+        self.streamed = [0] * n_sequences
+
+    def _decode(self, ids: List[int]) -> str:
+        return self.tokenizer.decode(ids, skip_special_tokens=self.skip_special_tokens)
+
+    def _held_back(self, text: str) -> int:
+        # length of the longest suffix of `text` that could still grow into a stop string
+        for n in range(min(self._tail, len(text)), 0, -1):
+            if any(s.startswith(text[-n:]) for s in self.stop):
+                return n
+        return 0
+
+    def _emit(self, i: int, delta: str, final: bool = False) -> None:
+        text = self.texts[i] + delta
+        if self.stop:
+            start = max(len(self.texts[i]) - self._tail, 0)
+            hits = [h for h in (text.find(s, start) for s in self.stop) if h >= 0]
+            if hits:
+                text = text[:min(hits)]
+                self.stopped[i] = True
+        self.texts[i] = text
+        if self.on_text is not None:
+            end = len(text) if final or self.stopped[i] else len(text) - self._held_back(text)
+            if end > self.streamed[i]:
+                self.on_text(i, text[self.streamed[i]:end])
+                self.streamed[i] = end
+
+    def add(self, i: int, token_id: int) -> str:
+        """
+        Appends one token to a sequence and returns the text that became stable.
+
+        Args:
+            i (int): Index of the sequence.
+            token_id (int): Generated token id.
+
+        Returns:
+            str: Newly emitted text, possibly empty.
+        """
+        if self.stopped[i]:
+            return ""
+        ids = self.ids[i]
+        ids.append(token_id)
+        prefix_offset, read_offset = self.prefix_offsets[i], self.read_offsets[i]
+        prefix_text = self._decode(ids[prefix_offset:read_offset])
+        new_text = self._decode(ids[prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+        before = len(self.texts[i])
+        self._emit(i, new_text[len(prefix_text):])
+        # only the window is ever decoded again, so the consumed ids can go
+        del ids[:read_offset]
+        self.prefix_offsets[i] = 0
+        self.read_offsets[i] = len(ids)
+        return self.texts[i][before:]
+
+    def step(self, token_ids: Sequence[int], active: Optional[Sequence[bool]] = None) -> List[str]:
+        """
+        Appends one token to every active sequence.
+
+        Args:
+            token_ids (Sequence[int]): Next token of every sequence.
+            active (Sequence[bool], optional): Which sequences take the token. Defaults to all.
+
+        Returns:
+            List[str]: Newly emitted text per sequence.
+        """
+        return [self.add(i, t) if active is None or active[i] else "" for i, t in enumerate(token_ids)]
+
+    def truncate(self, i: int, token_ids: Sequence[int]) -> None:
+        """
+        Replaces the text of a sequence by the decoding of `token_ids`, e.g. after its tail was cut.
+
+        Args:
+            i (int): Index of the sequence.
+            token_ids (Sequence[int]): Generated tokens to keep.
+        """
+        self.texts[i] = self._decode(list(token_ids))
+        self.ids[i] = []
+        self.prefix_offsets[i] = self.read_offsets[i] = 0
+        self.stopped[i] = True
+
+    def finish(self) -> List[str]:
+        """
+        Flushes the text still held back (e.g. an incomplete UTF-8 sequence at the end).
+
+        Returns:
+            List[str]: Final text of every sequence.
+        """
+        for i, ids in enumerate(self.ids):
+            if self.stopped[i]:
+                continue
+            prefix_text = self._decode(ids[self.prefix_offsets[i]:self.read_offsets[i]])
+            new_text = self._decode(ids[self.prefix_offsets[i]:])
+            self._emit(i, new_text[len(prefix_text):], final=True)
+            self.prefix_offsets[i] = self.read_offsets[i] = len(ids)
+        return self.texts
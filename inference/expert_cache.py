@@ -0,0 +1,177 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, Iterable, Literal, Tuple
+
+import torch
+from torch import nn
+from safetensors import safe_open
+
+from model import ModelArgs, Expert, MoE
+from dequant import load_checkpoint, read_param
+
+
+class ExpertCache:
+    """
+    Keeps a bounded set of routed experts resident and loads the others on demand.
+
+    Expert weights stay in the memory-mapped safetensors shard (`source="disk"`)
+    or in host memory (`source="host"`), and only the most recently used experts
+    are materialized on the compute device, up to `budget_bytes`. While a MoE
+    layer runs, the gate of the next MoE layer is applied to its input to
+    predict which experts will be needed and they are loaded in the background.
+
+    Attributes:
+        budget_bytes (int): Maximum number of bytes of resident expert weights.
+        device (torch.device): Device the resident experts live on.
+        resident (OrderedDict): Resident experts keyed by (layer_id, expert_id), least recently used first.
+        stats (Dict[str, int]): Hit, miss, eviction and prefetch counters.
+    """
+    def __init__(self, ckpt_file: str, args: ModelArgs, budget_bytes: int, device: str = "cpu",
+                 source: Literal["disk", "host"] = "disk", n_workers: int = 2):
+        """
+        Initializes the expert cache.
+
+        Args:
+            ckpt_file (str): Path of the rank's `model{rank}-mp{world_size}.safetensors` shard.
+            args (ModelArgs): Model arguments, used to build the `Expert` modules.
+            budget_bytes (int): Maximum number of bytes of resident expert weights.
+            device (str, optional): Device the resident experts live on. Defaults to "cpu".
+            source (Literal["disk", "host"], optional): Where non-resident weights are kept. Defaults to "disk".
+            n_workers (int, optional): Number of background loader threads. Defaults to 2.
+        """
+        self.args = args
+        self.budget_bytes = budget_bytes
+        self.device = torch.device(device)
+        self.resident: "OrderedDict[Tuple[int, int], Tuple[nn.Module, int]]" = OrderedDict()
+        self.resident_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "prefetched": 0}
+        self.gates: Dict[int, nn.Module] = {}
+        self.local_experts: Dict[int, Tuple[int, int]] = {}
+        self._file = safe_open(ckpt_file, framework="pt", device="cpu")
+        self._keys = set(self._file.keys())
+        self._host: Dict[str, torch.Tensor] = {}
+        if source == "host":
+            pin = self.device.type == "cuda"
+            for name in self._file.keys():
+                if ".experts." in name:
+                    tensor = self._file.get_tensor(name)
+                    self._host[name] = tensor.pin_memory() if pin else tensor
+        self._lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._inflight: Dict[Tuple[int, int], Future] = {}
+        self._pool = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="expert-prefetch")
+
+    def attach(self, model: nn.Module) -> None:
+        """
+        Routes the routed experts of every `MoE` layer of `model` through this cache.
+
+        Args:
+            model (nn.Module): Model built with `ModelArgs.expert_offload` enabled.
+        """
+        for module in model.modules():
+            if isinstance(module, MoE):
+                module.expert_cache = self
+                self.gates[module.layer_id] = module.gate
+                self.local_experts[module.layer_id] = (module.experts_start_idx, module.experts_end_idx)
+
+    def _read(self, name: str) -> torch.Tensor:
+        if name in self._host:
+            return self._host[name]
+        with self._read_lock:
+            return self._file.get_tensor(name)
+
+    @torch.no_grad()
+    def _load(self, key: Tuple[int, int]) -> nn.Module:
+        layer_id, expert_id = key
+        prefix = f"layers.{layer_id}.ffn.experts.{expert_id}."
+        with torch.device(self.device):
+            expert = Expert(self.args.dim, self.args.moe_inter_dim)
+        nbytes = 0
+        for name, param in expert.named_parameters():
+            param.copy_(read_param(self._read, self._keys, prefix + name, param.dtype, self.device), non_blocking=True)
+            nbytes += param.numel() * param.element_size()
+        with self._lock:
+            self._inflight.pop(key, None)
+            if key not in self.resident:
+                self.resident[key] = (expert, nbytes)
+                self.resident_bytes += nbytes
+                self._evict()
+        return expert
+
+    def _evict(self) -> None:
+        while self.resident_bytes > self.budget_bytes and len(self.resident) > 1:
+            _, (_, nbytes) = self.resident.popitem(last=False)
+            self.resident_bytes -= nbytes
+            self.stats["evictions"] += 1
+
+    def get(self, layer_id: int, expert_id: int) -> nn.Module:
+        """
+        Returns a resident expert, loading it synchronously if needed.
+
+        Args:
+            layer_id (int): Index of the transformer layer.
+            expert_id (int): Index of the routed expert.
+
+        Returns:
+            nn.Module: The expert module.
+        """
+        key = (layer_id, expert_id)
+        with self._lock:
+            entry = self.resident.get(key)
+            if entry is not None:
+                self.resident.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[0]
+            self.stats["misses"] += 1
+            future = self._inflight.get(key)
+        if future is not None:
+            return future.result()
+        return self._load(key)
+
+    def prefetch(self, layer_id: int, expert_ids: Iterable[int]) -> None:
+        """
+        Loads experts in the background unless they are resident or already loading.
+
+        Args:
+            layer_id (int): Index of the transformer layer.
+            expert_ids (Iterable[int]): Indices of the experts expected to be used.
+        """
+        with self._lock:
+            for expert_id in expert_ids:
+                key = (layer_id, expert_id)
+                if key in self.resident or key in self._inflight:
+                    continue
+                self._inflight[key] = self._pool.submit(self._load, key)
+                self.stats["prefetched"] += 1
+
+    def prefetch_next(self, layer_id: int, x: torch.Tensor) -> None:
+        """
+        Predicts the experts of the next MoE layer from the current input and prefetches them.
+
+        The next layer's gate is applied to the current hidden states, which the
+        residual stream keeps close to the states the next layer will see.
+
+        Args:
+            layer_id (int): Index of the layer currently running.
+            x (torch.Tensor): Flattened input of the current MoE layer.
+        """
+        gate = self.gates.get(layer_id + 1)
+        if gate is None:
+            return
+        start, end = self.local_experts[layer_id + 1]
+        _, indices = gate(x)
+        expert_ids = [i for i in indices.unique().tolist() if start <= i < end]
+        self.prefetch(layer_id + 1, expert_ids)
+
+
+@torch.no_grad()
+def load_dense_weights(model: nn.Module, ckpt_file: str) -> None:
+    """
+    Loads every weight of `model` from the shard, leaving the routed experts on disk.
+
+    Args:
+        model (nn.Module): Model built with `ModelArgs.expert_offload` enabled.
+        ckpt_file (str): Path of the rank's safetensors shard.
+    """
+    load_checkpoint(model, ckpt_file)
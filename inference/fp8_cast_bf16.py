@@ -1,15 +1,19 @@
 import os
 import json
+import threading
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from glob import glob
 from tqdm import tqdm
 
 import torch
-from safetensors.torch import load_file, save_file
+from safetensors import safe_open
 
-from kernel import weight_dequant
+from convert import ShardWriter
+from dequant import dequantize, block_size
 
-def main(fp8_path, bf16_path):
+def main(fp8_path, bf16_path, device=None, workers=2, tile_mb=64):
     """
     Converts FP8 weights to BF16 and saves the converted weights.
 
@@ -20,30 +24,40 @@ def main(fp8_path, bf16_path):
     Args:
     fp8_path (str): The path to the directory containing the FP8 weights and model index file.
     bf16_path (str): The path to the directory where the converted BF16 weights will be saved.
+    device (str, optional): Device the dequantization runs on, "cuda" (Triton kernel) or "cpu".
+        Defaults to "cuda" when available.
+    workers (int, optional): Number of files converted in parallel. Defaults to 2.
+    tile_mb (int, optional): Rows of an FP8 weight are dequantized in tiles of at most this many MB. Defaults to 64.
 
     Raises:
     KeyError: If a required scale_inv tensor is missing for a weight.
 
     Notes:
     - The function assumes that the FP8 weights are stored in safetensor files.
-    - The function caches loaded safetensor files to optimize memory usage.
+    - Tensors are read lazily with `safe_open`, one tile at a time, and written at their offset
+      in the output file, which is only renamed to its final name once complete.
+    - Completed files are recorded in `.fp8-cast-progress.json`; a rerun skips them.
     - The function updates the model index file to remove references to scale_inv tensors.
     """
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
     torch.set_default_dtype(torch.bfloat16)
     os.makedirs(bf16_path, exist_ok=True)
     model_index_file = os.path.join(fp8_path, "model.safetensors.index.json")
     with open(model_index_file, "r") as f:
         model_index = json.load(f)
     weight_map = model_index["weight_map"]
-    
-    # Cache for loaded safetensor files
-    loaded_files = {}
-    fp8_weight_names = []
 
-    # Helper function to get tensor from the correct file
-    def get_tensor(tensor_name):
+    # Progress manifest: FP8 weights converted in every completed file
+    manifest_file = os.path.join(bf16_path, ".fp8-cast-progress.json")
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+    manifest_lock = threading.Lock()
+
+    def get_scale_inv(tensor_name):
         """
-        Retrieves a tensor from the cached safetensor files or loads it from disk if not cached.
+        Reads a scale_inv tensor from whichever file holds it.
 
         Args:
             tensor_name (str): The name of the tensor to retrieve.
@@ -54,59 +68,82 @@ def main(fp8_path, bf16_path):
         Raises:
             KeyError: If the tensor does not exist in the safetensor file.
         """
-        file_name = weight_map[tensor_name]
-        if file_name not in loaded_files:
-            file_path = os.path.join(fp8_path, file_name)
-            loaded_files[file_name] = load_file(file_path, device="cuda")
-        return loaded_files[file_name][tensor_name]
+        file_path = os.path.join(fp8_path, weight_map[tensor_name])
+        with safe_open(file_path, framework="pt", device="cpu") as f:
+            return f.get_tensor(tensor_name)
+
+    def convert_file(safetensor_file):
+        file_name = os.path.basename(safetensor_file)
+        fp8_weight_names = []
+        with safe_open(safetensor_file, framework="pt", device="cpu") as f:
+            layout = {}
+            for weight_name in f.keys():
+                if weight_name.endswith("_scale_inv"):
+                    continue
+                weight = f.get_slice(weight_name)
+                dtype, shape = weight.get_dtype(), weight.get_shape()
+                if dtype.startswith("F8"):  # FP8 weight
+                    if f"{weight_name}_scale_inv" in weight_map:
+                        fp8_weight_names.append(weight_name)
+                        dtype = "BF16"
+                    else:
+                        print(f"Warning: Missing scale_inv tensor for {weight_name}, skipping conversion")
+                layout[weight_name] = (dtype, shape)
+            writer = ShardWriter([os.path.join(bf16_path, file_name)], [layout])
+            for weight_name in layout:
+                if weight_name not in fp8_weight_names:
+                    writer.write(0, weight_name, f.get_tensor(weight_name))
+                    continue
+                scale_inv = get_scale_inv(f"{weight_name}_scale_inv").to(device)
+                weight = f.get_slice(weight_name)
+                rows, cols = weight.get_shape()
+                step = max(tile_mb * 2 ** 20 // (cols * 4) // block_size, 1) * block_size
+                for r in range(0, rows, step):
+                    tile = weight[r:r + step].to(device)
+                    s = scale_inv[r // block_size:(min(r + step, rows) + block_size - 1) // block_size]
+                    y = dequantize(tile, s, block_size).to(torch.bfloat16)
+                    writer.write(0, weight_name, y.cpu(), start=r * cols * 2)
+            writer.close()
+        with manifest_lock:
+            manifest[file_name] = fp8_weight_names
+            tmp = manifest_file + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(manifest, f)
+            os.replace(tmp, manifest_file)
+        return os.path.getsize(safetensor_file)
 
     safetensor_files = list(glob(os.path.join(fp8_path, "*.safetensors")))
     safetensor_files.sort()
-    for safetensor_file in tqdm(safetensor_files):
-        file_name = os.path.basename(safetensor_file)
-        current_state_dict = load_file(safetensor_file, device="cuda")
-        loaded_files[file_name] = current_state_dict
-        
-        new_state_dict = {}
-        for weight_name, weight in current_state_dict.items():
-            if weight_name.endswith("_scale_inv"):
-                continue
-            elif weight.element_size() == 1:  # FP8 weight
-                scale_inv_name = f"{weight_name}_scale_inv"
-                try:
-                    # Get scale_inv from the correct file
-                    scale_inv = get_tensor(scale_inv_name)
-                    fp8_weight_names.append(weight_name)
-                    new_state_dict[weight_name] = weight_dequant(weight, scale_inv)
-                except KeyError:
-                    print(f"Warning: Missing scale_inv tensor for {weight_name}, skipping conversion")
-                    new_state_dict[weight_name] = weight
-            else:
-                new_state_dict[weight_name] = weight
-                
-        new_safetensor_file = os.path.join(bf16_path, file_name)
-        save_file(new_state_dict, new_safetensor_file)
-        
-        # Memory management: keep only the 2 most recently used files
-        if len(loaded_files) > 2:
-            oldest_file = next(iter(loaded_files))
-            del loaded_files[oldest_file]
-            torch.cuda.empty_cache()
-    
+    todo = [p for p in safetensor_files
+            if os.path.basename(p) not in manifest or not os.path.exists(os.path.join(bf16_path, os.path.basename(p)))]
+    if len(todo) < len(safetensor_files):
+        print(f"Resuming: {len(safetensor_files) - len(todo)} of {len(safetensor_files)} files already converted")
+    start, read_bytes = time.perf_counter(), 0
+    with ThreadPoolExecutor(max_workers=workers) as pool, tqdm(total=len(todo)) as bar:
+        for future in as_completed([pool.submit(convert_file, p) for p in todo]):
+            read_bytes += future.result()
+            bar.set_postfix_str(f"{read_bytes / 2 ** 30 / max(time.perf_counter() - start, 1e-9):.2f} GB/s")
+            bar.update()
+
     # Update model index
     new_model_index_file = os.path.join(bf16_path, "model.safetensors.index.json")
-    for weight_name in fp8_weight_names:
+    for weight_name in (name for names in manifest.values() for name in names):
         scale_inv_name = f"{weight_name}_scale_inv"
         if scale_inv_name in weight_map:
             weight_map.pop(scale_inv_name)
     with open(new_model_index_file, "w") as f:
         json.dump({"metadata": {}, "weight_map": weight_map}, f, indent=2)
-        
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--input-fp8-hf-path", type=str, required=True)
     parser.add_argument("--output-bf16-hf-path", type=str, required=True)
+    parser.add_argument("--device", type=str, choices=["cuda", "cpu"], default=None)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--tile-mb", type=int, default=64)
     args = parser.parse_args()
-    main(args.input_fp8_hf_path, args.output_bf16_hf_path)
-    
+    main(args.input_fp8_hf_path, args.output_bf16_hf_path, args.device, args.workers, args.tile_mb)
+
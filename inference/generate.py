@@ -2,7 +2,7 @@ import os
 import json
 import zlib
 from argparse import ArgumentParser
-from typing import List, Dict
+from typing import Callable, List, Dict, Optional, Sequence
 from datetime import datetime
 import docx
 from docx.shared import Pt, Inches
@@ -23,15 +23,28 @@ from googleapiclient.errors import HttpError
 
 import torch
 import torch.distributed as dist
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoTokenizer, AutoModelForCausalLM, StoppingCriteriaList
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email import encoders
-from safetensors.torch import load_model
 
-from model import Transformer, ModelArgs
+from model import Transformer, ModelArgs, MoE, moe_phase_report
+from expert_cache import ExpertCache, load_dense_weights
+from telemetry import RoutingTelemetry, summarize
+from weight_stream import build_streaming_model
+from profiler import LayerProfiler
+from detokenizer import IncrementalDetokenizer
+from cpu_tuner import CpuTuner, pin_cpu_rank
+from degeneration import DegenerationDetector, DegenerationCriteria, DegenerationStats
+from model_pool import ModelPool
+from mmap_loader import MappedShard, load_mapped
+from manifest import verify_checkpoint
+from cover import CoverService
+from segmenter import make_chunk, pack_units, split_paragraphs, split_units, stitch
+from refine_cache import RefineCache
+from static_generate import StaticGenerator
 
 app = Flask(__name__)
 
@@ -87,238 +100,478 @@ load_dotenv()
 # Configurazione API Google (no default hardcoded)
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 if GOOGLE_API_KEY:
-genai.configure(api_key=GOOGLE_API_KEY)
+    genai.configure(api_key=GOOGLE_API_KEY)
 
 # Configurazione del modello Gemini
 model = genai.GenerativeModel('gemini-pro') if GOOGLE_API_KEY else None
 
-# Qwen3 local model (Transformers) lazy loading
-QWEN_LOCAL_MODEL_PATH = os.getenv('QWEN_LOCAL_MODEL_PATH', 'models/Qwen3-8B')
-_qwen_model = None
-_qwen_tokenizer = None
+# Core assignment of the local models running on CPU (see cpu_tuner.py)
+_cpu_tuner = CpuTuner(
+    autotune=os.getenv('CPU_TUNER_AUTOTUNE', '').lower() == 'true',
+    cache_path=os.getenv('CPU_TUNER_CACHE', '.cpu_tuning.json'),
+    shared=os.getenv('CPU_TUNER_SHARED', 'true').lower() == 'true',
+)
 
-def _load_qwen_local():
-    global _qwen_model, _qwen_tokenizer
-    if _qwen_model is not None and _qwen_tokenizer is not None:
-        return _qwen_model, _qwen_tokenizer
+def _hf_bench(model, tokenizer, n_tokens: int = 16):
+    def run() -> int:
+        input_ids = tokenizer("FractalNova", return_tensors="pt").input_ids
+        with torch.inference_mode():
+            output_ids = model.generate(
+                input_ids=input_ids,
+                max_new_tokens=n_tokens,
+                min_new_tokens=n_tokens,
+                do_sample=False,
+                pad_token_id=tokenizer.eos_token_id,
+            )
+        return output_ids.shape[-1] - input_ids.shape[-1]
+    return run
+
+# Loop/degeneration guard shared by every local generation (see degeneration.py)
+_degeneration_stats = DegenerationStats()
+DEGENERATION_ACTION = os.getenv('DEGENERATION_ACTION', 'stop')
+
+def _degeneration_guard(input_ids, max_new_tokens: int, eos_token_id=None):
+    detector = DegenerationDetector(input_ids.shape[0], max_new_tokens)
+    return detector, StoppingCriteriaList([DegenerationCriteria(detector, input_ids.shape[-1], eos_token_id)])
+
+def _trim_degenerate(gen_ids, detector: DegenerationDetector, name: str):
+    _degeneration_stats.record(name, detector)
+    return [ids[:detector.keep[i]] if detector.stopped[i] else ids for i, ids in enumerate(gen_ids)]
+
+# Shared pool of the local models: one memory budget, LRU eviction, role aliases (see model_pool.py)
+model_pool = ModelPool(int(float(os.getenv('MODEL_POOL_GB', '0')) * 2 ** 30))
+# Checks local weights against their checkpoint.manifest.json before loading: off, fast or full (see manifest.py)
+CHECKPOINT_VERIFY = os.getenv('CHECKPOINT_VERIFY', 'fast')
+
+# Short calls of these models run on static KV caches with a compiled decode step (see static_generate.py)
+STATIC_GENERATE = [m.strip() for m in os.getenv('STATIC_GENERATE', 'llama,gemma').split(',') if m.strip()]
+STATIC_GENERATE_BUCKETS = [int(b) for b in os.getenv('STATIC_GENERATE_BUCKETS', '128,512,1024').split(',') if b.strip()]
+STATIC_GENERATE_MAX_NEW_TOKENS = int(os.getenv('STATIC_GENERATE_MAX_NEW_TOKENS', '512'))
+# Buckets compiled when the model loads; the others compile on their first call
+STATIC_GENERATE_WARMUP = [int(b) for b in os.getenv('STATIC_GENERATE_WARMUP', str(min(STATIC_GENERATE_BUCKETS, default=0))).split(',') if b.strip()]
+
+def _attach_static_generator(model, name: str) -> None:
     try:
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        torch.set_default_dtype(torch.bfloat16)
-        if device.type == "cuda":
-            torch.set_default_device("cuda")
-        allow_trust = os.getenv('ALLOW_TRUST_REMOTE_CODE', '').lower() == 'true'
-        _qwen_tokenizer = AutoTokenizer.from_pretrained(QWEN_LOCAL_MODEL_PATH, trust_remote_code=allow_trust)
-        _qwen_model = AutoModelForCausalLM.from_pretrained(
-            QWEN_LOCAL_MODEL_PATH,
-            torch_dtype=torch.bfloat16 if device.type == "cuda" else torch.float32,
-            device_map="auto" if device.type == "cuda" else None,
-            trust_remote_code=allow_trust,
-        )
-        if device.type != "cuda":
-            _qwen_model = _qwen_model.to(device)
-    except Exception:
-        _qwen_model, _qwen_tokenizer = None, None
-    return _qwen_model, _qwen_tokenizer
+        generator = StaticGenerator(model, STATIC_GENERATE_BUCKETS, STATIC_GENERATE_MAX_NEW_TOKENS)
+        with _cpu_tuner.use(name):
+            warm = generator.warmup(STATIC_GENERATE_WARMUP)
+    except Exception as e:
+        print(f"{name}: static generation disabled ({e})")
+        return
+    model.static_generator = generator
+    print(f"{name}: static generation warmed up in {sum(warm.values()):.1f}s (buckets {list(warm)} of "
+          f"{generator.buckets}, {generator.memory_bytes() / 2 ** 30:.2f} GB of KV cache)")
+
+def _hf_generate(model, input_ids, max_new_tokens: int, temperature: float, eos_token_id, pad_token_id,
+                 stopping_criteria, attention_mask=None):
+    # Single prompts that fit a bucket take the static path; everything else goes through model.generate
+    static = getattr(model, "static_generator", None)
+    if static is not None and attention_mask is None:
+        output_ids = static.generate(input_ids, max_new_tokens, temperature, eos_token_id=eos_token_id,
+                                     stopping_criteria=stopping_criteria)
+        if output_ids is not None:
+            return output_ids
+    return model.generate(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        max_new_tokens=max_new_tokens,
+        do_sample=True,
+        temperature=max(temperature, 1e-5),
+        eos_token_id=eos_token_id,
+        pad_token_id=pad_token_id,
+        stopping_criteria=stopping_criteria,
+    )
 
-def qwen_humanize_and_proof(text: str, temperature: float = 0.6, max_new_tokens: int = 1024) -> str:
-    model, tokenizer = _load_qwen_local()
-    if model is None or tokenizer is None:
-        return text
-    system = (
-        "Sei un editor professionista italiano. Riscrivi il testo rendendolo più umano, naturale, "
-        "fluido e coerente. Migliora ritmo e voce, elimina ripetizioni, correggi errori grammaticali/ortografici, "
-        "mantieni il significato e lo stile scelto dall'autore. Restituisci solo il testo revisionato."
+def _load_hf_local(path: str, name: str):
+    verify_checkpoint(path, mode=CHECKPOINT_VERIFY)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.set_default_dtype(torch.bfloat16)
+    if device.type == "cuda":
+        torch.set_default_device("cuda")
+    allow_trust = os.getenv('ALLOW_TRUST_REMOTE_CODE', '').lower() == 'true'
+    tokenizer = AutoTokenizer.from_pretrained(path, trust_remote_code=allow_trust)
+    model = AutoModelForCausalLM.from_pretrained(
+        path,
+        torch_dtype=torch.bfloat16 if device.type == "cuda" else torch.float32,
+        device_map="auto" if device.type == "cuda" else None,
+        trust_remote_code=allow_trust,
     )
+    if device.type != "cuda":
+        model = model.to(device)
+        _cpu_tuner.register(name, _hf_bench(model, tokenizer))
+    if name in STATIC_GENERATE:
+        _attach_static_generator(model, name)
+    return model, tokenizer
+
+# Qwen3 local model (Transformers) lazy loading
+QWEN_LOCAL_MODEL_PATH = os.getenv('QWEN_LOCAL_MODEL_PATH', 'models/Qwen3-8B')
+model_pool.register("qwen", lambda: _load_hf_local(os.getenv('QWEN_LOCAL_MODEL_PATH', QWEN_LOCAL_MODEL_PATH), "qwen"),
+                    on_unload=lambda: _cpu_tuner.unregister("qwen"))
+
+QWEN_SYSTEM_PROMPT = (
+    "Sei un editor professionista italiano. Riscrivi il testo rendendolo più umano, naturale, "
+    "fluido e coerente. Migliora ritmo e voce, elimina ripetizioni, correggi errori grammaticali/ortografici, "
+    "mantieni il significato e lo stile scelto dall'autore. Restituisci solo il testo revisionato."
+)
+# Humanization batches: at most QWEN_BATCH_SIZE texts whose prompt lengths differ by at most QWEN_BUCKET_RATIO
+QWEN_BATCH_SIZE = int(os.getenv('QWEN_BATCH_SIZE', '4'))
+QWEN_BUCKET_RATIO = float(os.getenv('QWEN_BUCKET_RATIO', '1.5'))
+# Long texts are rewritten in chunks of at most QWEN_CHUNK_TOKENS, each seeing QWEN_CHUNK_OVERLAP paragraphs before it
+QWEN_CHUNK_TOKENS = int(os.getenv('QWEN_CHUNK_TOKENS', '768'))
+QWEN_CHUNK_OVERLAP = int(os.getenv('QWEN_CHUNK_OVERLAP', '1'))
+QWEN_EXPANSION = 1.3  # headroom of the rewrite over the length of its input
+# Paragraph rewrites cache (see refine_cache.py): in memory by default, a JSON lines file to persist it
+# across runs (it holds the rewritten manuscripts), "off" to disable
+HUMANIZE_CACHE = os.getenv('HUMANIZE_CACHE', '')
+_refine_cache = RefineCache(HUMANIZE_CACHE, int(os.getenv('HUMANIZE_CACHE_ENTRIES', '100000'))) \
+    if HUMANIZE_CACHE != 'off' else None
+
+def _qwen_prompt_ids(tokenizer, text: str, context: str = "") -> List[int]:
     user = (
         "Testo da umanizzare e correggere (mantieni lingua e contenuti, migliora qualità editoriale):\n\n" + text
     )
-    try:
-        # Prefer chat template if available
-        if hasattr(tokenizer, "apply_chat_template"):
-            messages = [
-                {"role": "system", "content": system},
-                {"role": "user", "content": user},
-            ]
-            input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt")
-        else:
-            prompt = f"[SYSTEM]\n{system}\n[/SYSTEM]\n[USER]\n{user}\n[/USER]\n[ASSISTANT]"
-            input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+    if context:
+        user = (
+            "Contesto precedente, solo per continuità (non riscriverlo e non includerlo nella risposta):\n\n"
+            + context + "\n\n" + user
+        )
+    # Prefer chat template if available
+    if hasattr(tokenizer, "apply_chat_template"):
+        messages = [
+            {"role": "system", "content": QWEN_SYSTEM_PROMPT},
+            {"role": "user", "content": user},
+        ]
+        return list(tokenizer.apply_chat_template(messages, add_generation_prompt=True))
+    prompt = f"[SYSTEM]\n{QWEN_SYSTEM_PROMPT}\n[/SYSTEM]\n[USER]\n{user}\n[/USER]\n[ASSISTANT]"
+    return tokenizer(prompt).input_ids
+
+def length_buckets(lengths: Sequence[int], batch_size: int, ratio: float = QWEN_BUCKET_RATIO) -> List[List[int]]:
+    """
+    Groups items of similar length so that batches waste little compute on padding.
 
-        device = next(model.parameters()).device
-        input_ids = input_ids.to(device)
-        with torch.inference_mode():
-            output_ids = model.generate(
-                input_ids=input_ids,
-                max_new_tokens=max_new_tokens,
-                do_sample=True,
-                temperature=max(temperature, 1e-5),
-                eos_token_id=tokenizer.eos_token_id,
-                pad_token_id=tokenizer.eos_token_id,
-            )
-        gen_ids = output_ids[:, input_ids.shape[-1]:]
-        out = tokenizer.decode(gen_ids[0], skip_special_tokens=True)
-        return out.strip() or text
+    Args:
+        lengths (Sequence[int]): Length of every item.
+        batch_size (int): Maximum items per bucket.
+        ratio (float, optional): Maximum ratio between the longest and the shortest item of a bucket.
+
+    Returns:
+        List[List[int]]: Indices of the items of every bucket, shortest first.
+    """
+    buckets = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        if buckets and len(buckets[-1]) < batch_size and lengths[i] <= max(lengths[buckets[-1][0]], 1) * ratio:
+            buckets[-1].append(i)
+        else:
+            buckets.append([i])
+    return buckets
+
+def _qwen_generate(model, tokenizer, prompts: List[List[int]], temperature: float, max_new_tokens: int) -> List[str]:
+    device = next(model.parameters()).device
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    width = max(len(ids) for ids in prompts)
+    # left padding keeps the last prompt token of every row aligned with the first generated one
+    input_ids = torch.tensor([[pad_id] * (width - len(ids)) + ids for ids in prompts], device=device)
+    attention_mask = None
+    if len(prompts) > 1:
+        attention_mask = torch.tensor([[0] * (width - len(ids)) + [1] * len(ids) for ids in prompts], device=device)
+    detector, stopping = _degeneration_guard(input_ids, max_new_tokens, tokenizer.eos_token_id)
+    with torch.inference_mode(), _cpu_tuner.use("qwen"):
+        output_ids = _hf_generate(model, input_ids, max_new_tokens, temperature, tokenizer.eos_token_id, pad_id,
+                                  stopping, attention_mask)
+    gen_ids = _trim_degenerate(output_ids[:, width:], detector, "qwen")
+    return [tokenizer.decode(ids, skip_special_tokens=True).strip() for ids in gen_ids]
+
+def _qwen_rewrite(model, tokenizer, texts: Sequence[str], temperature: float, max_new_tokens: int,
+                  batch_size: int, contexts: Optional[Sequence[str]] = None) -> List[Optional[str]]:
+    results: List[Optional[str]] = [None] * len(texts)
+    try:
+        prompts = [_qwen_prompt_ids(tokenizer, text, contexts[i] if contexts else "") for i, text in enumerate(texts)]
     except Exception:
-        return text
+        return results
+    for bucket in length_buckets([len(ids) for ids in prompts], max(batch_size, 1)):
+        groups = [bucket]
+        while groups:
+            group = groups.pop(0)
+            try:
+                outputs = _qwen_generate(model, tokenizer, [prompts[i] for i in group], temperature, max_new_tokens)
+            except Exception:
+                if len(group) > 1:
+                    groups.extend([i] for i in group)
+                continue
+            for i, out in zip(group, outputs):
+                results[i] = out or None
+    return results
+
+def qwen_humanize_batch(texts: Sequence[str], temperature: float = 0.6, max_new_tokens: int = 1024,
+                        batch_size: int = QWEN_BATCH_SIZE, contexts: Optional[Sequence[str]] = None) -> List[str]:
+    """
+    Humanizes and proofreads several texts with Qwen, one `generate` call per bucket of similar lengths.
+
+    Prompts are left-padded and grouped by `length_buckets`, so the texts
+    of a book are rewritten at batch throughput. A bucket that fails is
+    retried one text at a time, and every text whose rewrite fails or comes
+    back empty is returned unchanged.
+
+    Args:
+        texts (Sequence[str]): Texts to rewrite.
+        temperature (float, optional): Sampling temperature. Defaults to 0.6.
+        max_new_tokens (int, optional): Maximum tokens generated per text. Defaults to 1024.
+        batch_size (int, optional): Maximum texts per `generate` call. Defaults to QWEN_BATCH_SIZE.
+        contexts (Sequence[str], optional): Preceding text shown to the model with each text, not rewritten.
+
+    Returns:
+        List[str]: The rewritten texts, in the order of `texts`.
+    """
+    if not texts:
+        return []
+    with model_pool.use("humanize", default=(None, None)) as (model, tokenizer):
+        if model is None or tokenizer is None:
+            return list(texts)
+        outputs = _qwen_rewrite(model, tokenizer, texts, temperature, max_new_tokens, batch_size, contexts)
+    return [out or text for text, out in zip(texts, outputs)]
+
+def _humanize_units(model, tokenizer, texts: Sequence[str], count_tokens, budget: int, overlap: int,
+                    temperature: float, max_new_tokens: int, cache: Optional[RefineCache] = None) -> List[str]:
+    # Headings are kept verbatim; with a cache, paragraphs already rewritten after the same context are reused
+    # and only the others are packed into chunks
+    model_id = getattr(model, "name_or_path", "") or model_pool.resolve("humanize")
+    params = {"temperature": temperature, "max_new_tokens": max_new_tokens}
+    key = lambda text, context: RefineCache.key(text, model_id, QWEN_SYSTEM_PROMPT, params, context)
+    unit_context = lambda units, i: make_chunk(units, [i], overlap).context
+    plans = []
+    for text in texts:
+        units = split_units(text, count_tokens, budget)
+        done = [p if p.startswith("#") else None for p, _, _ in units]
+        if cache is not None:
+            done = [d if d is not None else cache.get(key(units[i][0], unit_context(units, i)))
+                    for i, d in enumerate(done)]
+        groups = pack_units([n for _, n, _ in units], budget, [d is None for d in done])
+        plans.append((units, done, groups, [make_chunk(units, g, overlap) for g in groups]))
+    todo = {}
+    for units, done, groups, chunks in plans:
+        for group, chunk in zip(groups, chunks):
+            # a chunk whose rewrite could not be split back into paragraphs is cached whole
+            cached = cache.get(key(chunk.text, chunk.context)) if cache is not None and len(group) > 1 else None
+            if cached is not None:
+                done[group[0]] = cached
+                for i in group[1:]:
+                    done[i] = ""
+            elif key(chunk.text, chunk.context) not in todo:
+                todo[key(chunk.text, chunk.context)] = chunk
+    outputs = {}
+    if todo:
+        outputs = dict(zip(todo, _qwen_rewrite(model, tokenizer, [c.text for c in todo.values()], temperature,
+                                               max_new_tokens, QWEN_BATCH_SIZE, [c.context for c in todo.values()])))
+    results = []
+    for units, done, groups, chunks in plans:
+        complete = True
+        for group, chunk in zip(groups, chunks):
+            if done[group[0]] is not None:
+                continue
+            out = outputs.get(key(chunk.text, chunk.context))
+            if out is None:
+                complete = False
+                for i in group:
+                    done[i] = units[i][0]
+                continue
+            paragraphs = split_paragraphs(out)
+            if len(paragraphs) == len(group):
+                for i, rewritten in zip(group, paragraphs):
+                    done[i] = rewritten
+                    if cache is not None:
+                        cache.put(key(units[i][0], unit_context(units, i)), rewritten)
+            else:
+                done[group[0]] = out
+                for i in group[1:]:
+                    done[i] = ""
+                if cache is not None:
+                    cache.put(key(chunk.text, chunk.context), out)
+        result = stitch(done, [i > 0 and u[2] == units[i - 1][2] for i, u in enumerate(units)])
+        if cache is not None and complete:
+            # a repeat of the same pass over its own output is a no-op
+            out_units = split_units(result, count_tokens, budget)
+            for i, (p, _, _) in enumerate(out_units):
+                if not p.startswith("#"):
+                    cache.put(key(p, unit_context(out_units, i)), p)
+        results.append(result)
+    if cache is not None:
+        cache.save()
+    return results
+
+def qwen_humanize_long(texts: Sequence[str], temperature: float = 0.6, max_new_tokens: int = 1024,
+                       chunk_tokens: int = QWEN_CHUNK_TOKENS, overlap: int = QWEN_CHUNK_OVERLAP) -> List[str]:
+    """
+    Humanizes texts of any length by rewriting them in chunks of whole paragraphs.
+
+    Every text is cut into paragraphs and packed into chunks small enough for
+    their rewrite to fit in `max_new_tokens`, each preceded by `overlap`
+    paragraphs of read-only context; the chunks of all texts are rewritten
+    together in batches and joined back in order. Markdown headings are kept
+    verbatim and split the chunks around them. Nothing is truncated and the
+    cost grows linearly with the length of the texts. With the paragraph
+    cache (`HUMANIZE_CACHE`), paragraphs rewritten before after the same
+    context are taken from it and only the others are packed into chunks, so
+    a rerun after an edit costs in proportion to the edit.
+
+    Args:
+        texts (Sequence[str]): Texts to rewrite.
+        temperature (float, optional): Sampling temperature. Defaults to 0.6.
+        max_new_tokens (int, optional): Maximum tokens generated per chunk. Defaults to 1024.
+        chunk_tokens (int, optional): Maximum input tokens per chunk. Defaults to QWEN_CHUNK_TOKENS.
+        overlap (int, optional): Paragraphs of context before each chunk. Defaults to QWEN_CHUNK_OVERLAP.
+
+    Returns:
+        List[str]: The rewritten texts, in the order of `texts`.
+    """
+    with model_pool.use("humanize", default=(None, None)) as (model, tokenizer):
+        if model is None or tokenizer is None:
+            return list(texts)
+        budget = max(min(chunk_tokens, int(max_new_tokens / QWEN_EXPANSION)), 1)
+        count_tokens = lambda s: len(tokenizer(s, add_special_tokens=False).input_ids)
+        results = _humanize_units(model, tokenizer, texts, count_tokens, budget, overlap,
+                                  temperature, max_new_tokens, _refine_cache)
+        return [result or text for text, result in zip(texts, results)]
+
+def qwen_humanize_and_proof(text: str, temperature: float = 0.6, max_new_tokens: int = 1024) -> str:
+    return qwen_humanize_long([text], temperature, max_new_tokens)[0]
 
 # DeepSeek-V3 local loader and primary text generation (libro)
 DEEPSEEK_LOCAL_PATH = os.getenv('DEEPSEEK_LOCAL_PATH', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'models', 'DeepSeek-V3'))
 DEEPSEEK_CONFIG_PATH = os.getenv('DEEPSEEK_CONFIG_PATH', os.path.join(os.path.dirname(__file__), 'configs', 'config_7B.json'))
-_deepseek_model = None
-_deepseek_tokenizer = None
 
-def _load_deepseek_local():
-    global _deepseek_model, _deepseek_tokenizer
-    if _deepseek_model is not None and _deepseek_tokenizer is not None:
-        return _deepseek_model, _deepseek_tokenizer
-    try:
-        with open(DEEPSEEK_CONFIG_PATH, 'r', encoding='utf-8') as f:
+def deepseek_pool_key(model_path: str, config_path: str) -> str:
+    """
+    Registers a DeepSeek checkpoint in `model_pool` and returns its key.
+
+    Callers naming the same checkpoint and config share one loaded model. The
+    weights are mapped from the single-rank shard `model0-mp1.safetensors`
+    written by `convert.py --model-parallel 1`.
+
+    Args:
+        model_path (str): Directory of the converted checkpoint and tokenizer.
+        config_path (str): Path to the model configuration file.
+
+    Returns:
+        str: Pool key of the model.
+    """
+    def load():
+        with open(config_path, 'r', encoding='utf-8') as f:
             args = ModelArgs(**json.load(f))
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         torch.set_default_dtype(torch.bfloat16)
         if device.type == 'cuda':
             torch.set_default_device('cuda')
-        _deepseek_model = Transformer(args)
-        if device.type == 'cuda':
-            _deepseek_model = _deepseek_model.to('cuda')
-        _deepseek_tokenizer = AutoTokenizer.from_pretrained(DEEPSEEK_LOCAL_PATH)
-    except Exception:
-        _deepseek_model, _deepseek_tokenizer = None, None
-    return _deepseek_model, _deepseek_tokenizer
-
-def deepseek_generate_text(prompt: str, temperature: float = 0.9, max_new_tokens: int = 2048) -> str:
-    model, tokenizer = _load_deepseek_local()
-    if model is None or tokenizer is None:
-        return ""
-    try:
-        input_ids = tokenizer.encode(prompt)
-        out_ids = generate(
-            model,
-            [input_ids],
-            int(max_new_tokens),
-            tokenizer.eos_token_id if getattr(tokenizer, 'eos_token_id', None) is not None else -1,
-            float(temperature),
-        )[0]
-        return tokenizer.decode(out_ids)
-    except Exception:
-        return ""
+        shard_file = os.path.join(model_path, 'model0-mp1.safetensors')
+        verify_checkpoint(shard_file, mode=CHECKPOINT_VERIFY)
+        model, _ = load_mapped(args, shard_file, device.type)
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        if device.type != 'cuda':
+            _cpu_tuner.register('deepseek', lambda: len(generate(model, [tokenizer.encode("FractalNova")], 16, -1, 0.)[0]))
+        return model, tokenizer
+    return model_pool.register(f"deepseek:{os.path.abspath(model_path)}:{os.path.abspath(config_path)}", load,
+                               on_unload=lambda: _cpu_tuner.unregister('deepseek'))
+
+def deepseek_generate_text(prompt: str, temperature: float = 0.9, max_new_tokens: int = 2048,
+                           stop: Sequence[str] = (), on_text: Optional[Callable[[str], None]] = None) -> str:
+    with model_pool.use("book", default=(None, None)) as (model, tokenizer):
+        if model is None or tokenizer is None:
+            return ""
+        try:
+            input_ids = tokenizer.encode(prompt)
+            detokenizer = IncrementalDetokenizer(
+                tokenizer, 1, [input_ids], stop=stop, skip_special_tokens=False,
+                on_text=(lambda i, text: on_text(text)) if on_text is not None else None,
+            )
+            detector = DegenerationDetector(1, int(max_new_tokens), action=DEGENERATION_ACTION)
+            with _cpu_tuner.use('deepseek'):
+                generate(
+                    model,
+                    [input_ids],
+                    int(max_new_tokens),
+                    tokenizer.eos_token_id if getattr(tokenizer, 'eos_token_id', None) is not None else -1,
+                    float(temperature),
+                    detokenizer,
+                    degeneration=detector,
+                )
+            _degeneration_stats.record('deepseek', detector)
+            return detokenizer.texts[0]
+        except Exception:
+            return ""
 
 # Llama 3 local model (Transformers) lazy loading for title/plot
 LLAMA_LOCAL_MODEL_PATH = os.getenv('LLAMA_LOCAL_MODEL_PATH', 'models/Llama3-8B-Instruct')
-_llama_model = None
-_llama_tokenizer = None
-
-def _load_llama_local():
-    global _llama_model, _llama_tokenizer
-    if _llama_model is not None and _llama_tokenizer is not None:
-        return _llama_model, _llama_tokenizer
-    try:
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        torch.set_default_dtype(torch.bfloat16)
-        if device.type == "cuda":
-            torch.set_default_device("cuda")
-        allow_trust = os.getenv('ALLOW_TRUST_REMOTE_CODE', '').lower() == 'true'
-        _llama_tokenizer = AutoTokenizer.from_pretrained(LLAMA_LOCAL_MODEL_PATH, trust_remote_code=allow_trust)
-        _llama_model = AutoModelForCausalLM.from_pretrained(
-            LLAMA_LOCAL_MODEL_PATH,
-            torch_dtype=torch.bfloat16 if device.type == "cuda" else torch.float32,
-            device_map="auto" if device.type == "cuda" else None,
-            trust_remote_code=allow_trust,
-        )
-        if device.type != "cuda":
-            _llama_model = _llama_model.to(device)
-    except Exception:
-        _llama_model, _llama_tokenizer = None, None
-    return _llama_model, _llama_tokenizer
+model_pool.register("llama", lambda: _load_hf_local(os.getenv('LLAMA_LOCAL_MODEL_PATH', LLAMA_LOCAL_MODEL_PATH), "llama"),
+                    on_unload=lambda: _cpu_tuner.unregister("llama"))
 
 def llama_generate_text(prompt: str, temperature: float = 0.4, max_new_tokens: int = 256) -> str:
-    model, tokenizer = _load_llama_local()
-    if model is None or tokenizer is None:
-        return ""
-    try:
-        # Use chat template if available for Instruct models
-        if hasattr(tokenizer, "apply_chat_template"):
-            messages = [
-                {"role": "system", "content": "Sei un assistente di scrittura italiano sintetico e preciso."},
-                {"role": "user", "content": prompt},
-            ]
-            input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt")
-        else:
-            input_ids = tokenizer(prompt, return_tensors="pt").input_ids
-        device = next(model.parameters()).device
-        input_ids = input_ids.to(device)
-        with torch.inference_mode():
-            output_ids = model.generate(
-                input_ids=input_ids,
-                max_new_tokens=max_new_tokens,
-                do_sample=True,
-                temperature=max(temperature, 1e-5),
-                eos_token_id=tokenizer.eos_token_id,
-                pad_token_id=tokenizer.eos_token_id,
-            )
-        gen_ids = output_ids[:, input_ids.shape[-1]:]
-        out = tokenizer.decode(gen_ids[0], skip_special_tokens=True)
-        return out.strip()
-    except Exception:
-        return ""
+    with model_pool.use("title", default=(None, None)) as (model, tokenizer):
+        if model is None or tokenizer is None:
+            return ""
+        try:
+            # Use chat template if available for Instruct models
+            if hasattr(tokenizer, "apply_chat_template"):
+                messages = [
+                    {"role": "system", "content": "Sei un assistente di scrittura italiano sintetico e preciso."},
+                    {"role": "user", "content": prompt},
+                ]
+                input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt")
+            else:
+                input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+            device = next(model.parameters()).device
+            input_ids = input_ids.to(device)
+            detector, stopping = _degeneration_guard(input_ids, max_new_tokens, tokenizer.eos_token_id)
+            with torch.inference_mode(), _cpu_tuner.use("llama"):
+                output_ids = _hf_generate(model, input_ids, max_new_tokens, temperature, tokenizer.eos_token_id,
+                                          tokenizer.eos_token_id, stopping)
+            gen_ids = _trim_degenerate(output_ids[:, input_ids.shape[-1]:], detector, "llama")
+            out = tokenizer.decode(gen_ids[0], skip_special_tokens=True)
+            return out.strip()
+        except Exception:
+            return ""
 
 # Gemma local model (Transformers) lazy loading for SEO
 GEMMA_LOCAL_MODEL_PATH = os.getenv('GEMMA_LOCAL_MODEL_PATH', 'models/Gemma-7B')
-_gemma_model = None
-_gemma_tokenizer = None
-
-def _load_gemma_local():
-    global _gemma_model, _gemma_tokenizer
-    if _gemma_model is not None and _gemma_tokenizer is not None:
-        return _gemma_model, _gemma_tokenizer
-    try:
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        torch.set_default_dtype(torch.bfloat16)
-        if device.type == "cuda":
-            torch.set_default_device("cuda")
-        allow_trust = os.getenv('ALLOW_TRUST_REMOTE_CODE', '').lower() == 'true'
-        _gemma_tokenizer = AutoTokenizer.from_pretrained(GEMMA_LOCAL_MODEL_PATH, trust_remote_code=allow_trust)
-        _gemma_model = AutoModelForCausalLM.from_pretrained(
-            GEMMA_LOCAL_MODEL_PATH,
-            torch_dtype=torch.bfloat16 if device.type == "cuda" else torch.float32,
-            device_map="auto" if device.type == "cuda" else None,
-            trust_remote_code=allow_trust,
-        )
-        if device.type != "cuda":
-            _gemma_model = _gemma_model.to(device)
-    except Exception:
-        _gemma_model, _gemma_tokenizer = None, None
-    return _gemma_model, _gemma_tokenizer
+model_pool.register("gemma", lambda: _load_hf_local(os.getenv('GEMMA_LOCAL_MODEL_PATH', GEMMA_LOCAL_MODEL_PATH), "gemma"),
+                    on_unload=lambda: _cpu_tuner.unregister("gemma"))
 
 def gemma_generate_json(prompt: str, temperature: float = 0.3, max_new_tokens: int = 512) -> dict:
-    model, tokenizer = _load_gemma_local()
-    if model is None or tokenizer is None:
-        return {}
-    try:
-        if hasattr(tokenizer, "apply_chat_template"):
-            messages = [
-                {"role": "system", "content": "Sei un esperto SEO italiano. Rispondi SOLO in JSON valido."},
-                {"role": "user", "content": prompt},
-            ]
-            input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt")
-        else:
-            input_ids = tokenizer(prompt, return_tensors="pt").input_ids
-        device = next(model.parameters()).device
-        input_ids = input_ids.to(device)
-        with torch.inference_mode():
-            output_ids = model.generate(
-                input_ids=input_ids,
-                max_new_tokens=max_new_tokens,
-                do_sample=True,
-                temperature=max(temperature, 1e-5),
-                eos_token_id=tokenizer.eos_token_id,
-                pad_token_id=tokenizer.eos_token_id,
-            )
-        gen_ids = output_ids[:, input_ids.shape[-1]:]
-        out = tokenizer.decode(gen_ids[0], skip_special_tokens=True).strip()
-        return json.loads(out)
-    except Exception:
-        return {}
+    with model_pool.use("seo", default=(None, None)) as (model, tokenizer):
+        if model is None or tokenizer is None:
+            return {}
+        try:
+            if hasattr(tokenizer, "apply_chat_template"):
+                messages = [
+                    {"role": "system", "content": "Sei un esperto SEO italiano. Rispondi SOLO in JSON valido."},
+                    {"role": "user", "content": prompt},
+                ]
+                input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt")
+            else:
+                input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+            device = next(model.parameters()).device
+            input_ids = input_ids.to(device)
+            detector, stopping = _degeneration_guard(input_ids, max_new_tokens, tokenizer.eos_token_id)
+            with torch.inference_mode(), _cpu_tuner.use("gemma"):
+                output_ids = _hf_generate(model, input_ids, max_new_tokens, temperature, tokenizer.eos_token_id,
+                                          tokenizer.eos_token_id, stopping)
+            gen_ids = _trim_degenerate(output_ids[:, input_ids.shape[-1]:], detector, "gemma")
+            out = tokenizer.decode(gen_ids[0], skip_special_tokens=True).strip()
+            return json.loads(out)
+        except Exception:
+            return {}
+
+# Roles used by the pipeline; MODEL_POOL_ALIASES (e.g. "seo=llama,title=llama") lets roles share a model
+# and MODEL_POOL_PIN lists the roles never evicted
+model_pool.alias("humanize", "qwen")
+model_pool.alias("title", "llama")
+model_pool.alias("seo", "gemma")
+model_pool.alias("book", deepseek_pool_key(DEEPSEEK_LOCAL_PATH, DEEPSEEK_CONFIG_PATH))
+for _alias in os.getenv('MODEL_POOL_ALIASES', '').split(','):
+    if '=' in _alias:
+        _role, _key = _alias.split('=', 1)
+        model_pool.alias(_role.strip(), _key.strip())
+for _role in os.getenv('MODEL_POOL_PIN', '').split(','):
+    if _role.strip():
+        model_pool.pin(_role.strip())
 
 def analyze_seo_with_gemma(book_text: str) -> dict:
     prompt = (
@@ -458,34 +711,22 @@ def wattpad_export(book_structure: Dict) -> str:
 # Flux cover generation (text-to-image)
 FLUX_MODEL_ID = os.getenv('FLUX_MODEL_ID', 'black-forest-labs/FLUX.1-schnell')
 
+cover_service = CoverService(
+    model_pool,
+    FLUX_MODEL_ID,
+    size=int(os.getenv('COVER_SIZE', '1024')),
+    preview_size=int(os.getenv('COVER_PREVIEW_SIZE', '512')),
+    steps=int(os.getenv('COVER_STEPS', '0')) or None,
+    save_previews=os.getenv('COVER_SAVE_PREVIEWS', '').lower() == 'true',
+)
+COVER_VARIANTS = int(os.getenv('COVER_VARIANTS', '1'))
+
 def generate_cover_with_flux(title: str, refined_book_text: str, genre: str = None) -> str:
     try:
-        from diffusers import FluxPipeline
-        import torch
-        prompt = (
-            f"Copertina di libro professionale per il titolo: '{title}'. "
-            f"Stile coerente con il contenuto: {genre or ''}. "
-            f"Tema, atmosfera e simboli chiave tratti dal libro: usa elementi evocativi, tipografia leggibile, layout editoriale."
-        )
-        pipe = FluxPipeline.from_pretrained(FLUX_MODEL_ID, torch_dtype=torch.bfloat16 if torch.cuda.is_available() else torch.float32)
-        if torch.cuda.is_available():
-            pipe = pipe.to('cuda')
-        image = pipe(prompt=prompt, num_inference_steps=28, guidance_scale=3.5).images[0]
+        covers = cover_service.generate(title, genre, variants=COVER_VARIANTS)
     except Exception:
-        try:
-            from diffusers import StableDiffusionPipeline
-            pipe = StableDiffusionPipeline.from_pretrained('stabilityai/sd-turbo')
-            if torch.cuda.is_available():
-                pipe = pipe.to('cuda')
-            image = pipe(prompt=f"Book cover, professional layout, title '{title}', {genre or ''}").images[0]
-        except Exception:
-            return None
-
-    os.makedirs('book_covers', exist_ok=True)
-    safe_title = "".join(c for c in title if c.isalnum() or c in (' ', '-', '_')).rstrip()
-    image_path = os.path.join('book_covers', f"cover_{safe_title}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png")
-    image.save(image_path)
-    return image_path
+        return None
+    return covers["final"]
 
 def sample(logits, temperature: float = 1.0):
     """
@@ -503,53 +744,154 @@ def sample(logits, temperature: float = 1.0):
     return probs.div_(torch.empty_like(probs).exponential_(1)).argmax(dim=-1)
 
 
+_shard_generators = {}
+
+def sample_sharded(logits, temperature: float, vocab_start_idx: int):
+    """
+    Samples a token when every rank only holds a slice of the vocabulary.
+
+    `sample` draws argmax(p / E) with E ~ Exp(1), which is the Gumbel-max
+    trick: argmax(logits / T - log E) follows softmax(logits / T) exactly.
+    Since the noise is independent per token, each rank takes the argmax over
+    its own shard and only the (score, index) winner of every rank is
+    gathered, instead of the full-vocabulary logits.
+
+    Args:
+        logits (torch.Tensor): Local logits of shape (batch_size, vocab_size // world_size).
+        temperature (float): Temperature for scaling logits; 0 selects the argmax.
+        vocab_start_idx (int): Global index of the first token of the local shard.
+
+    Returns:
+        torch.Tensor: The sampled token, identical on every rank.
+    """
+    scores = logits.float()
+    if temperature > 0:
+        # every rank needs its own noise stream, otherwise the shards share the same draws
+        device = logits.device
+        if device not in _shard_generators:
+            generator = torch.Generator(device=device)
+            generator.manual_seed(torch.initial_seed() + dist.get_rank())
+            _shard_generators[device] = generator
+        noise = torch.empty_like(scores).exponential_(1, generator=_shard_generators[device])
+        scores = scores / max(temperature, 1e-5) - noise.log()
+    best_scores, best_idx = scores.max(dim=-1)
+    best_idx += vocab_start_idx
+    world_size = dist.get_world_size()
+    all_scores = [torch.empty_like(best_scores) for _ in range(world_size)]
+    all_idx = [torch.empty_like(best_idx) for _ in range(world_size)]
+    dist.all_gather(all_scores, best_scores)
+    dist.all_gather(all_idx, best_idx)
+    winner = torch.stack(all_scores).argmax(dim=0, keepdim=True)
+    return torch.stack(all_idx).gather(0, winner).squeeze(0)
+
+
 @torch.inference_mode()
 def generate(
     model: Transformer,
     prompt_tokens: List[List[int]],
     max_new_tokens: int,
     eos_id: int,
-    temperature: float = 1.0
+    temperature: float = 1.0,
+    detokenizer: Optional[IncrementalDetokenizer] = None,
+    packed: bool = False,
+    degeneration: Optional[DegenerationDetector] = None
 ) -> List[List[int]]:
     """
     Generates new tokens based on the given prompt tokens using the specified model.
 
+    By default the prompts share one position counter: the common prefix
+    length is prefilled in one pass and the remaining prompt tokens of the
+    longer prompts are fed one step at a time alongside the generated ones.
+    With `packed`, every prompt is prefilled in full by `forward_packed`
+    (no padding, one pass) and each sequence then decodes at its own position.
+
     Args:
         model (Transformer): The transformer model used for token generation.
         prompt_tokens (List[List[int]]): A list of lists containing the prompt tokens for each sequence.
         max_new_tokens (int): The maximum number of new tokens to generate.
         eos_id (int): The end-of-sequence token ID.
         temperature (float, optional): The temperature value for sampling. Defaults to 1.0.
+        detokenizer (IncrementalDetokenizer, optional): Receives every generated token as it is sampled;
+            a sequence that hits one of its stop strings is finished and cut there. Defaults to None.
+        packed (bool, optional): Whether to prefill the prompts packed. Ignored in pipeline mode. Defaults to False.
+        degeneration (DegenerationDetector, optional): Watches every sequence for loops and low-entropy
+            runs; flagged sequences are finished with the repeated tail cut, or have the token continuing
+            the loop banned at the next step. Defaults to None.
 
     Returns:
         List[List[int]]: A list of lists containing the generated tokens for each sequence.
     """
+    device = model.freqs_cis.device
     prompt_lens = [len(t) for t in prompt_tokens]
-    total_len = max_new_tokens + max(prompt_lens)
-    tokens = torch.full((len(prompt_tokens), total_len), -1, dtype=torch.long, device="cuda")
+    assert max(prompt_lens) <= model.max_seq_len
+    total_len = min(model.max_seq_len, max_new_tokens + max(prompt_lens))
+    tokens = torch.full((len(prompt_tokens), total_len), -1, dtype=torch.long, device=device)
     for i, t in enumerate(prompt_tokens):
-        tokens[i, :len(t)] = torch.tensor(t, dtype=torch.long, device="cuda")
+        tokens[i, :len(t)] = torch.tensor(t, dtype=torch.long, device=device)
+    packed = packed and len(prompt_tokens) > 1 and model.is_first_stage and model.is_last_stage
+    rows = torch.arange(len(prompt_tokens), device=device)
+    if packed:
+        # sequence i sits `shift[i]` positions behind the longest prompt
+        shift = torch.tensor([max(prompt_lens) - n for n in prompt_lens], device=device)
+        first_pos = max(prompt_lens)
+    else:
+        shift = torch.zeros(len(prompt_tokens), dtype=torch.long, device=device)
+        first_pos = min(prompt_lens)
+    gather_logits = not model.vocab_parallel
     prev_pos = 0
-    finished = torch.tensor([False] * len(prompt_tokens), device="cuda")
+    finished = torch.tensor([False] * len(prompt_tokens), device=device)
     prompt_mask = tokens != -1
-    for cur_pos in range(min(prompt_lens), total_len):
-        logits = model.forward(tokens[:, prev_pos:cur_pos], prev_pos)
-        if temperature > 0:
+    stop_lens = [total_len] * len(prompt_tokens)
+    for cur_pos in range(first_pos, total_len):
+        pos = cur_pos - shift
+        if not packed:
+            logits = model(tokens[:, prev_pos:cur_pos], prev_pos, gather_logits)
+        elif cur_pos == first_pos:
+            logits = model.forward_packed(prompt_tokens, gather_logits)
+        else:
+            logits = model(tokens[rows, pos - 1].unsqueeze(1), cur_pos - 1, gather_logits, pos - 1)
+        if degeneration is not None:
+            offset = model.vocab_start_idx if model.vocab_parallel else 0
+            for i, token in degeneration.pop_bans():
+                if 0 <= token - offset < logits.size(-1):
+                    logits[i, token - offset] = float("-inf")
+        if model.vocab_parallel:
+            next_token = sample_sharded(logits, temperature, model.vocab_start_idx)
+        elif temperature > 0:
             next_token = sample(logits, temperature)
         else:
             next_token = logits.argmax(dim=-1)
-        next_token = torch.where(prompt_mask[:, cur_pos], tokens[:, cur_pos], next_token)
-        tokens[:, cur_pos] = next_token
-        finished |= torch.logical_and(~prompt_mask[:, cur_pos], next_token == eos_id)
+        in_prompt = prompt_mask[rows, pos]
+        next_token = torch.where(in_prompt, tokens[rows, pos], next_token)
+        tokens[rows, pos] = next_token
+        if detokenizer is not None or degeneration is not None:
+            active = (~in_prompt & ~finished & (next_token != eos_id)).tolist()
+        if degeneration is not None:
+            for i in degeneration.step(next_token.tolist(), active):
+                stop_lens[i] = min(stop_lens[i], degeneration.keep[i])
+                finished[i] = True
+        if detokenizer is not None:
+            detokenizer.step(next_token.tolist(), active)
+            for i, stopped in enumerate(detokenizer.stopped):
+                if stopped and active[i]:
+                    stop_lens[i] = int(pos[i]) + 1 - prompt_lens[i]
+            finished |= torch.tensor(detokenizer.stopped, device=device)
+        finished |= torch.logical_and(~in_prompt, next_token == eos_id)
         prev_pos = cur_pos
         if finished.all():
             break
     completion_tokens = []
     for i, toks in enumerate(tokens.tolist()):
-        toks = toks[prompt_lens[i]:prompt_lens[i]+max_new_tokens]
+        toks = toks[prompt_lens[i]:prompt_lens[i]+min(stop_lens[i], total_len - max(prompt_lens))]
         if eos_id in toks:
             toks = toks[:toks.index(eos_id)]
         completion_tokens.append(toks)
+    if detokenizer is not None:
+        detokenizer.finish()
+        if degeneration is not None:
+            for i, stopped in enumerate(degeneration.stopped):
+                if stopped and degeneration.reasons[i] == "cycle":
+                    detokenizer.truncate(i, completion_tokens[i])
     return completion_tokens
 
 
@@ -1077,76 +1419,79 @@ def api_generate():
         if isinstance(v, str) and len(v) > 50000:
             book_details[k] = v[:50000]
     
-    # Genera la struttura del libro
-    book_structure = generate_long_book(book_details)
-    
-    # Genera e umanizza i capitoli (Qwen3 post-process per capitolo)
-    for chapter in book_structure['chapters']:
-        # placeholder style_guide; si può collegare a /api/analyze_style se fornito
-        style_guide = {"vocabulary": [], "sentence_structure": [], "themes": [], "techniques": []}
-        chapter_content = write_natural_chapter(chapter, style_guide)
-        # ulteriore passaggio breve di correzione
-        chapter['content'] = qwen_humanize_and_proof(chapter_content)
-
-    # Passaggio finale sull'intero libro
-    full_text = []
-    for chapter in book_structure['chapters']:
-        full_text.append(f"# {chapter['title']}\n\n{chapter['content']}")
-    refined_book = qwen_humanize_and_proof("\n\n".join(full_text))
-
-    # Sostituisce i contenuti con la versione raffinata a livello libro, splittando per capitoli se possibile
-    # (best-effort: manteniamo contenuti capitoli se split non affidabile)
-    if refined_book and len(refined_book) > 0:
-        # salva versione completa in prima sezione
-        if book_structure['chapters']:
-            book_structure['chapters'][0]['content'] = refined_book
-
-    # Genera titolo e trama con Llama3 sul testo raffinato, poi umanizza con Qwen
-    llama_title_prompt = (
-        "Leggi il seguente libro completo e proponi un titolo potente e sintetico (max 12 parole), "
-        "in italiano, coerente con genere e tono. Restituisci solo il titolo.\n\n" + refined_book
-    )
-    llama_plot_prompt = (
-        "Leggi il seguente libro completo e genera una sinossi/trama avvincente tra 120 e 200 parole, "
-        "in italiano, senza spoiler e con focus su conflitto e temi.\n\n" + refined_book
-    )
-    raw_title = llama_generate_text(llama_title_prompt, temperature=0.5, max_new_tokens=64)
-    raw_plot = llama_generate_text(llama_plot_prompt, temperature=0.5, max_new_tokens=220)
-    human_title = qwen_humanize_and_proof(raw_title, temperature=0.6, max_new_tokens=128).strip()
-    human_plot = qwen_humanize_and_proof(raw_plot, temperature=0.6, max_new_tokens=512).strip()
-
-    if human_title:
-        book_structure['title'] = human_title
-    if human_plot:
-        book_structure['plot'] = human_plot
-
-    # SEO con Gemma
-    seo = analyze_seo_with_gemma(refined_book)
-    book_structure['seo'] = seo
-
-    # Outreach editori (via Google CSE)
-    pitch = build_professional_pitch(
-        book_structure.get('title',''),
-        book_structure.get('plot',''),
-        seo,
-    )
-    outreach = outreach_publishers(book_structure.get('title',''), pitch, [
-        "casa editrice narrativa contatti email",
-        "editori italiani invio manoscritti",
-        "publishers fiction submissions email",
-    ], attachments=[file_path, wattpad_path])
-    book_structure['outreach'] = outreach
+    with _degeneration_stats.track() as degeneration_report:
+        # Genera la struttura del libro
+        book_structure = generate_long_book(book_details)
+    
+        # Genera e umanizza i capitoli (Qwen3 post-process per capitolo)
+        contents = []
+        for chapter in book_structure['chapters']:
+            # placeholder style_guide; si può collegare a /api/analyze_style se fornito
+            style_guide = {"vocabulary": [], "sentence_structure": [], "themes": [], "techniques": []}
+            contents.append(write_natural_chapter(chapter, style_guide))
+        # ulteriore passaggio breve di correzione, tutti i capitoli a lotti
+        for chapter, content in zip(book_structure['chapters'], qwen_humanize_long(contents)):
+            chapter['content'] = content
+
+        # Passaggio finale sull'intero libro
+        full_text = []
+        for chapter in book_structure['chapters']:
+            full_text.append(f"# {chapter['title']}\n\n{chapter['content']}")
+        refined_book = qwen_humanize_and_proof("\n\n".join(full_text))
+
+        # Sostituisce i contenuti con la versione raffinata a livello libro, splittando per capitoli se possibile
+        # (best-effort: manteniamo contenuti capitoli se split non affidabile)
+        if refined_book and len(refined_book) > 0:
+            # salva versione completa in prima sezione
+            if book_structure['chapters']:
+                book_structure['chapters'][0]['content'] = refined_book
+
+        # Genera titolo e trama con Llama3 sul testo raffinato, poi umanizza con Qwen
+        llama_title_prompt = (
+            "Leggi il seguente libro completo e proponi un titolo potente e sintetico (max 12 parole), "
+            "in italiano, coerente con genere e tono. Restituisci solo il titolo.\n\n" + refined_book
+        )
+        llama_plot_prompt = (
+            "Leggi il seguente libro completo e genera una sinossi/trama avvincente tra 120 e 200 parole, "
+            "in italiano, senza spoiler e con focus su conflitto e temi.\n\n" + refined_book
+        )
+        raw_title = llama_generate_text(llama_title_prompt, temperature=0.5, max_new_tokens=64)
+        raw_plot = llama_generate_text(llama_plot_prompt, temperature=0.5, max_new_tokens=220)
+        human_title = qwen_humanize_and_proof(raw_title, temperature=0.6, max_new_tokens=128).strip()
+        human_plot = qwen_humanize_and_proof(raw_plot, temperature=0.6, max_new_tokens=512).strip()
+
+        if human_title:
+            book_structure['title'] = human_title
+        if human_plot:
+            book_structure['plot'] = human_plot
+
+        # SEO con Gemma
+        seo = analyze_seo_with_gemma(refined_book)
+        book_structure['seo'] = seo
+
+        # Outreach editori (via Google CSE)
+        pitch = build_professional_pitch(
+            book_structure.get('title',''),
+            book_structure.get('plot',''),
+            seo,
+        )
+        outreach = outreach_publishers(book_structure.get('title',''), pitch, [
+            "casa editrice narrativa contatti email",
+            "editori italiani invio manoscritti",
+            "publishers fiction submissions email",
+        ], attachments=[file_path, wattpad_path])
+        book_structure['outreach'] = outreach
 
-    # Export Wattpad (offline file pronto per upload manuale)
-    wattpad_path = wattpad_export(book_structure)
-    book_structure['wattpad_path'] = wattpad_path
+        # Export Wattpad (offline file pronto per upload manuale)
+        wattpad_path = wattpad_export(book_structure)
+        book_structure['wattpad_path'] = wattpad_path
 
-    # Salva il libro (Word)
-    file_path = save_as_word(book_structure, book_structure['title'])
+        # Salva il libro (Word)
+        file_path = save_as_word(book_structure, book_structure['title'])
 
-    # Genera copertina con Flux usando il titolo (da Llama) e contesto libro
-    cover_path = generate_cover_with_flux(book_structure.get('title',''), refined_book, book_structure.get('genre',''))
-    book_structure['cover_path'] = cover_path
+        # Genera copertina con Flux usando il titolo (da Llama) e contesto libro
+        cover_path = generate_cover_with_flux(book_structure.get('title',''), refined_book, book_structure.get('genre',''))
+        book_structure['cover_path'] = cover_path
     
     return jsonify({
         'success': True,
@@ -1155,6 +1500,9 @@ def api_generate():
         'cover_path': cover_path,
         'seo': seo,
         'outreach': outreach,
+        'degeneration': degeneration_report,
+        'model_pool': model_pool.report(),
+        'refine_cache': _refine_cache.report() if _refine_cache is not None else None,
         'book_structure': book_structure
     })
 
@@ -1336,30 +1684,90 @@ def main(
     interactive: bool = True,
     max_new_tokens: int = float('inf'),
     temperature: float = 1.0,
+    device: str = "auto",
+    parallel: str = "tensor",
+    moe_timing: bool = False,
+    expert_cache_gb: float = 0.,
+    routing_stats: str = "",
+    stream_weights_gb: float = 0.,
+    profile: str = "",
+    verify: str = "fast",
 ) -> None:
     """
     Main function to load the model and start the web interface.
+
+    With `device="cpu"` (or `"auto"` on a host without CUDA) the ranks are
+    connected over gloo and each one is pinned to its own share of the cores,
+    so the tensor-parallel layers run across sockets or machines without GPUs.
+    With `parallel="pipeline"` every rank owns a contiguous range of layers
+    instead and loads the matching `model{rank}-pp{world_size}` shard.
+    With `expert_cache_gb > 0` the routed experts stay in the memory-mapped
+    shard and at most that many GB of them are kept resident.
+    With `stream_weights_gb > 0` the whole model may exceed memory: blocks are
+    read from the shard right before use and dropped afterwards, keeping at
+    most that many GB of layer weights resident, and the prompts of
+    `input_file` are generated in batches of `max_batch_size` to amortize
+    each pass over the weights.
+    With `verify` set to "fast" the tensors this rank loads are hashed and
+    checked against the `checkpoint.manifest.json` written by `convert.py`
+    (routed experts are skipped when offloaded); "full" hashes the whole
+    shard and "off" skips the check, as does a checkpoint without manifest.
     """
     world_size = int(os.getenv("WORLD_SIZE", "1"))
     rank = int(os.getenv("RANK", "0"))
     local_rank = int(os.getenv("LOCAL_RANK", "0"))
+    local_world_size = int(os.getenv("LOCAL_WORLD_SIZE", str(world_size)))
+    if device == "auto":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
     if world_size > 1:
-        dist.init_process_group("nccl")
+        dist.init_process_group("nccl" if device == "cuda" else "gloo")
     global print
     if rank != 0:
         print = lambda *_, **__: None
-    torch.cuda.set_device(local_rank)
+    if device == "cuda":
+        torch.cuda.set_device(local_rank)
+    if device == "cpu":
+        cores = pin_cpu_rank(local_rank, local_world_size)
+        print(f"rank {rank}: pinned to {len(cores)} cores")
     torch.set_default_dtype(torch.bfloat16)
-    torch.set_num_threads(8)
     torch.manual_seed(965)
     with open(config) as f:
         args = ModelArgs(**json.load(f))
+    args.parallel_mode = parallel
+    args.expert_offload = expert_cache_gb > 0
+    MoE.record_timings = moe_timing
     print(args)
-    with torch.device("cuda"):
-        model = Transformer(args)
+    shard_tag = "pp" if parallel == "pipeline" else "mp"
+    shard_file = os.path.join(ckpt_path, f"model{rank}-{shard_tag}{world_size}.safetensors")
+    names = None
+    if args.expert_offload and stream_weights_gb <= 0:
+        names = [name for name in MappedShard(shard_file).keys() if ".experts." not in name]
+    checked = verify_checkpoint(shard_file, names, verify)
+    if checked is not None:
+        print(f"verified {checked['bytes'] / 2 ** 30:.2f} GB against the manifest in {checked['seconds']:.2f}s")
     tokenizer = AutoTokenizer.from_pretrained(ckpt_path)
-    tokenizer.decode(generate(model, [tokenizer.encode("FractalNova")], float('inf'), -1, 1.)[0])
-    load_model(model, os.path.join(ckpt_path, f"model{rank}-mp{world_size}.safetensors"))
+    if stream_weights_gb > 0:
+        args.expert_offload = False
+        model = build_streaming_model(args, shard_file, int(stream_weights_gb * 1024 ** 3), device)
+        print(f"streaming {len(model.streamer.streamed)} layers, {len(model.streamer.pinned)} resident")
+    elif args.expert_offload:
+        with torch.device(device):
+            model = Transformer(args)
+        load_dense_weights(model, shard_file)
+        ExpertCache(shard_file, args, int(expert_cache_gb * 1024 ** 3), device).attach(model)
+        # warm up only once the dense weights are loaded and the experts can be fetched
+        tokenizer.decode(generate(model, [tokenizer.encode("FractalNova")], 2, -1, 1.)[0])
+    else:
+        model, loaded = load_mapped(args, shard_file, device)
+        print(f"loaded in {loaded['total']:.2f}s (construct {loaded['construct']:.2f}s, map {loaded['map']:.2f}s, "
+              f"bind {loaded['bind']:.2f}s, buffers {loaded['buffers']:.2f}s): "
+              f"{loaded['bound']} tensors mapped ({loaded['bound_bytes'] / 2 ** 30:.2f} GB), "
+              f"{loaded['copied']} copied ({loaded['copied_bytes'] / 2 ** 30:.2f} GB)")
+        tokenizer.decode(generate(model, [tokenizer.encode("FractalNova")], 2, -1, 1.)[0])
+    telemetry = RoutingTelemetry(time_experts=moe_timing).attach(model) if routing_stats else None
+    profiler = LayerProfiler(model)
+    if profile:
+        profiler.enable()
 
     if interactive:
         # Avvia il server web
@@ -1368,12 +1776,41 @@ def main(
         with open(input_file) as f:
             prompts = [line.strip() for line in f.readlines()]
         prompt_tokens = [tokenizer.apply_chat_template([{"role": "user", "content": prompt}], add_generation_prompt=True) for prompt in prompts]
-        completion_tokens = generate(model, prompt_tokens, float('inf'), tokenizer.eos_token_id, temperature)
-        completions = tokenizer.batch_decode(completion_tokens, skip_special_tokens=True)
+        if stream_weights_gb > 0:
+            completions = []
+            for i in range(0, len(prompt_tokens), args.max_batch_size):
+                batch = prompt_tokens[i:i + args.max_batch_size]
+                n_new = int(min(max_new_tokens, args.max_seq_len - max(len(t) for t in batch)))
+                detokenizer = IncrementalDetokenizer(tokenizer, len(batch), batch)
+                detector = DegenerationDetector(len(batch), n_new, action=DEGENERATION_ACTION)
+                generate(model, batch, n_new, tokenizer.eos_token_id, temperature, detokenizer, True, detector)
+                _degeneration_stats.record("deepseek", detector)
+                completions += detokenizer.texts
+        else:
+            n_new = int(min(max_new_tokens, args.max_seq_len - max(len(t) for t in prompt_tokens)))
+            detokenizer = IncrementalDetokenizer(tokenizer, len(prompt_tokens), prompt_tokens)
+            detector = DegenerationDetector(len(prompt_tokens), n_new, action=DEGENERATION_ACTION)
+            generate(model, prompt_tokens, n_new, tokenizer.eos_token_id, temperature, detokenizer, True, detector)
+            _degeneration_stats.record("deepseek", detector)
+            completions = detokenizer.texts
         for prompt, completion in zip(prompts, completions):
             print("Prompt:", prompt)
             print("Completion:", completion)
             print()
+        for name, row in _degeneration_stats.totals.items():
+            print(f"{name}: {row['stopped']} degenerate sequences stopped, {row['tokens_saved']} tokens saved")
+        for row in moe_phase_report(model):
+            phases = ", ".join(f"{k}={v:.1f}ms" for k, v in row.items() if k not in ("layer", "overlap"))
+            print(f"{row['layer']}: {phases}, overlap={row['overlap']:.0%}")
+        if telemetry is not None:
+            print("\n".join(summarize(telemetry.snapshot())))
+            if rank == 0:
+                telemetry.save(routing_stats)
+        if profiler.enabled:
+            profiler.disable()
+            print(profiler.format_table())
+            root, ext = os.path.splitext(profile)
+            profiler.save_chrome_trace(profile if world_size == 1 else f"{root}.rank{rank}{ext}")
 
     if world_size > 1:
         dist.destroy_process_group()
@@ -1387,6 +1824,14 @@ if __name__ == "__main__":
     parser.add_argument("--interactive", action="store_true")
     parser.add_argument("--max-new-tokens", type=int, default=float('inf'))
     parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--device", type=str, choices=["auto", "cuda", "cpu"], default="auto")
+    parser.add_argument("--parallel", type=str, choices=["tensor", "pipeline"], default="tensor")
+    parser.add_argument("--moe-timing", action="store_true")
+    parser.add_argument("--expert-cache-gb", type=float, default=0.)
+    parser.add_argument("--routing-stats", type=str, default="")
+    parser.add_argument("--stream-weights-gb", type=float, default=0.)
+    parser.add_argument("--profile", type=str, default="")
+    parser.add_argument("--verify", type=str, choices=["off", "fast", "full"], default="fast")
     args = parser.parse_args()
     assert args.input_file or args.interactive, "Either input-file or interactive mode must be specified"
-    main(args.ckpt_path, args.config, args.input_file, args.interactive, args.max_new_tokens, args.temperature)
+    main(args.ckpt_path, args.config, args.input_file, args.interactive, args.max_new_tokens, args.temperature, args.device, args.parallel, args.moe_timing, args.expert_cache_gb, args.routing_stats, args.stream_weights_gb, args.profile, args.verify)
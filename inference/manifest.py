@@ -0,0 +1,331 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Literal, Optional
+
+
+MANIFEST_NAME = "checkpoint.manifest.json"
+CHUNK_BYTES = 64 << 20
+FAST_SAMPLES = 8
+
+
+def _digest(data) -> str:
+    # hashlib releases the GIL on large buffers, so digests of separate ranges run in parallel
+    return hashlib.sha256(data).hexdigest()
+
+
+def _combine(digests: Iterable[str]) -> str:
+    return hashlib.sha256("".join(digests).encode()).hexdigest()
+
+
+def _spread(n: int, k: int) -> List[int]:
+    """Indices of `k` of `n` items spread evenly, the last one included."""
+    if k <= 0 or n == 0:
+        return []
+    if n <= k:
+        return list(range(n))
+    if k == 1:
+        return [n - 1]
+    return sorted({round(i * (n - 1) / (k - 1)) for i in range(k)})
+
+
+def _ranges(path: str, chunk_bytes: int) -> Dict:
+    """Splits a file into the byte ranges that are hashed separately."""
+    size = os.path.getsize(path)
+    if path.endswith(".safetensors") and size >= 8:
+        with open(path, "rb") as f:
+            n = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(n))
+        header.pop("__metadata__", None)
+        tensors = sorted(header.items(), key=lambda kv: kv[1]["data_offsets"][0])
+        return {
+            "size": size,
+            "header": (0, 8 + n),
+            "tensors": {name: (8 + n + info["data_offsets"][0], 8 + n + info["data_offsets"][1]) for name, info in tensors},
+        }
+    return {"size": size, "chunks": [(start, min(start + chunk_bytes, size)) for start in range(0, size, chunk_bytes)]}
+
+
+class _Mapped:
+    """Read-only mapping of a file, empty files included."""
+    def __init__(self, path: str):
+        self._f = open(path, "rb")
+        size = os.fstat(self._f.fileno()).st_size
+        self.view = memoryview(mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)) if size else memoryview(b"")
+
+    def close(self) -> None:
+        obj = self.view.obj
+        self.view.release()
+        if isinstance(obj, mmap.mmap):
+            obj.close()
+        self._f.close()
+
+
+def _hash_files(root: str, rel_paths: List[str], workers: int, chunk_bytes: int,
+                only: Optional[Dict[str, Optional[Iterable[str]]]] = None) -> Dict[str, Dict]:
+    """
+    Hashes files, or selected tensors of safetensors files, over mapped ranges in parallel.
+
+    `only` maps a file to the tensors, or for other files the chunk indices,
+    to hash; files missing from it, or mapped to None, are hashed entirely.
+    """
+    layouts = {rel: _ranges(os.path.join(root, rel), chunk_bytes) for rel in rel_paths}
+    mapped = {rel: _Mapped(os.path.join(root, rel)) for rel in rel_paths}
+    jobs = []
+    for rel, layout in layouts.items():
+        if "chunks" in layout:
+            indices = range(len(layout["chunks"])) if only is None or only.get(rel) is None else \
+                [i for i in only[rel] if 0 <= i < len(layout["chunks"])]
+            jobs.extend((rel, "chunks", i, layout["chunks"][i]) for i in indices)
+            continue
+        jobs.append((rel, "header", None, layout["header"]))
+        names = layout["tensors"] if only is None or only.get(rel) is None else \
+            [n for n in only[rel] if n in layout["tensors"]]
+        jobs.extend((rel, "tensors", name, layout["tensors"][name]) for name in names)
+    # largest ranges first so the pool drains evenly
+    jobs.sort(key=lambda job: job[3][0] - job[3][1])
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            digests = list(pool.map(lambda job: _digest(mapped[job[0]].view[job[3][0]:job[3][1]]), jobs))
+    finally:
+        for m in mapped.values():
+            m.close()
+    entries = {rel: {"size": layout["size"]} for rel, layout in layouts.items()}
+    for (rel, kind, key, _), digest in zip(jobs, digests):
+        entry = entries[rel]
+        if kind == "chunks":
+            entry.setdefault("chunks", [None] * len(layouts[rel]["chunks"]))[key] = digest
+        elif kind == "header":
+            entry["header"] = digest
+        else:
+            entry.setdefault("tensors", {})[key] = digest
+    for rel, entry in entries.items():
+        if only is not None and only.get(rel) is not None:
+            continue  # partly hashed: no file digest
+        if "chunks" in layouts[rel]:
+            entry.setdefault("chunks", [])
+            entry["digest"] = _combine(entry["chunks"])
+        else:
+            tensors = entry.setdefault("tensors", {})
+            entry["digest"] = _combine([entry["header"]] + [tensors[n] for n in layouts[rel]["tensors"]])
+    return entries
+
+
+def _listed_files(root: str) -> List[str]:
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        for name in filenames:
+            if name == MANIFEST_NAME or name.startswith(".") or name.endswith(".partial"):
+                continue
+            files.append(os.path.relpath(os.path.join(dirpath, name), root))
+    return sorted(files)
+
+
+def build_manifest(root: str, workers: Optional[int] = None, chunk_bytes: int = CHUNK_BYTES) -> Dict:
+    """
+    Computes the manifest of a checkpoint directory.
+
+    Safetensors files get a digest of their header and of every tensor, so a
+    loader can verify just the tensors it reads; other files are hashed in
+    `chunk_bytes` chunks. Each range is hashed from a memory mapping by a pool
+    of threads, and the digest of a file is the SHA-256 of its range digests
+    in file order.
+
+    Args:
+        root (str): Checkpoint directory.
+        workers (int, optional): Hashing threads. Defaults to the number of CPUs.
+        chunk_bytes (int, optional): Chunk size for files other than safetensors. Defaults to 64 MiB.
+
+    Returns:
+        Dict: The manifest, with `version`, `algorithm`, `chunk_bytes` and `files`.
+    """
+    files = _hash_files(root, _listed_files(root), workers or os.cpu_count() or 1, chunk_bytes)
+    return {"version": 1, "algorithm": "sha256", "chunk_bytes": chunk_bytes, "files": files}
+
+
+def write_manifest(root: str, workers: Optional[int] = None) -> Dict:
+    """
+    Builds the manifest of `root` and saves it as `checkpoint.manifest.json` in it.
+
+    Args:
+        root (str): Checkpoint directory.
+        workers (int, optional): Hashing threads. Defaults to the number of CPUs.
+
+    Returns:
+        Dict: The manifest.
+    """
+    manifest = build_manifest(root, workers)
+    tmp = os.path.join(root, MANIFEST_NAME + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, os.path.join(root, MANIFEST_NAME))
+    return manifest
+
+
+def load_manifest(root: str) -> Optional[Dict]:
+    """
+    Reads the manifest of a checkpoint directory.
+
+    Args:
+        root (str): Checkpoint directory.
+
+    Returns:
+        Optional[Dict]: The manifest, or None when the directory has none.
+    """
+    path = os.path.join(root, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def verify(root: str, manifest: Optional[Dict] = None, mode: Literal["fast", "full"] = "full",
+           files: Optional[Iterable[str]] = None, tensors: Optional[Dict[str, Iterable[str]]] = None,
+           workers: Optional[int] = None, samples: int = FAST_SAMPLES) -> Dict:
+    """
+    Checks a checkpoint directory against its manifest.
+
+    In "full" mode every byte of the listed files is hashed. In "fast" mode
+    sizes and safetensors headers (tensor names, shapes and offsets) are
+    checked and files of at most `chunk_bytes` are hashed. Of a safetensors
+    file, the tensors named in `tensors` are hashed, or, for a file not
+    named there, `samples` tensors spread evenly over it; of a larger file,
+    `samples` chunks spread evenly over it. A truncated or zeroed download is
+    caught this way, but a single flipped byte only in "full" mode or when
+    the tensor holding it is named.
+
+    Args:
+        root (str): Checkpoint directory.
+        manifest (Dict, optional): Manifest; read from `root` when omitted.
+        mode (Literal["fast", "full"], optional): How much to hash. Defaults to "full".
+        files (Iterable[str], optional): Files to check, relative to `root`. Defaults to all.
+        tensors (Dict[str, Iterable[str]], optional): Tensors to hash per file in "fast" mode.
+        workers (int, optional): Hashing threads. Defaults to the number of CPUs.
+        samples (int, optional): Tensors or chunks sampled per file in "fast" mode. Defaults to 8.
+
+    Returns:
+        Dict: `ok`, `missing` and `changed` files, `changed_tensors` per file, `bytes` hashed and `seconds`.
+    """
+    start = time.perf_counter()
+    manifest = manifest or load_manifest(root)
+    report = {"ok": True, "missing": [], "changed": [], "changed_tensors": {}, "bytes": 0, "seconds": 0.}
+    if manifest is None:
+        report["message"] = "No manifest"
+        return report
+    expected = manifest["files"]
+    chunk_bytes = manifest.get("chunk_bytes", CHUNK_BYTES)
+    rel_paths = []
+    for rel in (files if files is not None else expected):
+        path = os.path.join(root, rel)
+        if rel not in expected:
+            continue
+        if not os.path.isfile(path):
+            report["missing"].append(rel)
+        elif os.path.getsize(path) != expected[rel]["size"]:
+            report["changed"].append(rel)
+        else:
+            rel_paths.append(rel)
+    layouts = {rel: _ranges(os.path.join(root, rel), chunk_bytes) for rel in rel_paths}
+    only = None
+    if mode != "full":
+        only = {}
+        for rel, layout in layouts.items():
+            if "tensors" in layout:
+                named = (tensors or {}).get(rel)
+                names = list(layout["tensors"])
+                only[rel] = list(named) if named is not None else [names[i] for i in _spread(len(names), samples)]
+            elif layout["size"] > chunk_bytes:
+                only[rel] = _spread(len(layout["chunks"]), samples)
+    actual = _hash_files(root, rel_paths, workers or os.cpu_count() or 1, chunk_bytes, only)
+    for rel, entry in actual.items():
+        want, layout = expected[rel], layouts[rel]
+        if only is None or rel not in only:
+            report["bytes"] += entry["size"]
+            if entry.get("digest") != want.get("digest"):
+                report["changed"].append(rel)
+            continue
+        if "chunks" in layout:
+            hashed = [i for i, d in enumerate(entry.get("chunks", [])) if d is not None]
+            report["bytes"] += sum(layout["chunks"][i][1] - layout["chunks"][i][0] for i in hashed)
+            if any(entry["chunks"][i] != want["chunks"][i] for i in hashed):
+                report["changed"].append(rel)
+            continue
+        if entry.get("header") != want.get("header"):
+            report["changed"].append(rel)
+            continue
+        hashed = entry.get("tensors", {})
+        bad = [n for n, d in hashed.items() if want["tensors"].get(n) != d]
+        report["bytes"] += sum(layout["tensors"][n][1] - layout["tensors"][n][0] for n in hashed)
+        if bad:
+            report["changed"].append(rel)
+            report["changed_tensors"][rel] = bad
+    report["ok"] = not report["missing"] and not report["changed"]
+    report["seconds"] = time.perf_counter() - start
+    return report
+
+
+def verify_checkpoint(path: str, names: Optional[Iterable[str]] = None,
+                      mode: Literal["off", "fast", "full"] = "fast") -> Optional[Dict]:
+    """
+    Verifies a shard, or a whole directory, before a loader reads it; a no-op without a manifest.
+
+    For a shard, "fast" hashes the tensors in `names`. For a directory,
+    "fast" checks sizes, safetensors headers and small files and hashes a
+    sample of the tensors and chunks of every other file; use "full" to
+    hash every tensor.
+
+    Args:
+        path (str): Safetensors shard or checkpoint directory.
+        names (Iterable[str], optional): Tensors the loader reads from the shard; in "fast" mode only
+            these are hashed. Defaults to every tensor of the shard.
+        mode (Literal["off", "fast", "full"], optional): How much to hash. Defaults to "fast".
+
+    Returns:
+        Optional[Dict]: The `verify` report, or None when nothing was checked.
+
+    Raises:
+        ValueError: If the checkpoint does not match its manifest.
+    """
+    if mode == "off":
+        return None
+    root, files, tensors = path, None, None
+    if os.path.isfile(path):
+        root, rel = os.path.split(path)
+        files = [rel]
+    manifest = load_manifest(root)
+    if manifest is None:
+        return None
+    if files is not None:
+        entry = manifest["files"].get(files[0], {})
+        tensors = {files[0]: list(names) if names is not None else list(entry.get("tensors", {}))}
+    report = verify(root, manifest, mode, files, tensors)
+    if not report["ok"]:
+        raise ValueError(f"{path} does not match {MANIFEST_NAME}: missing {report['missing']}, "
+                         f"changed {report['changed']} {report['changed_tensors'] or ''}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--path", type=str, required=True)
+    parser.add_argument("--verify", action="store_true")
+    parser.add_argument("--fast", action="store_true")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    if args.verify:
+        report = verify(args.path, mode="fast" if args.fast else "full", workers=args.workers)
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        print(json.dumps({k: v for k, v in report.items() if k not in ("bytes", "seconds")}, indent=2))
+        print(f"hashed {report['bytes'] / 2 ** 30:.1f} GB in {elapsed:.1f}s ({report['bytes'] / 2 ** 30 / elapsed:.2f} GB/s)")
+        raise SystemExit(0 if report["ok"] else 1)
+    manifest = write_manifest(args.path, args.workers)
+    total = sum(entry["size"] for entry in manifest["files"].values())
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f"{len(manifest['files'])} files, {total / 2 ** 30:.1f} GB hashed in {elapsed:.1f}s ({total / 2 ** 30 / elapsed:.2f} GB/s)")
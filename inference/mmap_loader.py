@@ -0,0 +1,188 @@
+import json
+import os
+import struct
+import time
+from typing import Dict, List, Tuple
+
+import torch
+
+from model import ModelArgs, Transformer, precompute_freqs_cis
+from weight_stream import bind_parameter
+from dequant import copy_param
+
+
+DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "F8_E4M3": torch.float8_e4m3fn, "F8_E5M2": torch.float8_e5m2,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+
+class _MappedSlice:
+    def __init__(self, tensor: torch.Tensor, dtype: str):
+        self._tensor = tensor
+        self._dtype = dtype
+
+    def get_shape(self) -> List[int]:
+        return list(self._tensor.shape)
+
+    def get_dtype(self) -> str:
+        return self._dtype
+
+    def __getitem__(self, index) -> torch.Tensor:
+        return self._tensor[index]
+
+
+class MappedShard:
+    """
+    A safetensors file mapped into memory, whose tensors are views of the mapping.
+
+    The file is mapped copy-on-write with `torch.UntypedStorage.from_file`, so
+    nothing is read until a page is first touched and the pages stay in the
+    page cache, shared with other processes mapping the same file. Tensors
+    whose offset is not a multiple of their element size cannot be viewed in
+    place and are copied out instead. The handle offers the `keys`,
+    `get_tensor` and `get_slice` methods of `safe_open`.
+
+    Attributes:
+        path (str): Path of the file.
+        header (Dict[str, Dict]): Dtype, shape and data offsets of every tensor.
+    """
+    def __init__(self, path: str):
+        """
+        Maps `path` and parses its header.
+
+        Args:
+            path (str): Path of the safetensors file.
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            n = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(n))
+        header.pop("__metadata__", None)
+        self.header: Dict[str, Dict] = header
+        self._data_start = 8 + n
+        self._storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+
+    def __enter__(self) -> "MappedShard":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+    def keys(self) -> List[str]:
+        return list(self.header)
+
+    def is_aligned(self, name: str) -> bool:
+        """Whether tensor `name` can be viewed in place."""
+        info = self.header[name]
+        return (self._data_start + info["data_offsets"][0]) % DTYPES[info["dtype"]].itemsize == 0
+
+    def get_tensor(self, name: str) -> torch.Tensor:
+        """
+        Returns tensor `name`, a view of the mapping when aligned and a copy otherwise.
+
+        Args:
+            name (str): Tensor name.
+
+        Returns:
+            torch.Tensor: The tensor, on CPU.
+        """
+        info = self.header[name]
+        dtype, shape = DTYPES[info["dtype"]], info["shape"]
+        begin, end = info["data_offsets"]
+        offset = self._data_start + begin
+        if offset % dtype.itemsize == 0:
+            stride = [1] * len(shape)
+            for i in range(len(shape) - 2, -1, -1):
+                stride[i] = stride[i + 1] * shape[i + 1]
+            return torch.empty(0, dtype=dtype).set_(self._storage, offset // dtype.itemsize, shape, stride)
+        raw = torch.empty(0, dtype=torch.uint8).set_(self._storage, offset, (end - begin,))
+        return raw.clone().view(dtype).reshape(shape)
+
+    def get_slice(self, name: str) -> _MappedSlice:
+        return _MappedSlice(self.get_tensor(name), self.header[name]["dtype"])
+
+
+def materialize_buffers(model: Transformer, args: ModelArgs, device: str) -> None:
+    """
+    Allocates on `device` the buffers of a model built on the meta device (KV caches, rotary tables).
+
+    Args:
+        model (Transformer): Model built on the meta device.
+        args (ModelArgs): Model arguments.
+        device (str): Device of the buffers.
+    """
+    for module in model.modules():
+        for name, buf in list(module._buffers.items()):
+            if buf is not None:
+                module._buffers[name] = torch.zeros(buf.shape, dtype=buf.dtype, device=device)
+    model.freqs_cis = precompute_freqs_cis(args).to(device)
+
+
+def load_mapped(args: ModelArgs, ckpt_file: str, device: str = "cpu") -> Tuple[Transformer, Dict[str, float]]:
+    """
+    Builds a `Transformer` whose weights come from a memory-mapped shard, without an up-front copy.
+
+    The model is constructed on the meta device and every parameter that
+    the shard stores on the target device with the same dtype and shape, at
+    an aligned offset, is bound to a view of the mapping; only the others are
+    materialized and filled: copied to the GPU, converted, or dequantized
+    from FP8 with `copy_param`. On CPU with a matching checkpoint the cost of
+    loading is thus paid as page faults on first use.
+
+    Args:
+        args (ModelArgs): Model arguments.
+        ckpt_file (str): Path of the rank's safetensors shard.
+        device (str, optional): Device to run on. Defaults to "cpu".
+
+    Returns:
+        Tuple[Transformer, Dict[str, float]]: The model, and the seconds spent in each phase
+        (`construct`, `map`, `bind`, `buffers`, `total`) with the number of tensors and bytes
+        bound in place and copied.
+
+    Raises:
+        KeyError: If a parameter of the model is missing from the shard.
+    """
+    stats = {}
+    start = phase = time.perf_counter()
+
+    def lap(name: str) -> None:
+        nonlocal phase
+        now = time.perf_counter()
+        stats[name] = now - phase
+        phase = now
+
+    with torch.device("meta"):
+        model = Transformer(args)
+    lap("construct")
+    shard = MappedShard(ckpt_file)
+    keys = set(shard.keys())
+    lap("map")
+    missing = [name for name, _ in model.named_parameters() if name not in keys]
+    if missing:
+        raise KeyError(f"Missing tensors in {ckpt_file}: {missing[:8]}{' ...' if len(missing) > 8 else ''}")
+    counts = {"bound": 0, "bound_bytes": 0, "copied": 0, "copied_bytes": 0}
+    target = torch.device(device)
+    with torch.no_grad():
+        for name, param in list(model.named_parameters()):
+            info = shard.header[name]
+            nbytes = param.numel() * param.element_size()
+            if target.type == "cpu" and DTYPES[info["dtype"]] == param.dtype and \
+                    list(info["shape"]) == list(param.shape) and shard.is_aligned(name):
+                bind_parameter(model, name, shard.get_tensor(name))
+                counts["bound"] += 1
+                counts["bound_bytes"] += nbytes
+                continue
+            tensor = torch.empty(param.shape, dtype=param.dtype, device=target)
+            copy_param(shard, keys, name, tensor)
+            bind_parameter(model, name, tensor)
+            counts["copied"] += 1
+            counts["copied_bytes"] += nbytes
+    lap("bind")
+    materialize_buffers(model, args, device)
+    lap("buffers")
+    stats["total"] = time.perf_counter() - start
+    stats.update(counts)
+    model.load_stats = stats
+    return model, stats
@@ -1,6 +1,7 @@
 import math
+import time
 from dataclasses import dataclass
-from typing import Tuple, Optional, Literal
+from typing import Tuple, Optional, Literal, List, Dict
 
 import torch
 from torch import nn
@@ -12,6 +13,8 @@ from kernel import act_quant, weight_dequant, fp8_gemm
 
 world_size = 1
 rank = 0
+pp_size = 1
+pp_rank = 0
 block_size = 128
 gemm_impl: Literal["bf16", "fp8"] = "bf16"
 attn_impl: Literal["naive", "absorb"] = "absorb"
@@ -50,6 +53,9 @@ class ModelArgs:
         beta_fast (int): Fast beta correction factor.
         beta_slow (int): Slow beta correction factor.
         mscale (float): Scaling factor for extended attention.
+        parallel_mode (Literal["tensor", "pipeline"]): How the layers are split across distributed processes.
+        n_micro_batches (int): Number of micro-batches kept in flight in pipeline mode.
+        expert_offload (bool): Whether routed experts are left out of the model and served by an `ExpertCache`.
     """
     max_batch_size: int = 1024
     max_seq_len: int = 2097152
@@ -82,6 +88,10 @@ class ModelArgs:
     beta_fast: int = 32
     beta_slow: int = 1
     mscale: float = 1.
+    # parallelism
+    parallel_mode: Literal["tensor", "pipeline"] = "tensor"
+    n_micro_batches: int = 4
+    expert_offload: bool = False
 
 
 class ParallelEmbedding(nn.Module):
@@ -378,14 +388,15 @@ def apply_rotary_emb(x: torch.Tensor, freqs_cis: torch.Tensor) -> torch.Tensor:
 
     Args:
         x (torch.Tensor): Input tensor with positional embeddings to be applied.
-        freqs_cis (torch.Tensor): Precomputed complex exponential values for positional embeddings.
+        freqs_cis (torch.Tensor): Precomputed complex exponential values for positional embeddings,
+            shared by the batch (seq_len, dim // 2) or per sequence (batch_size, seq_len, dim // 2).
 
     Returns:
         torch.Tensor: Tensor with rotary embeddings applied.
     """
     dtype = x.dtype
     x = torch.view_as_complex(x.float().view(*x.shape[:-1], -1, 2))
-    freqs_cis = freqs_cis.view(1, x.size(1), 1, x.size(-1))
+    freqs_cis = freqs_cis.view(-1, x.size(1), 1, x.size(-1))
     y = torch.view_as_real(x * freqs_cis).flatten(3)
     return y.to(dtype)
 
@@ -440,21 +451,75 @@ class MLA(nn.Module):
             self.register_buffer("kv_cache", torch.zeros(args.max_batch_size, args.max_seq_len, self.kv_lora_rank), persistent=False)
             self.register_buffer("pe_cache", torch.zeros(args.max_batch_size, args.max_seq_len, self.qk_rope_head_dim), persistent=False)
 
-    def forward(self, x: torch.Tensor, start_pos: int, freqs_cis: torch.Tensor, mask: Optional[torch.Tensor]):
+    def _attend(self, q: Tuple[torch.Tensor, ...], kv: Tuple[torch.Tensor, torch.Tensor], start_pos: int,
+                mask: Optional[torch.Tensor], batch_start: int, positions: Optional[torch.Tensor],
+                wkv_b: Optional[torch.Tensor]) -> torch.Tensor:
+        """
+        Writes new keys and values to the cache slots of a batch and attends over the cached positions.
+
+        Args:
+            q (Tuple[torch.Tensor, ...]): (query,) for "naive", (absorbed nope query, rope query) otherwise.
+            kv (Tuple[torch.Tensor, torch.Tensor]): (keys, values) for "naive", (normalized latent, rope key) otherwise.
+            start_pos (int): Cache position of the first query; the largest one when `positions` is given.
+            mask (Optional[torch.Tensor]): Additive mask of shape (seq_len, end_pos) or (batch_size, seq_len, end_pos).
+            batch_start (int): First cache slot used by this batch.
+            positions (Optional[torch.Tensor]): Per-sequence cache position of the first query, shape (batch_size,).
+            wkv_b (Optional[torch.Tensor]): Dequantized `wkv_b` weight, for "absorb".
+
+        Returns:
+            torch.Tensor: Attention output of shape (batch_size, seq_len, n_local_heads, v_head_dim).
+        """
+        bsz, seqlen = q[0].shape[:2]
+        end_pos = start_pos + seqlen
+        b0, b1 = batch_start, batch_start + bsz
+        if positions is None:
+            rows, cols = slice(b0, b1), slice(start_pos, end_pos)
+        else:
+            rows = torch.arange(b0, b1, device=positions.device).unsqueeze(1)
+            cols = positions.unsqueeze(1) + torch.arange(seqlen, device=positions.device)
+        if attn_impl == "naive":
+            self.k_cache[rows, cols] = kv[0]
+            self.v_cache[rows, cols] = kv[1]
+            scores = torch.einsum("bshd,bthd->bsht", q[0], self.k_cache[b0:b1, :end_pos]) * self.softmax_scale
+        else:
+            self.kv_cache[rows, cols] = kv[0]
+            self.pe_cache[rows, cols] = kv[1]
+            scores = (torch.einsum("bshc,btc->bsht", q[0], self.kv_cache[b0:b1, :end_pos]) +
+                      torch.einsum("bshr,btr->bsht", q[1], self.pe_cache[b0:b1, :end_pos])) * self.softmax_scale
+        if mask is not None:
+            scores += mask.unsqueeze(1) if mask.dim() == 2 else mask.unsqueeze(2)
+        scores = scores.softmax(dim=-1, dtype=torch.float32).type_as(q[0])
+        if attn_impl == "naive":
+            return torch.einsum("bsht,bthd->bshd", scores, self.v_cache[b0:b1, :end_pos])
+        x = torch.einsum("bsht,btc->bshc", scores, self.kv_cache[b0:b1, :end_pos])
+        return torch.einsum("bshc,hdc->bshd", x, wkv_b[:, -self.v_head_dim:])
+
+    def forward(self, x: torch.Tensor, start_pos: int, freqs_cis: torch.Tensor, mask: Optional[torch.Tensor], batch_start: int = 0,
+                seq_lens: Optional[List[int]] = None, positions: Optional[torch.Tensor] = None):
         """
         Forward pass for the Multi-Head Latent Attention (MLA) Layer.
 
+        With `seq_lens`, `x` is a packed stream of shape (1, sum(seq_lens), dim)
+        holding several prompts back to back: the projections run once over
+        the stream, and each prompt is written to its own cache slot
+        (`batch_start + i`) from position 0 and attends causally to itself
+        only, i.e. a block-diagonal causal mask without computing the blocks
+        outside the diagonal.
+
         Args:
             x (torch.Tensor): Input tensor of shape (batch_size, seq_len, dim).
             start_pos (int): Starting position in the sequence for caching.
             freqs_cis (torch.Tensor): Precomputed complex exponential values for rotary embeddings.
             mask (Optional[torch.Tensor]): Mask tensor to exclude certain positions from attention.
+            batch_start (int, optional): First cache slot used by this batch. Defaults to 0.
+            seq_lens (Optional[List[int]], optional): Lengths of the packed sequences. Defaults to None.
+            positions (Optional[torch.Tensor], optional): Per-sequence starting position when the sequences
+                of the batch are at different positions; `start_pos` is then the largest. Defaults to None.
 
         Returns:
             torch.Tensor: Output tensor with the same shape as the input.
         """
         bsz, seqlen, _ = x.size()
-        end_pos = start_pos + seqlen
         if self.q_lora_rank == 0:
             q = self.wq(x)
         else:
@@ -465,31 +530,30 @@ class MLA(nn.Module):
         kv = self.wkv_a(x)
         kv, k_pe = torch.split(kv, [self.kv_lora_rank, self.qk_rope_head_dim], dim=-1)
         k_pe = apply_rotary_emb(k_pe.unsqueeze(2), freqs_cis)
+        wkv_b = None
         if attn_impl == "naive":
             q = torch.cat([q_nope, q_pe], dim=-1)
             kv = self.wkv_b(self.kv_norm(kv))
             kv = kv.view(bsz, seqlen, self.n_local_heads, self.qk_nope_head_dim + self.v_head_dim)
             k_nope, v = torch.split(kv, [self.qk_nope_head_dim, self.v_head_dim], dim=-1)
             k = torch.cat([k_nope, k_pe.expand(-1, -1, self.n_local_heads, -1)], dim=-1)
-            self.k_cache[:bsz, start_pos:end_pos] = k
-            self.v_cache[:bsz, start_pos:end_pos] = v
-            scores = torch.einsum("bshd,bthd->bsht", q, self.k_cache[:bsz, :end_pos]) * self.softmax_scale
+            qs, kvs = (q,), (k, v)
         else:
             wkv_b = self.wkv_b.weight if self.wkv_b.scale is None else weight_dequant(self.wkv_b.weight, self.wkv_b.scale, block_size) 
             wkv_b = wkv_b.view(self.n_local_heads, -1, self.kv_lora_rank)
             q_nope = torch.einsum("bshd,hdc->bshc", q_nope, wkv_b[:, :self.qk_nope_head_dim])
-            self.kv_cache[:bsz, start_pos:end_pos] = self.kv_norm(kv)
-            self.pe_cache[:bsz, start_pos:end_pos] = k_pe.squeeze(2)
-            scores = (torch.einsum("bshc,btc->bsht", q_nope, self.kv_cache[:bsz, :end_pos]) +
-                      torch.einsum("bshr,btr->bsht", q_pe, self.pe_cache[:bsz, :end_pos])) * self.softmax_scale
-        if mask is not None:
-            scores += mask.unsqueeze(1)
-        scores = scores.softmax(dim=-1, dtype=torch.float32).type_as(x)
-        if attn_impl == "naive":
-            x = torch.einsum("bsht,bthd->bshd", scores, self.v_cache[:bsz, :end_pos])
+            qs, kvs = (q_nope, q_pe), (self.kv_norm(kv), k_pe.squeeze(2))
+        if seq_lens is None:
+            x = self._attend(qs, kvs, start_pos, mask, batch_start, positions, wkv_b)
         else:
-            x = torch.einsum("bsht,btc->bshc", scores, self.kv_cache[:bsz, :end_pos])
-            x = torch.einsum("bshc,hdc->bshd", x, wkv_b[:, -self.v_head_dim:])
+            outputs, offset = [], 0
+            for i, n in enumerate(seq_lens):
+                part = slice(offset, offset + n)
+                seq_mask = torch.full((n, n), float("-inf"), device=x.device).triu_(1) if n > 1 else None
+                outputs.append(self._attend(tuple(t[:, part] for t in qs), tuple(t[:, part] for t in kvs),
+                                            0, seq_mask, batch_start + i, None, wkv_b))
+                offset += n
+            x = torch.cat(outputs, dim=1)
         x = self.wo(x.flatten(2))
         return x
 
@@ -634,6 +698,11 @@ class MoE(nn.Module):
     """
     Mixture-of-Experts (MoE) module.
 
+    The reduction of the routed-expert outputs is issued asynchronously and
+    overlapped with the shared-expert MLP. Setting `MoE.record_timings = True`
+    accumulates the wall time of each phase (gate, routed, shared and the
+    residual wait on the reduction) in `phase_times`.
+
     Attributes:
         dim (int): Dimensionality of input features.
         n_routed_experts (int): Total number of experts in the model.
@@ -642,16 +711,23 @@ class MoE(nn.Module):
         gate (nn.Module): Gating mechanism to route inputs to experts.
         experts (nn.ModuleList): List of expert modules.
         shared_experts (nn.Module): Shared experts applied to all inputs.
+        phase_times (Dict[str, float]): Accumulated seconds per phase when `record_timings` is set.
+        expert_cache (Optional[ExpertCache]): Cache serving the routed experts when they are offloaded.
+        telemetry (Optional[RoutingTelemetry]): Collector of routing statistics, if attached.
     """
-    def __init__(self, args: ModelArgs):
+    record_timings = False
+
+    def __init__(self, args: ModelArgs, layer_id: int = 0):
         """
         Initializes the MoE module.
 
         Args:
             args (ModelArgs): Model arguments containing MoE parameters.
+            layer_id (int, optional): Layer index in the transformer. Defaults to 0.
         """
         super().__init__()
         self.dim = args.dim
+        self.layer_id = layer_id
         assert args.n_routed_experts % world_size == 0, f"Number of experts must be divisible by world size (world_size={world_size})"
         self.n_routed_experts = args.n_routed_experts
         self.n_local_experts = args.n_routed_experts // world_size
@@ -659,9 +735,30 @@ class MoE(nn.Module):
         self.experts_start_idx = rank * self.n_local_experts
         self.experts_end_idx = self.experts_start_idx + self.n_local_experts
         self.gate = Gate(args)
-        self.experts = nn.ModuleList([Expert(args.dim, args.moe_inter_dim) if self.experts_start_idx <= i < self.experts_end_idx else None
+        self.experts = nn.ModuleList([Expert(args.dim, args.moe_inter_dim) if self.experts_start_idx <= i < self.experts_end_idx and not args.expert_offload else None
                                       for i in range(self.n_routed_experts)])
+        self.expert_cache = None
+        self.telemetry = None
         self.shared_experts = MLP(args.dim, args.n_shared_experts * args.moe_inter_dim)
+        self.phase_times: Dict[str, float] = {}
+
+    def _lap(self, phase: str, start: float, x: torch.Tensor) -> float:
+        """
+        Adds the time elapsed since `start` to a phase and returns the current time.
+
+        Args:
+            phase (str): Name of the phase that just ended.
+            start (float): `time.perf_counter()` value at the start of the phase.
+            x (torch.Tensor): Tensor on the device doing the work, synchronized before reading the clock.
+
+        Returns:
+            float: The current `time.perf_counter()` value.
+        """
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        now = time.perf_counter()
+        self.phase_times[phase] = self.phase_times.get(phase, 0.) + now - start
+        return now
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """
@@ -675,18 +772,40 @@ class MoE(nn.Module):
         """
         shape = x.size()
         x = x.view(-1, self.dim)
+        timed = self.record_timings
+        t = time.perf_counter() if timed else 0.
         weights, indices = self.gate(x)
+        if self.expert_cache is not None:
+            self.expert_cache.prefetch_next(self.layer_id, x)
+        if timed:
+            t = self._lap("gate", t, x)
         y = torch.zeros_like(x)
-        counts = torch.bincount(indices.flatten(), minlength=self.n_routed_experts).tolist()
+        counts = torch.bincount(indices.flatten(), minlength=self.n_routed_experts)
+        telemetry = self.telemetry
+        if telemetry is not None:
+            telemetry.record(self.layer_id, weights, indices, counts)
+        counts = counts.tolist()
         for i in range(self.experts_start_idx, self.experts_end_idx):
             if counts[i] == 0:
                 continue
-            expert = self.experts[i]
+            if telemetry is not None and telemetry.time_experts:
+                expert_start = telemetry.start_expert(x)
+            expert = self.experts[i] if self.expert_cache is None else self.expert_cache.get(self.layer_id, i)
             idx, top = torch.where(indices == i)
             y[idx] += expert(x[idx]) * weights[idx, top, None]
+            if telemetry is not None and telemetry.time_experts:
+                telemetry.end_expert(self.layer_id, i, expert_start, x)
+        if timed:
+            t = self._lap("routed", t, x)
+        # the reduction of the routed outputs runs while the shared experts compute
+        handle = dist.all_reduce(y, async_op=True) if world_size > 1 else None
         z = self.shared_experts(x)
-        if world_size > 1:
-            dist.all_reduce(y)
+        if timed:
+            t = self._lap("shared", t, x)
+        if handle is not None:
+            handle.wait()
+            if timed:
+                self._lap("reduce_wait", t, x)
         return (y + z).view(shape)
 
 
@@ -710,11 +829,12 @@ class Block(nn.Module):
         """
         super().__init__()
         self.attn = MLA(args)
-        self.ffn = MLP(args.dim, args.inter_dim) if layer_id < args.n_dense_layers else MoE(args)
+        self.ffn = MLP(args.dim, args.inter_dim) if layer_id < args.n_dense_layers else MoE(args, layer_id)
         self.attn_norm = RMSNorm(args.dim)
         self.ffn_norm = RMSNorm(args.dim)
 
-    def forward(self, x: torch.Tensor, start_pos: int, freqs_cis: torch.Tensor, mask: Optional[torch.Tensor]) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, start_pos: int, freqs_cis: torch.Tensor, mask: Optional[torch.Tensor], batch_start: int = 0,
+                seq_lens: Optional[List[int]] = None, positions: Optional[torch.Tensor] = None) -> torch.Tensor:
         """
         Forward pass for the Transformer block.
 
@@ -723,19 +843,70 @@ class Block(nn.Module):
             start_pos (int): Starting position in the sequence.
             freqs_cis (torch.Tensor): Precomputed complex exponential values for rotary embeddings.
             mask (Optional[torch.Tensor]): Mask tensor to exclude certain positions from attention.
+            batch_start (int, optional): First cache slot used by this batch. Defaults to 0.
+            seq_lens (Optional[List[int]], optional): Lengths of the sequences packed in `x`. Defaults to None.
+            positions (Optional[torch.Tensor], optional): Per-sequence starting positions. Defaults to None.
 
         Returns:
             torch.Tensor: Output tensor after block computation.
         """
-        x = x + self.attn(self.attn_norm(x), start_pos, freqs_cis, mask)
+        x = x + self.attn(self.attn_norm(x), start_pos, freqs_cis, mask, batch_start, seq_lens, positions)
         x = x + self.ffn(self.ffn_norm(x))
         return x
 
 
+def moe_phase_report(model: nn.Module) -> List[Dict[str, float]]:
+    """
+    Collects the per-layer phase timings recorded by `MoE` modules.
+
+    Args:
+        model (nn.Module): Model whose `MoE` layers ran with `MoE.record_timings` enabled.
+
+    Returns:
+        List[Dict[str, float]]: One row per MoE layer with the accumulated milliseconds of each
+        phase and `overlap`, the share of the time after the routed experts spent computing the
+        shared experts rather than blocked on the reduction (1.0 means fully hidden).
+    """
+    rows = []
+    for name, module in model.named_modules():
+        if not isinstance(module, MoE) or not module.phase_times:
+            continue
+        row = {"layer": name}
+        row.update({phase: seconds * 1e3 for phase, seconds in module.phase_times.items()})
+        shared, wait = row.get("shared", 0.), row.get("reduce_wait", 0.)
+        row["overlap"] = shared / (shared + wait) if shared + wait > 0 else 1.
+        rows.append(row)
+    return rows
+
+
+def stage_layers(n_layers: int, stage: int, n_stages: int) -> Tuple[int, int]:
+    """
+    Computes the contiguous range of layers owned by a pipeline stage.
+
+    Layers are split as evenly as possible; the first `n_layers % n_stages`
+    stages own one extra layer.
+
+    Args:
+        n_layers (int): Total number of transformer layers.
+        stage (int): Index of the pipeline stage.
+        n_stages (int): Number of pipeline stages.
+
+    Returns:
+        Tuple[int, int]: The (start, end) layer indices, end exclusive.
+    """
+    per_stage, remainder = divmod(n_layers, n_stages)
+    start = stage * per_stage + min(stage, remainder)
+    return start, start + per_stage + (1 if stage < remainder else 0)
+
+
 class Transformer(nn.Module):
     """
     Transformer model with positional embeddings, multiple layers, and output projection.
 
+    In pipeline mode each process only builds the layers returned by
+    `stage_layers` (the others are left as `None`), the embedding on the first
+    stage and the norm and head on the last one.
+
     Attributes:
         max_seq_len (int): Maximum sequence length for the transformer.
         embed (nn.Module): Embedding layer for input tokens.
@@ -751,46 +922,162 @@ class Transformer(nn.Module):
         Args:
             args (ModelArgs): Model arguments containing transformer parameters.
         """
-        global world_size, rank
-        world_size = dist.get_world_size() if dist.is_initialized() else 1
-        rank = dist.get_rank() if dist.is_initialized() else 0
+        global world_size, rank, pp_size, pp_rank
+        if args.parallel_mode == "pipeline":
+            world_size, rank = 1, 0
+            pp_size = dist.get_world_size() if dist.is_initialized() else 1
+            pp_rank = dist.get_rank() if dist.is_initialized() else 0
+        else:
+            world_size = dist.get_world_size() if dist.is_initialized() else 1
+            rank = dist.get_rank() if dist.is_initialized() else 0
+            pp_size, pp_rank = 1, 0
         Linear.dtype = torch.float8_e4m3fn if args.dtype == "fp8" else torch.bfloat16
         super().__init__()
         self.max_seq_len = args.max_seq_len
-        self.embed = ParallelEmbedding(args.vocab_size, args.dim)
+        self.dim = args.dim
+        self.vocab_size = args.vocab_size
+        self.vocab_parallel = world_size > 1
+        self.vocab_start_idx = rank * (args.vocab_size // world_size)
+        self.n_micro_batches = args.n_micro_batches
+        self.is_first_stage = pp_rank == 0
+        self.is_last_stage = pp_rank == pp_size - 1
+        self.layer_start, self.layer_end = stage_layers(args.n_layers, pp_rank, pp_size)
+        self.embed = ParallelEmbedding(args.vocab_size, args.dim) if self.is_first_stage else None
         self.layers = torch.nn.ModuleList()
         for layer_id in range(args.n_layers):
-            self.layers.append(Block(layer_id, args))
-        self.norm = RMSNorm(args.dim)
-        self.head = ColumnParallelLinear(args.dim, args.vocab_size, dtype=torch.get_default_dtype())
+            self.layers.append(Block(layer_id, args) if self.layer_start <= layer_id < self.layer_end else None)
+        self.norm = RMSNorm(args.dim) if self.is_last_stage else None
+        self.head = ColumnParallelLinear(args.dim, args.vocab_size, dtype=torch.get_default_dtype()) if self.is_last_stage else None
         self.register_buffer("freqs_cis", precompute_freqs_cis(args), persistent=False)
 
+    def _gather(self, logits: torch.Tensor, gather_logits: bool) -> torch.Tensor:
+        if world_size > 1 and gather_logits:
+            all_logits = [torch.empty_like(logits) for _ in range(world_size)]
+            dist.all_gather(all_logits, logits)
+            logits = torch.cat(all_logits, dim=-1)
+        return logits
+
     @torch.inference_mode()
-    def forward(self, tokens: torch.Tensor, start_pos: int = 0):
+    def forward(self, tokens: torch.Tensor, start_pos: int = 0, gather_logits: bool = True, positions: Optional[torch.Tensor] = None):
         """
         Forward pass for the Transformer model.
 
         Args:
             tokens (torch.Tensor): Input tensor of token IDs with shape (batch_size, seq_len).
             start_pos (int, optional): Starting position in the sequence for rotary embeddings. Defaults to 0.
+            gather_logits (bool, optional): Whether to all-gather the vocabulary shards of every rank.
+                When False, each rank returns only the logits of its own shard, starting at
+                `vocab_start_idx`. Defaults to True.
+            positions (Optional[torch.Tensor], optional): Starting position of every sequence, of shape
+                (batch_size,), when the sequences are at different positions (e.g. after `forward_packed`);
+                `start_pos` must then be the largest of them. Defaults to None.
 
         Returns:
-            torch.Tensor: Logits tensor of shape (batch_size, vocab_size).
+            torch.Tensor: Logits tensor of shape (batch_size, vocab_size), or
+            (batch_size, vocab_size // world_size) when `gather_logits` is False.
         """
         seqlen = tokens.size(1)
-        h = self.embed(tokens)
-        freqs_cis = self.freqs_cis[start_pos:start_pos+seqlen]
         mask = None
-        if seqlen > 1:
-            mask = torch.full((seqlen, seqlen), float("-inf"), device=tokens.device).triu_(1)
+        if positions is None:
+            freqs_cis = self.freqs_cis[start_pos:start_pos+seqlen]
+            if seqlen > 1:
+                mask = torch.full((seqlen, seqlen), float("-inf"), device=tokens.device).triu_(1)
+        else:
+            query_pos = positions.unsqueeze(1) + torch.arange(seqlen, device=tokens.device)
+            freqs_cis = self.freqs_cis[query_pos]
+            key_pos = torch.arange(start_pos + seqlen, device=tokens.device)
+            mask = torch.zeros(query_pos.size(0), seqlen, key_pos.size(0), device=tokens.device)
+            mask.masked_fill_(key_pos > query_pos.unsqueeze(-1), float("-inf"))
+        if pp_size > 1:
+            return self.pipeline_forward(tokens, start_pos, freqs_cis, mask, positions)
+        h = self.embed(tokens)
         for layer in self.layers:
-            h = layer(h, start_pos, freqs_cis, mask)
+            h = layer(h, start_pos, freqs_cis, mask, 0, None, positions)
         h = self.norm(h)[:, -1]
         logits = self.head(h)
-        if world_size > 1:
-            all_logits = [torch.empty_like(logits) for _ in range(world_size)]
-            dist.all_gather(all_logits, logits)
-            logits = torch.cat(all_logits, dim=-1)
+        return self._gather(logits, gather_logits)
+
+    @torch.inference_mode()
+    def forward_packed(self, prompt_tokens: List[List[int]], gather_logits: bool = True) -> torch.Tensor:
+        """
+        Prefills several prompts of different lengths without padding.
+
+        The prompts are concatenated into a single stream, so the embedding,
+        projections and feed-forward layers only see real tokens. Rotary
+        positions restart at 0 for every prompt, prompt `i` is cached in slot
+        `i`, and attention is causal within each prompt. Afterwards the
+        sequences continue with `forward(..., positions=...)`.
+
+        Args:
+            prompt_tokens (List[List[int]]): Token ids of every prompt.
+            gather_logits (bool, optional): Whether to all-gather the vocabulary shards. Defaults to True.
+
+        Returns:
+            torch.Tensor: Logits of the last token of every prompt, of shape (n_prompts, vocab_size).
+        """
+        assert pp_size == 1, "packed prefill is not supported in pipeline mode"
+        device = self.freqs_cis.device
+        seq_lens = [len(t) for t in prompt_tokens]
+        tokens = torch.tensor([t for seq in prompt_tokens for t in seq], dtype=torch.long, device=device).unsqueeze(0)
+        positions = torch.cat([torch.arange(n, device=device) for n in seq_lens])
+        freqs_cis = self.freqs_cis[positions]
+        h = self.embed(tokens)
+        for layer in self.layers:
+            h = layer(h, 0, freqs_cis, None, 0, seq_lens)
+        last = torch.tensor(seq_lens, device=device).cumsum(0) - 1
+        h = self.norm(h)[0, last]
+        logits = self.head(h)
+        return self._gather(logits, gather_logits)
+
+    def pipeline_forward(self, tokens: torch.Tensor, start_pos: int, freqs_cis: torch.Tensor, mask: Optional[torch.Tensor],
+                         positions: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        Forward pass of one pipeline stage.
+
+        The batch is split into micro-batches. Each stage receives the hidden
+        states of a micro-batch from the previous stage, runs its own layers and
+        hands them to the next stage with a non-blocking send, so that stage `i`
+        works on micro-batch `m + 1` while stage `i + 1` works on micro-batch `m`.
+        The last stage computes the logits and broadcasts them to every stage.
+
+        Args:
+            tokens (torch.Tensor): Input tensor of token IDs with shape (batch_size, seq_len).
+            start_pos (int): Starting position in the sequence for rotary embeddings.
+            freqs_cis (torch.Tensor): Rotary embeddings for the positions being processed.
+            mask (Optional[torch.Tensor]): Causal mask for the positions being processed.
+            positions (Optional[torch.Tensor], optional): Per-sequence starting positions. Defaults to None.
+
+        Returns:
+            torch.Tensor: Logits tensor of shape (batch_size, vocab_size).
+        """
+        bsz, seqlen = tokens.size()
+        n_micro = max(min(self.n_micro_batches, bsz), 1)
+        bounds = [(bsz * i // n_micro, bsz * (i + 1) // n_micro) for i in range(n_micro)]
+        layers = self.layers[self.layer_start:self.layer_end]
+        pending, outputs = [], []
+        for b0, b1 in bounds:
+            if self.is_first_stage:
+                h = self.embed(tokens[b0:b1])
+            else:
+                h = torch.empty(b1 - b0, seqlen, self.dim, dtype=torch.get_default_dtype(), device=tokens.device)
+                dist.recv(h, src=pp_rank - 1)
+            if positions is None:
+                for layer in layers:
+                    h = layer(h, start_pos, freqs_cis, mask, b0)
+            else:
+                for layer in layers:
+                    h = layer(h, start_pos, freqs_cis[b0:b1], mask[b0:b1], b0, None, positions[b0:b1])
+            if self.is_last_stage:
+                outputs.append(self.head(self.norm(h)[:, -1]))
+            else:
+                pending.append((dist.isend(h, dst=pp_rank + 1), h))
+        for req, _ in pending:
+            req.wait()
+        if self.is_last_stage:
+            logits = torch.cat(outputs)
+        else:
+            logits = torch.empty(bsz, self.vocab_size, dtype=torch.get_default_dtype(), device=tokens.device)
+        dist.broadcast(logits, src=pp_size - 1)
         return logits
 
 
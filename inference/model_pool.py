@@ -0,0 +1,323 @@
+import gc
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import torch
+from torch import nn
+
+
+_MISSING = object()
+
+
+def object_bytes(obj: Any) -> int:
+    """
+    Estimates the memory held by a loaded model object.
+
+    Counts the parameters and buffers of `nn.Module`s, recursing into tuples,
+    lists, dicts and objects exposing `components` (diffusers pipelines), plus
+    what attached helpers exposing `memory_bytes()` report, such as the static
+    KV caches of a `StaticGenerator`.
+
+    Args:
+        obj (Any): Loaded object, e.g. `(model, tokenizer)`.
+
+    Returns:
+        int: Number of bytes.
+    """
+    if isinstance(obj, nn.Module):
+        tensors = list(obj.parameters()) + list(obj.buffers())
+        extra = sum(object_bytes(v) for v in vars(obj).values() if hasattr(v, "memory_bytes"))
+        return sum(t.numel() * t.element_size() for t in tensors if t.device.type != "meta") + extra
+    if isinstance(obj, (tuple, list)):
+        return sum(object_bytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(object_bytes(o) for o in obj.values())
+    if callable(getattr(obj, "memory_bytes", None)):
+        return obj.memory_bytes()
+    components = getattr(obj, "components", None)
+    if isinstance(components, dict):
+        return object_bytes(components)
+    return 0
+
+
+class _Entry:
+    __slots__ = ("key", "loader", "pinned", "on_unload", "value", "nbytes", "load_seconds", "loads", "hits", "in_use", "loading")
+
+    def __init__(self, key: str, loader: Callable[[], Any], pinned: bool, on_unload: Optional[Callable[[], None]]):
+        self.key = key
+        self.loader = loader
+        self.pinned = pinned
+        self.on_unload = on_unload
+        self.value = _MISSING
+        self.nbytes = 0
+        self.load_seconds = 0.
+        self.loads = 0
+        self.hits = 0
+        self.in_use = 0
+        self.loading: Optional[Future] = None
+
+
+class ModelPool:
+    """
+    Owns every lazily loaded model of the process under one memory budget.
+
+    Models are registered by key with a loader and fetched by key or by role
+    alias (several roles may share one model). The first request of a model
+    loads it; concurrent requests wait for that same load instead of starting
+    their own. Resident models are kept in LRU order and, when the budget is
+    exceeded, the least recently used ones that are neither pinned nor in use
+    are dropped.
+
+    Attributes:
+        budget_bytes (int): Maximum resident bytes; 0 disables eviction.
+        aliases (Dict[str, str]): Model key of every role.
+        evictions (int): Number of models dropped to respect the budget.
+    """
+    def __init__(self, budget_bytes: int = 0):
+        """
+        Initializes an empty pool.
+
+        Args:
+            budget_bytes (int, optional): Maximum resident bytes; 0 disables eviction. Defaults to 0.
+        """
+        self.budget_bytes = budget_bytes
+        self.aliases: Dict[str, str] = {}
+        self.evictions = 0
+        self._entries: Dict[str, _Entry] = {}
+        self._lru: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, key: str, loader: Callable[[], Any], pinned: bool = False,
+                 on_unload: Optional[Callable[[], None]] = None) -> str:
+        """
+        Declares a model; registering an existing key again is a no-op.
+
+        Args:
+            key (str): Model key.
+            loader (Callable[[], Any]): Loads the model and returns it (e.g. `(model, tokenizer)`).
+            pinned (bool, optional): Never evict this model. Defaults to False.
+            on_unload (Callable[[], None], optional): Called after the model is evicted or released,
+                e.g. to free resources held for it elsewhere. Defaults to none.
+
+        Returns:
+            str: The key.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = _Entry(key, loader, pinned, on_unload)
+        return key
+
+    def alias(self, role: str, key: str) -> None:
+        """
+        Makes `role` resolve to the model `key`.
+
+        Args:
+            role (str): Role name, e.g. "seo".
+            key (str): Registered model key.
+        """
+        self.aliases[role] = key
+
+    def pin(self, name: str, pinned: bool = True) -> None:
+        """
+        Pins or unpins a model by key or role.
+
+        Args:
+            name (str): Model key or role.
+            pinned (bool, optional): New state. Defaults to True.
+        """
+        self._entries[self.resolve(name)].pinned = pinned
+
+    def resolve(self, name: str) -> str:
+        """
+        Returns the model key of a role, following chained aliases.
+
+        Args:
+            name (str): Model key or role.
+
+        Returns:
+            str: Model key.
+        """
+        seen = set()
+        while name in self.aliases and name not in seen:
+            seen.add(name)
+            name = self.aliases[name]
+        return name
+
+    @property
+    def resident_bytes(self) -> int:
+        """Bytes of the models currently loaded."""
+        return sum(self._entries[key].nbytes for key in self._lru)
+
+    def _evict(self, need: int, keep: str) -> List[_Entry]:
+        dropped = []
+        if not self.budget_bytes:
+            return dropped
+        resident = self.resident_bytes
+        for key in list(self._lru):
+            if resident + need <= self.budget_bytes:
+                break
+            entry = self._entries[key]
+            if key == keep or entry.pinned or entry.in_use:
+                continue
+            del self._lru[key]
+            resident -= entry.nbytes
+            entry.value = _MISSING
+            self.evictions += 1
+            dropped.append(entry)
+        return dropped
+
+    @staticmethod
+    def _release_memory(dropped: List[_Entry]) -> None:
+        for entry in dropped:
+            if entry.on_unload is not None:
+                # a failing hook must not keep the others from running nor the memory from being freed
+                try:
+                    entry.on_unload()
+                except Exception as e:
+                    print(f"model pool: unload hook of {entry.key} failed ({e})")
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _acquire(self, name: str, hold: bool) -> Any:
+        key = self.resolve(name)
+        with self._lock:
+            entry = self._entries[key]
+            if entry.value is not _MISSING:
+                entry.hits += 1
+                entry.in_use += hold
+                self._lru.move_to_end(key)
+                return entry.value
+            owner = entry.loading is None
+            if owner:
+                entry.loading = Future()
+                # make room up front when the size is known from an earlier load
+                dropped = self._evict(entry.nbytes, key)
+            future = entry.loading
+        if not owner:
+            value = future.result()
+            with self._lock:
+                entry.hits += 1
+                entry.in_use += hold
+            return value
+        start = time.perf_counter()
+        try:
+            if dropped:
+                self._release_memory(dropped)
+            value = entry.loader()
+        except BaseException as e:
+            with self._lock:
+                entry.loading = None
+            future.set_exception(e)
+            raise
+        with self._lock:
+            entry.value = value
+            entry.nbytes = object_bytes(value)
+            entry.load_seconds = time.perf_counter() - start
+            entry.loads += 1
+            entry.in_use += hold
+            entry.loading = None
+            self._lru[key] = None
+            dropped = self._evict(0, key)
+        future.set_result(value)
+        if dropped:
+            self._release_memory(dropped)
+        return value
+
+    def get(self, name: str) -> Any:
+        """
+        Returns a model, loading it if needed.
+
+        The pool does not track how long the caller keeps the object, so it may
+        be evicted while still referenced; prefer `use` around a generation.
+
+        Args:
+            name (str): Model key or role.
+
+        Returns:
+            Any: The loaded object.
+        """
+        return self._acquire(name, hold=False)
+
+    @contextmanager
+    def use(self, name: str, default: Any = _MISSING) -> Iterator[Any]:
+        """
+        Yields a model and protects it from eviction until the block exits.
+
+        Args:
+            name (str): Model key or role.
+            default (Any, optional): Yielded instead of raising when loading fails; nothing is
+                cached, so the next call tries again.
+        """
+        try:
+            value = self._acquire(name, hold=True)
+        except Exception:
+            if default is _MISSING:
+                raise
+            yield default
+            return
+        try:
+            yield value
+        finally:
+            with self._lock:
+                self._entries[self.resolve(name)].in_use -= 1
+
+    def release(self, name: str) -> None:
+        """
+        Drops a model now, unless it is in use.
+
+        Args:
+            name (str): Model key or role.
+        """
+        key = self.resolve(name)
+        with self._lock:
+            entry = self._entries[key]
+            if key not in self._lru or entry.in_use:
+                return
+            del self._lru[key]
+            entry.value = _MISSING
+        self._release_memory([entry])
+
+    def report(self) -> List[Dict]:
+        """
+        Describes every registered model.
+
+        Returns:
+            List[Dict]: Key, roles, residency, bytes, last load time, loads, hits, pin and use state.
+        """
+        with self._lock:
+            rows = []
+            for key, entry in self._entries.items():
+                rows.append({
+                    "key": key,
+                    "roles": sorted(r for r in self.aliases if self.resolve(r) == key),
+                    "resident": key in self._lru,
+                    "bytes": entry.nbytes if key in self._lru else 0,
+                    "load_seconds": round(entry.load_seconds, 3),
+                    "loads": entry.loads,
+                    "hits": entry.hits,
+                    "pinned": entry.pinned,
+                    "in_use": entry.in_use,
+                })
+        return rows
+
+    def format_report(self) -> str:
+        """
+        Formats `report()` as text.
+
+        Returns:
+            str: One line per model plus the resident total.
+        """
+        lines = []
+        for r in self.report():
+            state = "resident" if r["resident"] else "unloaded"
+            roles = ",".join(r["roles"]) or "-"
+            lines.append(f"{r['key']} [{roles}] {state} {r['bytes'] / 2 ** 30:.2f} GB, "
+                         f"load {r['load_seconds']:.1f}s x{r['loads']}, hits {r['hits']}{' pinned' if r['pinned'] else ''}")
+        budget = f"{self.budget_bytes / 2 ** 30:.1f} GB" if self.budget_bytes else "unlimited"
+        lines.append(f"resident {self.resident_bytes / 2 ** 30:.2f} GB / {budget}, evictions {self.evictions}")
+        return "\n".join(lines)
@@ -6,6 +6,7 @@ from .generate import (
     generate_long_book,
     write_natural_chapter,
     qwen_humanize_and_proof,
+    qwen_humanize_long,
     save_as_word,
     analyze_seo_with_gemma,
     build_professional_pitch,
@@ -13,7 +14,9 @@ from .generate import (
     wattpad_export,
     llama_generate_text,
     generate_cover_with_flux,
+    model_pool,
 )
+from .manifest import MANIFEST_NAME, load_manifest, write_manifest
 
 
 class FractalNova:
@@ -63,6 +66,13 @@ class FractalNova:
                     token=token,
                     revision=revision_overrides.get(env_key) or None,
                 )
+                # digest the fresh snapshot so later starts can detect corrupted or altered weights
+                write_manifest(local_dir)
+            elif os.getenv("CHECKPOINT_VERIFY", "fast") != "off" and load_manifest(local_dir) is None:
+                # what is on disk now may already be damaged, so it is not taken as the reference;
+                # the loaders verify the snapshots that have a manifest
+                print(f"{local_dir}: no {MANIFEST_NAME}, weights will not be verified "
+                      f"(check them, then run `python inference/manifest.py --path {local_dir}`)")
             os.environ[env_key] = local_dir
 
     def run(self, book_details: Dict) -> Dict:
@@ -70,10 +80,12 @@ class FractalNova:
         book_structure = generate_long_book(book_details)
 
         # 2) generazione e umanizzazione capitoli
+        contents = []
         for chapter in book_structure['chapters']:
             style_guide = {"vocabulary": [], "sentence_structure": [], "themes": [], "techniques": []}
-            chapter_content = write_natural_chapter(chapter, style_guide)
-            chapter['content'] = qwen_humanize_and_proof(chapter_content)
+            contents.append(write_natural_chapter(chapter, style_guide))
+        for chapter, content in zip(book_structure['chapters'], qwen_humanize_long(contents)):
+            chapter['content'] = content
 
         # 3) passaggio finale su tutto il libro
         full_text = []
@@ -133,6 +145,7 @@ class FractalNova:
             "cover_path": cover_path,
             "seo": seo,
             "outreach": outreach,
+            "model_pool": model_pool.report(),
         }
 
 
@@ -0,0 +1,311 @@
+import json
+from argparse import ArgumentParser
+from dataclasses import dataclass, fields, replace
+from typing import Dict, List, Literal
+
+
+block_size = 128  # mirrors `model.block_size`, kept here so that planning does not need triton
+BF16_BYTES = 2
+FP32_BYTES = 4
+
+
+@dataclass
+class PlanArgs:
+    """
+    The shape arguments of the model that memory and compute depend on.
+
+    Mirrors the matching fields and defaults of `model.ModelArgs`, so that
+    configs can be planned without importing the model.
+    """
+    max_batch_size: int = 1024
+    max_seq_len: int = 2097152
+    dtype: Literal["bf16", "fp8"] = "bf16"
+    vocab_size: int = 102400
+    dim: int = 2048
+    inter_dim: int = 10944
+    moe_inter_dim: int = 1408
+    n_layers: int = 27
+    n_dense_layers: int = 1
+    n_heads: int = 16
+    n_routed_experts: int = 64
+    n_shared_experts: int = 2
+    n_activated_experts: int = 6
+    q_lora_rank: int = 0
+    kv_lora_rank: int = 512
+    qk_nope_head_dim: int = 128
+    qk_rope_head_dim: int = 64
+    v_head_dim: int = 128
+
+
+def load_args(config: str, **overrides) -> PlanArgs:
+    """
+    Reads a config JSON into `PlanArgs`, ignoring keys the planner does not use.
+
+    Keys set to null in the file fall back to the `ModelArgs` defaults, and
+    non-None `overrides` take precedence over the file.
+
+    Args:
+        config (str): Path of the JSON config.
+        **overrides: Values replacing those of the file.
+
+    Returns:
+        PlanArgs: The model arguments.
+    """
+    with open(config, encoding="utf-8") as f:
+        data = json.load(f)
+    known = {field.name for field in fields(PlanArgs)}
+    values = {k: v for k, v in data.items() if k in known and v is not None}
+    values.update({k: v for k, v in overrides.items() if v is not None})
+    return PlanArgs(**values)
+
+
+def linear_bytes(in_features: int, out_features: int, dtype: str) -> int:
+    """
+    Returns the bytes of a `Linear` weight, including FP8 block scales.
+
+    Args:
+        in_features (int): Number of input features.
+        out_features (int): Number of output features.
+        dtype (str): "bf16" or "fp8".
+
+    Returns:
+        int: Number of bytes.
+    """
+    if dtype == "fp8":
+        scales = -(-in_features // block_size) * -(-out_features // block_size)
+        return in_features * out_features + scales * FP32_BYTES
+    return in_features * out_features * BF16_BYTES
+
+
+def param_bytes(args: PlanArgs, world_size: int) -> Dict[str, int]:
+    """
+    Computes the parameter bytes held by one tensor-parallel rank.
+
+    Args:
+        args (PlanArgs): Model arguments.
+        world_size (int): Number of tensor-parallel ranks.
+
+    Returns:
+        Dict[str, int]: Bytes of the embedding, attention, dense MLPs, MoE layers, head and total.
+    """
+    dt = args.dtype
+    qk_head_dim = args.qk_nope_head_dim + args.qk_rope_head_dim
+    if args.q_lora_rank == 0:
+        attn = linear_bytes(args.dim, args.n_heads * qk_head_dim // world_size, dt)
+    else:
+        attn = (linear_bytes(args.dim, args.q_lora_rank, dt) + args.q_lora_rank * BF16_BYTES +
+                linear_bytes(args.q_lora_rank, args.n_heads * qk_head_dim // world_size, dt))
+    attn += linear_bytes(args.dim, args.kv_lora_rank + args.qk_rope_head_dim, dt) + args.kv_lora_rank * BF16_BYTES
+    attn += linear_bytes(args.kv_lora_rank, args.n_heads * (args.qk_nope_head_dim + args.v_head_dim) // world_size, dt)
+    attn += linear_bytes(args.n_heads * args.v_head_dim // world_size, args.dim, dt)
+    norms = 2 * args.dim * BF16_BYTES
+    dense = 3 * linear_bytes(args.dim, args.inter_dim // world_size, dt)
+    expert = 3 * linear_bytes(args.dim, args.moe_inter_dim, dt)
+    shared = 3 * linear_bytes(args.dim, args.n_shared_experts * args.moe_inter_dim // world_size, dt)
+    gate = args.n_routed_experts * args.dim * BF16_BYTES + (args.n_routed_experts * BF16_BYTES if args.dim == 7168 else 0)
+    moe = gate + args.n_routed_experts // world_size * expert + shared
+    n_moe = args.n_layers - args.n_dense_layers
+    result = {
+        "embed": args.vocab_size // world_size * args.dim * BF16_BYTES,
+        "attention": args.n_layers * (attn + norms),
+        "dense_mlp": args.n_dense_layers * dense,
+        "moe": n_moe * moe,
+        "routed_experts": n_moe * args.n_routed_experts // world_size * expert,
+        "head": args.vocab_size // world_size * args.dim * BF16_BYTES + args.dim * BF16_BYTES,
+    }
+    result["total"] = result["embed"] + result["attention"] + result["dense_mlp"] + result["moe"] + result["head"]
+    return result
+
+
+def kv_cache_bytes(args: PlanArgs, world_size: int, attn_impl: str) -> int:
+    """
+    Computes the bytes of the KV cache buffers one rank allocates in `MLA.__init__`.
+
+    Args:
+        args (PlanArgs): Model arguments; `max_batch_size` and `max_seq_len` size the cache.
+        world_size (int): Number of tensor-parallel ranks.
+        attn_impl (str): "naive" or "absorb".
+
+    Returns:
+        int: Number of bytes, including the rotary table.
+    """
+    slots = args.max_batch_size * args.max_seq_len
+    if attn_impl == "naive":
+        per_slot = args.n_heads // world_size * (args.qk_nope_head_dim + args.qk_rope_head_dim + args.v_head_dim)
+    else:
+        per_slot = args.kv_lora_rank + args.qk_rope_head_dim
+    freqs_cis = args.max_seq_len * args.qk_rope_head_dim // 2 * 2 * FP32_BYTES
+    return args.n_layers * slots * per_slot * BF16_BYTES + freqs_cis
+
+
+def activation_peak_bytes(args: PlanArgs, world_size: int, attn_impl: str, batch: int, chunk: int, context: int) -> int:
+    """
+    Estimates the peak activation bytes of one prefill chunk.
+
+    The peak is the largest of the attention scores (float32 softmax plus its
+    bf16 copy) and the feed-forward intermediates, on top of the residual
+    stream and the final logits.
+
+    Args:
+        args (PlanArgs): Model arguments.
+        world_size (int): Number of tensor-parallel ranks.
+        attn_impl (str): "naive" or "absorb".
+        batch (int): Number of sequences in the chunk.
+        chunk (int): Tokens per sequence in the chunk.
+        context (int): Cached positions attended to, including the chunk.
+
+    Returns:
+        int: Number of bytes.
+    """
+    tokens = batch * chunk
+    heads = args.n_heads // world_size
+    scores = tokens * heads * context * (FP32_BYTES + BF16_BYTES)
+    if attn_impl == "absorb":
+        scores += tokens * heads * args.kv_lora_rank * BF16_BYTES * 2
+    ffn = 3 * tokens * max(args.inter_dim // world_size, args.n_shared_experts * args.moe_inter_dim // world_size,
+                           args.n_activated_experts * args.moe_inter_dim) * BF16_BYTES
+    residual = 4 * tokens * args.dim * BF16_BYTES
+    logits = batch * args.vocab_size * FP32_BYTES
+    return residual + max(scores, ffn) + logits
+
+
+def flops_per_token(args: PlanArgs, attn_impl: str, context: int) -> int:
+    """
+    Estimates the FLOPs of one token across all ranks at a given context length.
+
+    Linear layers count 2 FLOPs per active weight (the activated and shared
+    experts for MoE layers); attention adds the score and value products over
+    `context` cached positions.
+
+    Args:
+        args (PlanArgs): Model arguments.
+        attn_impl (str): "naive" or "absorb".
+        context (int): Number of positions attended to.
+
+    Returns:
+        int: Number of FLOPs.
+    """
+    qk_head_dim = args.qk_nope_head_dim + args.qk_rope_head_dim
+    if args.q_lora_rank == 0:
+        q = args.dim * args.n_heads * qk_head_dim
+    else:
+        q = args.dim * args.q_lora_rank + args.q_lora_rank * args.n_heads * qk_head_dim
+    kv_a = args.dim * (args.kv_lora_rank + args.qk_rope_head_dim)
+    wo = args.n_heads * args.v_head_dim * args.dim
+    if attn_impl == "naive":
+        kv_b = args.kv_lora_rank * args.n_heads * (args.qk_nope_head_dim + args.v_head_dim)
+        attn = 2 * (q + kv_a + kv_b + wo) + 2 * args.n_heads * context * (qk_head_dim + args.v_head_dim)
+    else:
+        absorb = args.n_heads * args.kv_lora_rank * (args.qk_nope_head_dim + args.v_head_dim)
+        attn = (2 * (q + kv_a + absorb + wo) +
+                2 * args.n_heads * context * (2 * args.kv_lora_rank + args.qk_rope_head_dim))
+    dense = 2 * 3 * args.dim * args.inter_dim
+    moe = 2 * (args.n_routed_experts * args.dim +
+               3 * args.dim * args.moe_inter_dim * (args.n_activated_experts + args.n_shared_experts))
+    head = 2 * args.dim * args.vocab_size
+    return args.n_layers * attn + args.n_dense_layers * dense + (args.n_layers - args.n_dense_layers) * moe + head
+
+
+def plan(args: PlanArgs, world_size: int, attn_impl: str, prefill_chunk: int) -> Dict:
+    """
+    Produces the memory and compute estimates of one configuration.
+
+    Args:
+        args (PlanArgs): Model arguments, including `max_batch_size` and `max_seq_len`.
+        world_size (int): Number of tensor-parallel ranks.
+        attn_impl (str): "naive" or "absorb".
+        prefill_chunk (int): Tokens per sequence fed in one prefill forward pass.
+
+    Returns:
+        Dict: Bytes per rank (parameters, KV cache, activation peak, total) and FLOPs per token.
+    """
+    params = param_bytes(args, world_size)
+    kv = kv_cache_bytes(args, world_size, attn_impl)
+    chunk = min(prefill_chunk, args.max_seq_len)
+    act = activation_peak_bytes(args, world_size, attn_impl, args.max_batch_size, chunk, chunk)
+    return {
+        "world_size": world_size,
+        "dtype": args.dtype,
+        "attn_impl": attn_impl,
+        "max_batch_size": args.max_batch_size,
+        "max_seq_len": args.max_seq_len,
+        "param_bytes": params,
+        "kv_cache_bytes": kv,
+        "activation_peak_bytes": act,
+        "total_bytes_per_rank": params["total"] + kv + act,
+        "prefill_flops_per_token": flops_per_token(args, attn_impl, chunk // 2),
+        "decode_flops_per_token": flops_per_token(args, attn_impl, args.max_seq_len),
+    }
+
+
+def recommend(args: PlanArgs, budget_bytes: int, prefill_chunk: int, world_sizes: List[int]) -> List[Dict]:
+    """
+    Lists the configurations that fit `budget_bytes` per rank, largest batch first.
+
+    For every world size, dtype and attention implementation, the largest
+    power-of-two `max_batch_size` (up to `args.max_batch_size`) that fits at
+    `args.max_seq_len` is kept.
+
+    Args:
+        args (PlanArgs): Model arguments; `max_seq_len` is kept fixed.
+        budget_bytes (int): Memory available per rank.
+        prefill_chunk (int): Tokens per sequence fed in one prefill forward pass.
+        world_sizes (List[int]): Candidate numbers of tensor-parallel ranks.
+
+    Returns:
+        List[Dict]: Plans of the fitting configurations.
+    """
+    fits = []
+    for world_size in world_sizes:
+        if args.vocab_size % world_size or args.n_routed_experts % world_size or args.n_heads % world_size:
+            continue
+        for dtype in ("bf16", "fp8"):
+            for attn_impl in ("absorb", "naive"):
+                best = None
+                batch = 1
+                while batch <= args.max_batch_size:
+                    candidate = plan(replace(args, dtype=dtype, max_batch_size=batch), world_size, attn_impl, prefill_chunk)
+                    if candidate["total_bytes_per_rank"] > budget_bytes:
+                        break
+                    best = candidate
+                    batch *= 2
+                if best is not None:
+                    fits.append(best)
+    return sorted(fits, key=lambda p: (-p["max_batch_size"], p["world_size"], p["dtype"] != "bf16"))
+
+
+def _gb(n: int) -> str:
+    return f"{n / 2 ** 30:.2f} GB"
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--config", type=str, required=True)
+    parser.add_argument("--world-size", type=int, default=1)
+    parser.add_argument("--max-batch-size", type=int, default=None)
+    parser.add_argument("--max-seq-len", type=int, default=None)
+    parser.add_argument("--dtype", type=str, choices=["bf16", "fp8"], default=None)
+    parser.add_argument("--attn-impl", type=str, choices=["naive", "absorb"], default="absorb")
+    parser.add_argument("--prefill-chunk", type=int, default=2048)
+    parser.add_argument("--budget-gb", type=float, default=0.)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+    model_args = load_args(args.config, max_batch_size=args.max_batch_size, max_seq_len=args.max_seq_len, dtype=args.dtype)
+    result = plan(model_args, args.world_size, args.attn_impl, args.prefill_chunk)
+    if args.budget_gb > 0:
+        result["recommendations"] = recommend(model_args, int(args.budget_gb * 2 ** 30), args.prefill_chunk, [1, 2, 4, 8, 16])
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(f"{args.config}: world_size={args.world_size} dtype={model_args.dtype} attn_impl={args.attn_impl} "
+              f"max_batch_size={model_args.max_batch_size} max_seq_len={model_args.max_seq_len}")
+        for name, n in result["param_bytes"].items():
+            print(f"  params/{name:<15} {_gb(n)}")
+        print(f"  kv cache              {_gb(result['kv_cache_bytes'])}")
+        print(f"  activation peak       {_gb(result['activation_peak_bytes'])} (prefill chunk {args.prefill_chunk})")
+        print(f"  total per rank        {_gb(result['total_bytes_per_rank'])}")
+        print(f"  prefill GFLOP/token   {result['prefill_flops_per_token'] / 1e9:.2f}")
+        print(f"  decode GFLOP/token    {result['decode_flops_per_token'] / 1e9:.2f}")
+        for r in result.get("recommendations", [])[:10]:
+            print(f"  fits: world_size={r['world_size']} dtype={r['dtype']} attn_impl={r['attn_impl']} "
+                  f"max_batch_size={r['max_batch_size']} -> {_gb(r['total_bytes_per_rank'])}")
@@ -0,0 +1,235 @@
+import json
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import torch
+from torch import nn
+import torch.distributed as dist
+
+from model import Transformer, Block, MLA, MLP, Gate, MoE, Expert, Linear, ParallelEmbedding
+
+
+_PROFILED_TYPES = (Block, MLA, MLP, Gate, MoE, Expert, Linear, ParallelEmbedding)
+_COLLECTIVES = ("all_reduce", "all_gather", "broadcast", "send", "recv", "isend", "irecv")
+
+
+def _tensor_bytes(output) -> int:
+    if isinstance(output, torch.Tensor):
+        return output.numel() * output.element_size()
+    if isinstance(output, (tuple, list)):
+        return sum(_tensor_bytes(o) for o in output)
+    return 0
+
+
+def _flops(module: nn.Module, inputs: tuple) -> int:
+    """
+    Estimates the FLOPs of one forward call of a leaf module.
+
+    Linear layers count 2 * tokens * in_features * out_features. MLA adds the
+    score and value products over the cached positions; the projections are
+    counted by its `Linear` children.
+    """
+    x = inputs[0] if inputs else None
+    if not isinstance(x, torch.Tensor):
+        return 0
+    if isinstance(module, Linear):
+        return 2 * (x.numel() // module.in_features) * module.in_features * module.out_features
+    if isinstance(module, MLA):
+        bsz, seqlen, _ = x.size()
+        end_pos = inputs[1] + seqlen
+        return 2 * bsz * seqlen * end_pos * module.n_local_heads * (module.qk_head_dim + module.v_head_dim)
+    return 0
+
+
+class LayerProfiler:
+    """
+    Records per-module wall time, FLOPs and memory of a `Transformer`, and exports them.
+
+    While enabled, forward hooks on the blocks, attention, gate, experts,
+    linear layers and embedding emit one event per call, tagged with the
+    current step and its phase (prefill when more than one token is fed,
+    decode otherwise); packed prefill through `forward_packed` is recorded
+    as a prefill step too. Collectives issued through `torch.distributed` are
+    recorded as events of their own. `disable()` removes every hook, so a
+    disabled profiler costs nothing.
+
+    Attributes:
+        events (List[Dict]): Recorded events, in Chrome trace format.
+        enabled (bool): Whether hooks are currently installed.
+    """
+    def __init__(self, model: Transformer):
+        """
+        Initializes a disabled profiler for `model`.
+
+        Args:
+            model (Transformer): Model to profile.
+        """
+        self.model = model
+        self.events: List[Dict] = []
+        self.enabled = False
+        self.step = 0
+        self.phase = "decode"
+        self._handles = []
+        self._stack = []
+        self._originals = {}
+        self._pid = dist.get_rank() if dist.is_initialized() else 0
+        self._origin = time.perf_counter()
+
+    def __enter__(self) -> "LayerProfiler":
+        self.enable()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.disable()
+
+    def _now(self, device: Optional[torch.device] = None) -> float:
+        if device is not None and device.type == "cuda":
+            torch.cuda.synchronize(device)
+        return (time.perf_counter() - self._origin) * 1e6
+
+    def _push(self, name: str, cat: str, flops: int, device: Optional[torch.device]) -> None:
+        mem = torch.cuda.memory_allocated(device) if device is not None and device.type == "cuda" else 0
+        self._stack.append({"name": name, "cat": cat, "flops": flops, "child_flops": 0, "mem": mem, "ts": self._now(device)})
+
+    def _pop(self, output, device: Optional[torch.device]) -> None:
+        end = self._now(device)
+        frame = self._stack.pop()
+        flops = frame["flops"] + frame["child_flops"]
+        if self._stack:
+            self._stack[-1]["child_flops"] += flops
+        alloc = torch.cuda.memory_allocated(device) - frame["mem"] if device is not None and device.type == "cuda" else 0
+        self.events.append({
+            "name": frame["name"], "cat": frame["cat"], "ph": "X", "pid": self._pid, "tid": 0,
+            "ts": frame["ts"], "dur": end - frame["ts"],
+            "args": {"step": self.step, "phase": self.phase, "flops": flops,
+                     "out_bytes": _tensor_bytes(output), "alloc_bytes": alloc},
+        })
+
+    def _wrap_collective(self, name: str, fn):
+        def wrapped(tensor, *args, **kwargs):
+            tensors = tensor if isinstance(tensor, list) else [tensor]
+            device = tensors[0].device if tensors and isinstance(tensors[0], torch.Tensor) else None
+            self._push(name, "comm", 0, device)
+            result = fn(tensor, *args, **kwargs)
+            self._pop(tensor, device)
+            return result
+        return wrapped
+
+    def enable(self) -> None:
+        """Installs the hooks and starts recording."""
+        if self.enabled:
+            return
+        self.enabled = True
+
+        def step_pre(module, inputs):
+            tokens = inputs[0]
+            self.phase = "prefill" if tokens.size(1) > 1 else "decode"
+            self._push(f"step {self.step}", "step", 0, tokens.device)
+
+        def step_post(module, inputs, output):
+            self._pop(output, output.device)
+            self.step += 1
+
+        self._handles.append(self.model.register_forward_pre_hook(step_pre))
+        self._handles.append(self.model.register_forward_hook(step_post))
+
+        # packed prefill calls `forward_packed` directly, bypassing the module hooks above
+        forward_packed = self.model.forward_packed
+
+        def packed(prompt_tokens, *args, **kwargs):
+            self.phase = "prefill"
+            self._push(f"step {self.step}", "step", 0, self.model.freqs_cis.device)
+            output = forward_packed(prompt_tokens, *args, **kwargs)
+            step_post(self.model, (), output)
+            return output
+
+        self.model.forward_packed = packed
+        for name, module in self.model.named_modules():
+            if not isinstance(module, _PROFILED_TYPES):
+                continue
+            cat = "head" if name == "head" else type(module).__name__
+
+            def pre(module, inputs, name=name, cat=cat):
+                x = inputs[0] if inputs else None
+                self._push(name, cat, _flops(module, inputs), x.device if isinstance(x, torch.Tensor) else None)
+
+            def post(module, inputs, output):
+                self._pop(output, output.device if isinstance(output, torch.Tensor) else None)
+
+            self._handles.append(module.register_forward_pre_hook(pre))
+            self._handles.append(module.register_forward_hook(post))
+        for name in _COLLECTIVES:
+            self._originals[name] = getattr(dist, name)
+            setattr(dist, name, self._wrap_collective(name, self._originals[name]))
+
+    def disable(self) -> None:
+        """Removes the hooks; recorded events are kept."""
+        if not self.enabled:
+            return
+        for handle in self._handles:
+            handle.remove()
+        self._handles.clear()
+        self.model.__dict__.pop("forward_packed", None)
+        for name, fn in self._originals.items():
+            setattr(dist, name, fn)
+        self._originals.clear()
+        self._stack.clear()
+        self.enabled = False
+
+    def reset(self) -> None:
+        """Clears the recorded events."""
+        self.events.clear()
+        self.step = 0
+
+    def save_chrome_trace(self, path: str) -> None:
+        """
+        Writes the events as a Chrome trace, viewable in chrome://tracing or Perfetto.
+
+        Args:
+            path (str): Output path.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+    def table(self) -> List[Dict]:
+        """
+        Aggregates the events by module type and phase.
+
+        Times and FLOPs are inclusive: a `Block` row contains its attention and
+        feed-forward children, and `step` rows cover whole forward passes.
+
+        Returns:
+            List[Dict]: One row per (category, phase) with calls, total and mean
+            milliseconds, GFLOPs, achieved GFLOP/s and output megabytes, slowest first.
+        """
+        rows = defaultdict(lambda: {"calls": 0, "ms": 0., "flops": 0, "out_bytes": 0, "alloc_bytes": 0})
+        for event in self.events:
+            row = rows[(event["cat"], event["args"]["phase"])]
+            row["calls"] += 1
+            row["ms"] += event["dur"] / 1e3
+            row["flops"] += event["args"]["flops"]
+            row["out_bytes"] += event["args"]["out_bytes"]
+            row["alloc_bytes"] += event["args"]["alloc_bytes"]
+        result = []
+        for (cat, phase), row in rows.items():
+            result.append({
+                "module": cat, "phase": phase, "calls": row["calls"], "total_ms": row["ms"],
+                "mean_ms": row["ms"] / row["calls"], "gflops": row["flops"] / 1e9,
+                "gflop_per_s": row["flops"] / 1e6 / row["ms"] if row["ms"] else 0.,
+                "out_mb": row["out_bytes"] / 2 ** 20, "alloc_mb": row["alloc_bytes"] / 2 ** 20,
+            })
+        return sorted(result, key=lambda r: -r["total_ms"])
+
+    def format_table(self) -> str:
+        """
+        Formats `table()` as text.
+
+        Returns:
+            str: The aggregated table.
+        """
+        lines = [f"{'module':<20} {'phase':<8} {'calls':>7} {'total ms':>10} {'mean ms':>9} {'GFLOP':>9} {'GFLOP/s':>9} {'out MB':>8}"]
+        for r in self.table():
+            lines.append(f"{r['module']:<20} {r['phase']:<8} {r['calls']:>7} {r['total_ms']:>10.2f} {r['mean_ms']:>9.3f} "
+                         f"{r['gflops']:>9.2f} {r['gflop_per_s']:>9.1f} {r['out_mb']:>8.1f}")
+        return "\n".join(lines)
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+def text_digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class RefineCache:
+    """
+    Content-addressed cache of rewritten paragraphs.
+
+    An entry maps the digest of (paragraph, context, model, prompt, sampling
+    parameters) to the rewrite of the paragraph, so a rerun after an edit
+    only sends the paragraphs that changed, and those right after them whose
+    context changed, to the model. Every rewrite is
+    also stored as its own result: a paragraph that already went through a
+    pass is found in the cache when the same pass sees it again, and the
+    repeat is skipped. Entries are evicted least recently used first. With a
+    `path`, new entries are appended to it as JSON lines by `save`, so a save
+    costs only what changed; the file is compacted when it is loaded with
+    far more lines than live entries.
+
+    Attributes:
+        path (str): JSON lines file the cache is loaded from and appended to; empty keeps it in memory only.
+        max_entries (int): Entries kept before the least recently used are dropped.
+        hits (int): Lookups answered from the cache.
+        misses (int): Lookups that had to go to the model.
+    """
+    def __init__(self, path: str = "", max_entries: int = 100000):
+        """
+        Loads the cache saved in `path`, if any.
+
+        Args:
+            path (str, optional): JSON lines file backing the cache. Defaults to none.
+            max_entries (int, optional): Maximum number of entries. Defaults to 100000.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending: Dict[str, str] = {}
+        if path and os.path.exists(path):
+            lines = 0
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        key, value = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line of an interrupted save
+                    self._entries[key] = value
+                    self._entries.move_to_end(key)
+                    lines += 1
+            while len(self._entries) > max_entries:
+                self._entries.popitem(last=False)
+            if lines > 2 * len(self._entries):
+                self._rewrite()
+
+    @staticmethod
+    def key(text: str, model: str, prompt: str, params: Dict, context: str = "") -> str:
+        """
+        Digest identifying the rewrite of `text` after `context` by `model` with `prompt` and sampling `params`.
+
+        Args:
+            text (str): Paragraph.
+            model (str): Model name or path.
+            prompt (str): Instructions given to the model.
+            params (Dict): Sampling parameters, e.g. temperature and max_new_tokens.
+            context (str, optional): Read-only text shown to the model before `text`. Defaults to none.
+
+        Returns:
+            str: Hex digest.
+        """
+        return text_digest(json.dumps([text_digest(text), text_digest(context), model, text_digest(prompt), params],
+                                      sort_keys=True))
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if self.path:
+                self._pending[key] = value
+
+    def _rewrite(self) -> None:
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for item in self._entries.items():
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path)
+
+    def save(self) -> None:
+        """Appends the entries added since the last save to `path`."""
+        with self._lock:
+            if not self._pending:
+                return
+            with open(self.path, "a", encoding="utf-8") as f:
+                for item in self._pending.items():
+                    f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            self._pending.clear()
+
+    def report(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,198 @@
+import math
+import os
+import re
+import shutil
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from glob import glob
+from tqdm import tqdm
+
+import torch
+from safetensors.torch import safe_open
+
+from convert import mapping, DTYPE_SIZES, ByteBudget, ShardWriter
+from manifest import write_manifest
+
+
+split_dims = {new_key: dim for new_key, dim in mapping.values()}
+
+
+def expert_id(name):
+    """
+    Returns the index of a routed expert tensor, or None for any other tensor.
+
+    Args:
+        name (str): Converted tensor name.
+
+    Returns:
+        Optional[int]: Expert index.
+    """
+    if "experts" in name and "shared_experts" not in name:
+        return int(name.split(".")[-3])
+    return None
+
+
+def work_unit(name):
+    """
+    Groups tensors into units of work: one per layer, plus one per top-level module.
+
+    Args:
+        name (str): Converted tensor name.
+
+    Returns:
+        str: Unit name, e.g. "layers.3" or "embed".
+    """
+    parts = name.split(".")
+    return ".".join(parts[:2]) if parts[0] == "layers" else parts[0]
+
+
+def find_shards(ckpt_path, source_mp=None):
+    """
+    Locates the `model{i}-mp{N}.safetensors` shards of a converted checkpoint.
+
+    Args:
+        ckpt_path (str): Directory of the converted checkpoint.
+        source_mp (int, optional): Model parallelism of the shards, when several are present.
+
+    Returns:
+        List[str]: Shard paths ordered by rank.
+    """
+    degrees = set()
+    for path in glob(os.path.join(ckpt_path, "model*-mp*.safetensors")):
+        match = re.search(r"-mp(\d+)\.safetensors$", path)
+        if match:
+            degrees.add(int(match.group(1)))
+    if source_mp is None:
+        assert len(degrees) == 1, f"Expected shards of one model parallelism in {ckpt_path}, found {sorted(degrees)}"
+        source_mp = degrees.pop()
+    paths = [os.path.join(ckpt_path, f"model{i}-mp{source_mp}.safetensors") for i in range(source_mp)]
+    missing = [p for p in paths if not os.path.exists(p)]
+    assert not missing, f"Missing shards: {missing}"
+    return paths
+
+
+def main(ckpt_path, save_path, mp, source_mp=None, workers=4, buffer_gb=8.):
+    """
+    Converts `model{i}-mp{N}.safetensors` shards into `model{j}-mp{M}.safetensors` shards.
+
+    Tensors split by `mapping` are re-split along the same dimension: every
+    output shard reads only the slices of the source shards it overlaps, so a
+    full tensor is never assembled. Replicated tensors are copied from the
+    first source shard and routed experts are moved to the rank that owns
+    them at the new degree. Layers are processed by `workers` threads with at
+    most `buffer_gb` of tensors in memory, written straight into the output
+    shards, and an interrupted run resumes from the layers it completed.
+    The new shards get their own `checkpoint.manifest.json`.
+
+    Args:
+        ckpt_path (str): Directory of the source shards.
+        save_path (str): Directory of the new shards.
+        mp (int): Target model parallelism.
+        source_mp (int, optional): Model parallelism of the source shards. Defaults to the one found.
+        workers (int, optional): Layers resharded in parallel. Defaults to 4.
+        buffer_gb (float, optional): Maximum GB of tensors held in memory. Defaults to 8.
+
+    Returns:
+        None
+    """
+    torch.set_num_threads(8)
+    src_paths = find_shards(ckpt_path, source_mp)
+    n_src = len(src_paths)
+
+    # plan: names, dtypes and shapes from the headers only
+    sources = {}
+    for i, path in enumerate(src_paths):
+        with safe_open(path, framework="pt", device="cpu") as f:
+            for name in f.keys():
+                if name in sources and expert_id(name) is None:
+                    continue
+                tensor_slice = f.get_slice(name)
+                sources[name] = (i, tensor_slice.get_dtype(), tensor_slice.get_shape())
+    expert_ids = [e for e in map(expert_id, sources) if e is not None]
+    n_experts = max(expert_ids) + 1 if expert_ids else 0
+    assert n_experts % mp == 0, f"{n_experts} experts cannot be split over {mp} ranks"
+
+    layouts = [{} for _ in range(mp)]
+    plans = {}
+    for name, (src, dtype, shape) in sources.items():
+        expert, dim = expert_id(name), split_dims.get(name.split(".")[-2])
+        if expert is not None:
+            targets = [expert // (n_experts // mp)]
+        else:
+            targets = list(range(mp))
+            if dim is not None:
+                shape = list(shape)
+                shape[dim] *= n_src
+                assert shape[dim] % mp == 0, f"Dimension {dim} of {name} must be divisible by {mp}"
+                shape[dim] //= mp
+        for j in targets:
+            layouts[j][name] = (dtype, list(shape))
+        nbytes = DTYPE_SIZES[dtype] * math.prod(shape)
+        plans.setdefault(work_unit(name), []).append((name, src, None if expert is not None else dim, targets, nbytes))
+
+    os.makedirs(save_path, exist_ok=True)
+    paths = [os.path.join(save_path, f"model{j}-mp{mp}.safetensors") for j in range(mp)]
+    writer = ShardWriter(paths, layouts, os.path.join(save_path, ".reshard-progress.json"))
+    budget = ByteBudget(int(buffer_gb * 2 ** 30))
+    todo = [u for u in plans if u not in writer.done]
+    if len(todo) < len(plans):
+        print(f"Resuming: {len(plans) - len(todo)} of {len(plans)} layers already resharded")
+
+    def reshard_unit(unit):
+        read_bytes = 0
+        with ExitStack() as stack:
+            files = [stack.enter_context(safe_open(p, framework="pt", device="cpu")) for p in src_paths]
+            for name, src, dim, targets, nbytes in plans[unit]:
+                if dim is None:
+                    # replicated tensor or routed expert: copied whole from the shard holding it
+                    with budget.hold(nbytes):
+                        param = files[src].get_tensor(name)
+                        for j in targets:
+                            writer.write(j, name, param)
+                    read_bytes += nbytes
+                    continue
+                src_size = files[0].get_slice(name).get_shape()[dim]
+                dst_size = src_size * n_src // mp
+                for j in targets:
+                    lo, hi = j * dst_size, (j + 1) * dst_size
+                    with budget.hold(nbytes):
+                        pieces = []
+                        for i in range(lo // src_size, (hi - 1) // src_size + 1):
+                            index = [slice(None)] * (dim + 1)
+                            index[dim] = slice(max(lo - i * src_size, 0), min(hi - i * src_size, src_size))
+                            pieces.append(files[i].get_slice(name)[tuple(index)])
+                        param = pieces[0] if len(pieces) == 1 else torch.cat(pieces, dim=dim)
+                        writer.write(j, name, param)
+                    read_bytes += nbytes
+        writer.mark_done(unit)
+        return read_bytes
+
+    start, read_bytes = time.perf_counter(), 0
+    with ThreadPoolExecutor(max_workers=workers) as pool, tqdm(total=len(todo)) as bar:
+        for future in as_completed([pool.submit(reshard_unit, u) for u in todo]):
+            read_bytes += future.result()
+            bar.set_postfix_str(f"{read_bytes / 2 ** 30 / max(time.perf_counter() - start, 1e-9):.2f} GB/s read")
+            bar.update()
+    writer.close()
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f"Resharded mp={n_src} -> mp={mp}: read {read_bytes / 2 ** 30:.1f} GB and wrote "
+          f"{writer.written_bytes / 2 ** 30:.1f} GB in {elapsed:.1f}s ({writer.written_bytes / 2 ** 30 / elapsed:.2f} GB/s)")
+
+    for file_path in glob(os.path.join(ckpt_path, "*token*")):
+        shutil.copyfile(file_path, os.path.join(save_path, os.path.basename(file_path)))
+    write_manifest(save_path)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--ckpt-path", type=str, required=True)
+    parser.add_argument("--save-path", type=str, required=True)
+    parser.add_argument("--model-parallel", type=int, required=True)
+    parser.add_argument("--source-model-parallel", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--buffer-gb", type=float, default=8.)
+    args = parser.parse_args()
+    main(args.ckpt_path, args.save_path, args.model_parallel, args.source_model_parallel,
+         args.workers, args.buffer_gb)
@@ -0,0 +1,187 @@
+import re
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Sequence, Tuple
+
+
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+")
+
+
+@dataclass
+class Chunk:
+    """
+    A run of paragraphs rewritten in one request.
+
+    Attributes:
+        text (str): Paragraphs to rewrite, joined by blank lines.
+        context (str): Paragraphs right before the chunk, given to the model as read-only context.
+        tokens (int): Tokens of `text`.
+        continues (bool): Whether the chunk starts inside the paragraph the previous chunk ends in.
+    """
+    text: str
+    context: str
+    tokens: int
+    continues: bool = False
+
+
+def split_paragraphs(text: str) -> List[str]:
+    """
+    Splits a text on blank lines, dropping empty paragraphs.
+
+    Args:
+        text (str): Text to split.
+
+    Returns:
+        List[str]: Paragraphs, stripped.
+    """
+    return [p.strip() for p in PARAGRAPH_BREAK.split(text) if p.strip()]
+
+
+def _split_oversized(paragraph: str, count_tokens: Callable[[str], int], budget: int) -> List[str]:
+    """Splits a paragraph longer than `budget` tokens on sentence ends, then on words."""
+    pieces, current = [], ""
+    for unit in SENTENCE_END.split(paragraph):
+        if count_tokens(unit) > budget:
+            words = unit.split(" ")
+            step = max(len(words) * budget // max(count_tokens(unit), 1), 1)
+            units = [" ".join(words[i:i + step]) for i in range(0, len(words), step)]
+        else:
+            units = [unit]
+        for u in units:
+            candidate = f"{current} {u}" if current else u
+            if current and count_tokens(candidate) > budget:
+                pieces.append(current)
+                candidate = u
+            current = candidate
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def split_units(text: str, count_tokens: Callable[[str], int], budget: int) -> List[Tuple[str, int, int]]:
+    """
+    Splits a text into paragraphs of at most `budget` tokens, with their token counts.
+
+    A paragraph longer than the budget is cut on sentence ends first, then on
+    words; its pieces share the index of the paragraph, so they are joined
+    back into one paragraph.
+
+    Args:
+        text (str): Text to split.
+        count_tokens (Callable[[str], int]): Token count of a string.
+        budget (int): Maximum tokens per unit.
+
+    Returns:
+        List[Tuple[str, int, int]]: Units, their tokens and the index of their paragraph, in text order.
+    """
+    units = []
+    for k, p in enumerate(split_paragraphs(text)):
+        n = count_tokens(p)
+        if n > budget:
+            units.extend((piece, count_tokens(piece), k) for piece in _split_oversized(p, count_tokens, budget))
+        else:
+            units.append((p, n, k))
+    return units
+
+
+def _join(units: Sequence[Tuple[str, int, int]]) -> str:
+    """Joins units, pieces of one paragraph by a space and paragraphs by a blank line."""
+    return stitch([u[0] for u in units], [i > 0 and u[2] == units[i - 1][2] for i, u in enumerate(units)])
+
+
+def pack_units(tokens: Sequence[int], budget: int, todo: Optional[Sequence[bool]] = None) -> List[List[int]]:
+    """
+    Packs consecutive units greedily into groups of at most `budget` tokens.
+
+    Args:
+        tokens (Sequence[int]): Tokens of every unit.
+        budget (int): Maximum tokens per group.
+        todo (Sequence[bool], optional): Units to pack; the others are left out and
+            end the group before them. Defaults to all.
+
+    Returns:
+        List[List[int]]: Indices of the units of every group, in order.
+    """
+    groups: List[List[int]] = []
+    used, last = 0, -2
+    for i, n in enumerate(tokens):
+        if todo is not None and not todo[i]:
+            continue
+        # blank-line separators cost about one token each
+        if groups and last == i - 1 and used + n + 1 <= budget:
+            groups[-1].append(i)
+            used += n + 1
+        else:
+            groups.append([i])
+            used = n
+        last = i
+    return groups
+
+
+def make_chunk(units: Sequence[Tuple[str, int, int]], group: Sequence[int], overlap: int) -> Chunk:
+    """
+    Builds the chunk of a group of units, with the `overlap` units before it as context.
+
+    Args:
+        units (Sequence[Tuple[str, int, int]]): Output of `split_units`.
+        group (Sequence[int]): Consecutive unit indices.
+        overlap (int): Units of context.
+
+    Returns:
+        Chunk: The chunk.
+    """
+    before = units[max(group[0] - overlap, 0):group[0]] if overlap > 0 else []
+    return Chunk(
+        text=_join([units[i] for i in group]),
+        context=_join(before),
+        tokens=sum(units[i][1] for i in group) + len(group) - 1,
+        continues=group[0] > 0 and units[group[0]][2] == units[group[0] - 1][2],
+    )
+
+
+def plan_chunks(text: str, count_tokens: Callable[[str], int], budget: int, overlap: int = 1) -> List[Chunk]:
+    """
+    Splits a text into chunks of whole paragraphs of at most `budget` tokens each.
+
+    Paragraphs are packed greedily in order; one longer than the budget is
+    cut on sentence ends first, and `stitch` with the chunks' `continues`
+    joins its pieces back into one paragraph. Every chunk carries the last `overlap`
+    paragraphs of the chunk before it as context, so the rewrite of its
+    opening follows on from what precedes it, while each paragraph is
+    rewritten exactly once.
+
+    Args:
+        text (str): Text to split.
+        count_tokens (Callable[[str], int]): Token count of a string.
+        budget (int): Maximum tokens per chunk.
+        overlap (int, optional): Paragraphs of context carried over from the previous chunk. Defaults to 1.
+
+    Returns:
+        List[Chunk]: Chunks in text order.
+    """
+    units = split_units(text, count_tokens, budget)
+    return [make_chunk(units, group, overlap) for group in pack_units([n for _, n, _ in units], budget)]
+
+
+def stitch(pieces: Sequence[str], continues: Optional[Sequence[bool]] = None) -> str:
+    """
+    Joins rewritten chunks back into one text, one blank line between them.
+
+    Args:
+        pieces (Sequence[str]): Rewritten chunks, or units, in text order; empty ones are skipped.
+        continues (Sequence[bool], optional): Per piece, whether it continues the paragraph the
+            piece before it ends in (`Chunk.continues`); such pieces are joined by a space.
+            Defaults to none.
+
+    Returns:
+        str: The text.
+    """
+    text = ""
+    for i, piece in enumerate(pieces):
+        piece = piece.strip()
+        if not piece:
+            continue
+        if text:
+            text += " " if continues is not None and continues[i] else "\n\n"
+        text += piece
+    return text
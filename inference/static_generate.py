@@ -0,0 +1,246 @@
+import threading
+import time
+from argparse import ArgumentParser
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import torch
+
+
+class StaticGenerator:
+    """
+    Short generations with a Hugging Face causal LM over preallocated static KV caches and a compiled decode step.
+
+    `model.generate` re-plans every step in Python and grows a dynamic cache,
+    which dominates calls of a few hundred tokens. Here prompts are assigned
+    to the smallest length bucket that holds them; every bucket owns one
+    `StaticCache` of `bucket + max_new_tokens` positions, allocated once and
+    reset between calls, so the decode step always sees the same shapes and
+    its `torch.compile`d graph is reused across calls. The prompt itself is
+    prefilled eagerly. `warmup()` compiles the step of the given buckets up
+    front; the others compile on their first call. Tokens are sampled with
+    the temperature of the call and the `top_k` and `top_p` of the model's
+    `generation_config`, as `model.generate` would. `memory_bytes()` reports
+    the memory of the caches to `ModelPool`.
+
+    One call runs at a time; `generate` returns None for a call it cannot
+    serve (prompt too long, batch, busy), and the caller falls back to
+    `model.generate`.
+
+    Attributes:
+        buckets (List[int]): Prompt length buckets, ascending.
+        max_new_tokens (int): Most tokens a call may generate.
+        calls (List[Dict[str, float]]): Prompt length, generated tokens and seconds of every call served.
+    """
+    def __init__(self, model, buckets: Sequence[int] = (128, 512, 1024), max_new_tokens: int = 512,
+                 compile: bool = True):
+        """
+        Prepares the generator; caches are allocated on first use of their bucket.
+
+        Args:
+            model: Hugging Face causal LM.
+            buckets (Sequence[int], optional): Prompt length buckets. Defaults to (128, 512, 1024).
+            max_new_tokens (int, optional): Most tokens a call may generate. Defaults to 512.
+            compile (bool, optional): Compile the decode step with `torch.compile`. Defaults to True.
+        """
+        self.model = model
+        self.buckets = sorted(buckets)
+        self.max_new_tokens = max_new_tokens
+        self.calls: List[Dict[str, float]] = []
+        self.device = next(model.parameters()).device
+        self._caches: Dict[int, Any] = {}
+        self._lock = threading.Lock()
+        self._decode = self._step
+        if compile:
+            mode = "reduce-overhead" if self.device.type == "cuda" else None
+            self._decode = torch.compile(self._step, mode=mode, dynamic=False)
+
+    def _step(self, token: torch.Tensor, position: torch.Tensor, cache) -> torch.Tensor:
+        out = self.model(input_ids=token, cache_position=position, position_ids=position.unsqueeze(0),
+                         past_key_values=cache, use_cache=True)
+        return out.logits[:, -1]
+
+    def _cache(self, bucket: int):
+        cache = self._caches.get(bucket)
+        if cache is None:
+            # imported here so that transformers releases without StaticCache (< 4.38) can still import this module
+            from transformers import StaticCache
+            cache = StaticCache(config=self.model.config, max_batch_size=1, max_cache_len=bucket + self.max_new_tokens,
+                                device=self.device, dtype=self.model.dtype)
+            self._caches[bucket] = cache
+        else:
+            cache.reset()
+        return cache
+
+    def memory_bytes(self) -> int:
+        """Bytes of the KV caches of all buckets, estimated from the model config."""
+        config = self.model.config
+        n_heads = config.num_attention_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // n_heads
+        n_kv_heads = getattr(config, "num_key_value_heads", None) or n_heads
+        per_token = 2 * config.num_hidden_layers * n_kv_heads * head_dim * self.model.dtype.itemsize
+        return sum((b + self.max_new_tokens) * per_token for b in self.buckets)
+
+    def _sample(self, logits: torch.Tensor, temperature: float) -> torch.Tensor:
+        config = getattr(self.model, "generation_config", None)
+        top_k = getattr(config, "top_k", None) or 0
+        top_p = getattr(config, "top_p", None) or 1.0
+        logits = logits.float() / max(temperature, 1e-5)
+        if 0 < top_k < logits.size(-1):
+            kth = torch.topk(logits, top_k, dim=-1).values[..., -1:]
+            logits = logits.masked_fill(logits < kth, float("-inf"))
+        if top_p < 1.0:
+            sorted_logits, order = torch.sort(logits, descending=True, dim=-1)
+            cumulative = torch.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+            # drop the tokens past top_p, always keeping the most likely one
+            drop = cumulative - torch.softmax(sorted_logits, dim=-1) >= top_p
+            logits = logits.masked_fill(drop.scatter(-1, order, drop), float("-inf"))
+        return torch.multinomial(torch.softmax(logits, dim=-1), 1)
+
+    def bucket(self, prompt_len: int) -> Optional[int]:
+        """Smallest bucket holding a prompt of `prompt_len` tokens, or None."""
+        return next((b for b in self.buckets if b >= prompt_len), None)
+
+    def generate(self, input_ids: torch.Tensor, max_new_tokens: int, temperature: float = 1.0, do_sample: bool = True,
+                 eos_token_id: Optional[Union[int, List[int]]] = None, stopping_criteria=None) -> Optional[torch.Tensor]:
+        """
+        Generates a continuation of one prompt.
+
+        Args:
+            input_ids (torch.Tensor): Prompt of shape (1, prompt_len).
+            max_new_tokens (int): Maximum tokens to generate.
+            temperature (float, optional): Sampling temperature. Defaults to 1.0.
+            do_sample (bool, optional): Sample instead of taking the most likely token. Defaults to True.
+            eos_token_id (Union[int, List[int]], optional): Tokens ending the generation.
+            stopping_criteria (optional): Called as `stopping_criteria(ids, scores)` after every token,
+                like the `StoppingCriteriaList` of `model.generate`.
+
+        Returns:
+            Optional[torch.Tensor]: Prompt and generated tokens, of shape (1, prompt_len + n), or None
+            when the call is left to `model.generate`.
+        """
+        prompt_len = input_ids.shape[-1]
+        bucket = self.bucket(prompt_len)
+        if input_ids.shape[0] != 1 or bucket is None or max_new_tokens > self.max_new_tokens:
+            return None
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            start = time.perf_counter()
+            eos = set([eos_token_id] if isinstance(eos_token_id, int) else eos_token_id or [])
+            ids = input_ids.to(self.device)
+            with torch.inference_mode():
+                # reset in inference mode too: the cache tensors may have been allocated by a forward pass in it
+                cache = self._cache(bucket)
+                position = torch.arange(prompt_len, device=self.device)
+                logits = self._step(ids, position, cache)
+                for i in range(max_new_tokens):
+                    if do_sample:
+                        token = self._sample(logits, temperature)
+                    else:
+                        token = logits.argmax(dim=-1, keepdim=True)
+                    ids = torch.cat([ids, token], dim=-1)
+                    if token.item() in eos or i == max_new_tokens - 1:
+                        break
+                    if stopping_criteria is not None and bool(torch.as_tensor(stopping_criteria(ids, logits)).all()):
+                        break
+                    position = torch.tensor([prompt_len + i], device=self.device)
+                    logits = self._decode(token, position, cache).clone()
+            self.calls.append({"prompt_len": prompt_len, "new_tokens": ids.shape[-1] - prompt_len,
+                               "seconds": time.perf_counter() - start})
+            return ids
+        finally:
+            self._lock.release()
+
+    def warmup(self, buckets: Optional[Sequence[int]] = None, n_tokens: int = 4) -> Dict[int, float]:
+        """
+        Allocates the cache and compiles the decode step of some buckets.
+
+        Args:
+            buckets (Sequence[int], optional): Buckets to warm up. Defaults to all.
+            n_tokens (int, optional): Tokens generated per bucket. Defaults to 4.
+
+        Returns:
+            Dict[int, float]: Seconds spent per bucket.
+        """
+        seconds = {}
+        for bucket in (self.buckets if buckets is None else [b for b in self.buckets if b in buckets]):
+            start = time.perf_counter()
+            self.generate(torch.zeros((1, min(8, bucket)), dtype=torch.long), min(n_tokens, self.max_new_tokens),
+                          do_sample=False)
+            seconds[bucket] = time.perf_counter() - start
+        self.calls.clear()
+        return seconds
+
+    def report(self) -> Dict[str, float]:
+        """Calls served, with mean latency per call and per generated token."""
+        tokens = sum(c["new_tokens"] for c in self.calls)
+        seconds = sum(c["seconds"] for c in self.calls)
+        return {
+            "calls": len(self.calls),
+            "ms_per_call": 1000 * seconds / max(len(self.calls), 1),
+            "ms_per_token": 1000 * seconds / max(tokens, 1),
+        }
+
+
+def benchmark(model, tokenizer, prompts: Sequence[str], max_new_tokens: int, generator: StaticGenerator) -> Dict[str, Dict]:
+    """
+    Times the same greedy generations with `model.generate` and with a `StaticGenerator`.
+
+    Args:
+        model: Hugging Face causal LM.
+        tokenizer: Its tokenizer.
+        prompts (Sequence[str]): Prompts, generated one at a time.
+        max_new_tokens (int): Tokens generated per prompt; EOS is ignored so both paths do the same work.
+        generator (StaticGenerator): Warmed-up generator of `model`.
+
+    Returns:
+        Dict[str, Dict]: Milliseconds per call and per token of the `dynamic` and `static` paths; empty
+        when the generator can serve none of the prompts.
+    """
+    if max_new_tokens > generator.max_new_tokens:
+        print(f"skipped: {max_new_tokens} new tokens exceed the generator's {generator.max_new_tokens}")
+        return {}
+    inputs = []
+    for prompt in prompts:
+        input_ids = tokenizer(prompt, return_tensors="pt").input_ids.to(generator.device)
+        if generator.bucket(input_ids.shape[-1]) is None:
+            print(f"skipped: prompt of {input_ids.shape[-1]} tokens is longer than every bucket {generator.buckets}")
+            continue
+        inputs.append(input_ids)
+    if not inputs:
+        return {}
+    results = {}
+    for path in ("dynamic", "static"):
+        seconds, tokens = 0., 0
+        for input_ids in inputs:
+            start = time.perf_counter()
+            if path == "dynamic":
+                with torch.inference_mode():
+                    out = model.generate(input_ids=input_ids, max_new_tokens=max_new_tokens,
+                                         min_new_tokens=max_new_tokens, do_sample=False,
+                                         pad_token_id=tokenizer.eos_token_id)
+            else:
+                out = generator.generate(input_ids, max_new_tokens, do_sample=False)
+            seconds += time.perf_counter() - start
+            tokens += out.shape[-1] - input_ids.shape[-1]
+        results[path] = {"ms_per_call": 1000 * seconds / len(inputs), "ms_per_token": 1000 * seconds / max(tokens, 1)}
+    return results
+
+
+if __name__ == "__main__":
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    parser = ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--prompt", type=str, action="append", default=[])
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--buckets", type=str, default="128,512,1024")
+    args = parser.parse_args()
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+    model = AutoModelForCausalLM.from_pretrained(args.model_path, torch_dtype=torch.float32)
+    generator = StaticGenerator(model, [int(b) for b in args.buckets.split(",")], args.max_new_tokens)
+    warm = generator.warmup()
+    print("warmup: " + ", ".join(f"bucket {b}: {s:.1f}s" for b, s in warm.items()))
+    prompts = args.prompt or ["Proponi un titolo per un romanzo giallo ambientato a Venezia."]
+    for path, r in benchmark(model, tokenizer, prompts, args.max_new_tokens, generator).items():
+        print(f"{path:>8}: {r['ms_per_call']:.0f} ms/call, {r['ms_per_token']:.1f} ms/token")
@@ -0,0 +1,212 @@
+import json
+import math
+import time
+from argparse import ArgumentParser
+from typing import Dict, List, Optional
+
+import torch
+from torch import nn
+
+
+class RoutingTelemetry:
+    """
+    Accumulates expert-routing statistics of the `MoE` layers of a model.
+
+    Per layer it keeps the number of tokens routed to each expert, a histogram
+    of the routing weights over [0, route_scale] (`weight_max`), the number
+    of distinct expert groups each token touches and, if `time_experts` is
+    set, the wall time spent in each local expert. Counters stay on the
+    device and are only read back by `snapshot`, so recording costs a few
+    small kernels per layer and no synchronization unless expert timing is
+    enabled.
+
+    Attributes:
+        n_bins (int): Number of bins of the routing-weight histograms.
+        time_experts (bool): Whether to time each local expert (synchronizes the device).
+        layers (Dict[int, Dict[str, torch.Tensor]]): Accumulated statistics per layer id.
+    """
+    def __init__(self, n_bins: int = 20, time_experts: bool = False):
+        """
+        Initializes an empty telemetry collector.
+
+        Args:
+            n_bins (int, optional): Number of bins of the routing-weight histograms. Defaults to 20.
+            time_experts (bool, optional): Whether to time each local expert. Defaults to False.
+        """
+        self.n_bins = n_bins
+        self.time_experts = time_experts
+        self.layers: Dict[int, Dict[str, torch.Tensor]] = {}
+        self.meta: Dict[int, Dict[str, float]] = {}
+        self.steps = 0
+
+    def attach(self, model: nn.Module) -> "RoutingTelemetry":
+        """
+        Makes every `MoE` layer of `model` report to this collector.
+
+        Args:
+            model (nn.Module): Model whose MoE layers should be instrumented.
+
+        Returns:
+            RoutingTelemetry: The collector itself.
+        """
+        from model import MoE
+        for module in model.modules():
+            if isinstance(module, MoE):
+                module.telemetry = self
+                self.meta[module.layer_id] = {
+                    "n_experts": module.n_routed_experts,
+                    "n_groups": module.gate.n_groups,
+                    "topk_groups": module.gate.topk_groups,
+                    # routing weights are scaled by route_scale after normalization, so they can exceed 1
+                    "weight_max": float(module.gate.route_scale),
+                }
+        return self
+
+    def detach(self, model: nn.Module) -> None:
+        """
+        Stops recording for every `MoE` layer of `model`.
+
+        Args:
+            model (nn.Module): Instrumented model.
+        """
+        for module in model.modules():
+            if getattr(module, "telemetry", None) is self:
+                module.telemetry = None
+
+    def _layer(self, layer_id: int, device: torch.device) -> Dict[str, torch.Tensor]:
+        stats = self.layers.get(layer_id)
+        if stats is None:
+            meta = self.meta[layer_id]
+            stats = self.layers[layer_id] = {
+                "tokens": torch.zeros(meta["n_experts"], dtype=torch.long, device=device),
+                "weight_hist": torch.zeros(self.n_bins, dtype=torch.float32, device=device),
+                "groups_per_token": torch.zeros(meta["n_groups"] + 1, dtype=torch.long, device=device),
+                "expert_seconds": torch.zeros(meta["n_experts"], dtype=torch.float64),
+            }
+        return stats
+
+    def record(self, layer_id: int, weights: torch.Tensor, indices: torch.Tensor, counts: torch.Tensor) -> None:
+        """
+        Records the routing decision of one MoE forward pass.
+
+        Args:
+            layer_id (int): Index of the transformer layer.
+            weights (torch.Tensor): Routing weights of shape (n_tokens, topk).
+            indices (torch.Tensor): Selected expert indices of shape (n_tokens, topk).
+            counts (torch.Tensor): Tokens per expert, as computed by `torch.bincount`.
+        """
+        stats = self._layer(layer_id, indices.device)
+        stats["tokens"] += counts
+        stats["weight_hist"] += torch.histc(weights.float(), bins=self.n_bins, min=0., max=self.meta[layer_id]["weight_max"])
+        n_groups = self.meta[layer_id]["n_groups"]
+        group_size = self.meta[layer_id]["n_experts"] // n_groups
+        groups = torch.zeros(indices.size(0), n_groups, dtype=torch.bool, device=indices.device)
+        groups.scatter_(1, indices // group_size, True)
+        stats["groups_per_token"] += torch.bincount(groups.sum(dim=-1), minlength=n_groups + 1)
+        if layer_id == min(self.meta):
+            self.steps += 1
+
+    def start_expert(self, x: torch.Tensor) -> float:
+        """
+        Returns a start timestamp for `end_expert`, synchronizing the device first.
+
+        Args:
+            x (torch.Tensor): Tensor on the device running the experts.
+
+        Returns:
+            float: `time.perf_counter()` value.
+        """
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        return time.perf_counter()
+
+    def end_expert(self, layer_id: int, expert_id: int, start: float, x: torch.Tensor) -> None:
+        """
+        Adds the time since `start` to an expert.
+
+        Args:
+            layer_id (int): Index of the transformer layer.
+            expert_id (int): Index of the routed expert.
+            start (float): Value returned by `start_expert`.
+            x (torch.Tensor): Tensor on the device running the experts.
+        """
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        self._layer(layer_id, x.device)["expert_seconds"][expert_id] += time.perf_counter() - start
+
+    def snapshot(self) -> Dict:
+        """
+        Returns the accumulated statistics as plain JSON-serializable data.
+
+        Returns:
+            Dict: `steps` plus, per layer, token counts, load-imbalance figures, the
+            routing-weight histogram, the distribution of groups per token and expert times.
+        """
+        layers = {}
+        for layer_id in sorted(self.layers):
+            stats = self.layers[layer_id]
+            tokens = stats["tokens"].tolist()
+            total = sum(tokens)
+            mean = total / len(tokens) if tokens else 0.
+            std = math.sqrt(sum((t - mean) ** 2 for t in tokens) / len(tokens)) if tokens else 0.
+            probs = [t / total for t in tokens if t > 0] if total else []
+            layers[str(layer_id)] = {
+                "tokens_per_expert": tokens,
+                "total_assignments": total,
+                "max_over_mean": max(tokens) / mean if mean else 0.,
+                "coeff_of_variation": std / mean if mean else 0.,
+                "normalized_entropy": -sum(p * math.log(p) for p in probs) / math.log(len(tokens)) if len(tokens) > 1 else 1.,
+                "hot_experts": sorted(range(len(tokens)), key=lambda i: -tokens[i])[:8],
+                "cold_experts": [i for i, t in enumerate(tokens) if t == 0],
+                "weight_hist": stats["weight_hist"].tolist(),
+                "groups_per_token": stats["groups_per_token"].tolist(),
+                "expert_seconds": stats["expert_seconds"].tolist(),
+                **self.meta[layer_id],
+            }
+        return {"steps": self.steps, "n_bins": self.n_bins, "layers": layers}
+
+    def save(self, path: str) -> None:
+        """
+        Writes `snapshot()` to a JSON file.
+
+        Args:
+            path (str): Output path.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def reset(self) -> None:
+        """Clears the accumulated statistics."""
+        self.layers.clear()
+        self.steps = 0
+
+
+def summarize(snapshot: Dict, top: int = 5) -> List[str]:
+    """
+    Formats a routing snapshot as a per-layer text table.
+
+    Args:
+        snapshot (Dict): Data returned by `RoutingTelemetry.snapshot` or loaded from its JSON.
+        top (int, optional): Number of hot experts to list per layer. Defaults to 5.
+
+    Returns:
+        List[str]: Lines of the table.
+    """
+    lines = [f"steps: {snapshot['steps']}",
+             f"{'layer':>5} {'tokens':>10} {'max/mean':>8} {'cv':>6} {'entropy':>7} {'cold':>5}  hot experts"]
+    for layer_id, layer in snapshot["layers"].items():
+        hot = ", ".join(f"{i}:{layer['tokens_per_expert'][i]}" for i in layer["hot_experts"][:top])
+        lines.append(f"{layer_id:>5} {layer['total_assignments']:>10} {layer['max_over_mean']:>8.2f} "
+                     f"{layer['coeff_of_variation']:>6.2f} {layer['normalized_entropy']:>7.3f} "
+                     f"{len(layer['cold_experts']):>5}  {hot}")
+    return lines
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("snapshot", type=str)
+    parser.add_argument("--top", type=int, default=5)
+    args = parser.parse_args()
+    with open(args.snapshot, encoding="utf-8") as f:
+        data = json.load(f)
+    print("\n".join(summarize(data, args.top)))
@@ -0,0 +1,160 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, List
+
+import torch
+from torch import nn
+from safetensors import safe_open
+
+from model import ModelArgs, Transformer
+from dequant import read_param
+
+
+def bind_parameter(model: nn.Module, name: str, tensor: torch.Tensor) -> None:
+    """
+    Replaces a parameter of `model` by `tensor`, keeping FP8 `weight.scale` links intact.
+
+    Args:
+        model (nn.Module): Root module.
+        name (str): Dotted parameter name, as in `state_dict()`.
+        tensor (torch.Tensor): New value of the parameter.
+    """
+    module_name, _, param_name = name.rpartition(".")
+    module = model.get_submodule(module_name) if module_name else model
+    module._parameters[param_name] = nn.Parameter(tensor, requires_grad=False)
+    if getattr(module, "scale", None) is not None:
+        module.weight.scale = module.scale
+
+
+class LayerStreamer:
+    """
+    Streams the weights of `Transformer.layers` from a memory-mapped shard.
+
+    The first layers that fit in `budget_bytes` (after reserving room for the
+    prefetch window) are loaded once and stay resident. Every other block is
+    loaded right before its forward pass and dropped back to the meta device
+    right after it, while the next `prefetch` streamed blocks are read on a
+    background thread. KV caches and other buffers are never dropped.
+
+    Attributes:
+        pinned (List[int]): Layers that stay resident.
+        streamed (List[int]): Layers loaded and dropped on every forward pass.
+        layer_bytes (Dict[int, int]): Parameter bytes of each layer.
+    """
+    def __init__(self, model: Transformer, ckpt_file: str, budget_bytes: int, device: str = "cpu", prefetch: int = 2):
+        """
+        Initializes the streamer and registers its hooks on the layers of `model`.
+
+        Args:
+            model (Transformer): Model whose layer parameters are on the meta device.
+            ckpt_file (str): Path of the rank's safetensors shard.
+            budget_bytes (int): Maximum number of bytes of resident layer weights.
+            device (str, optional): Device the weights are loaded to. Defaults to "cpu".
+            prefetch (int, optional): Number of streamed layers read ahead. Defaults to 2.
+        """
+        self.model = model
+        self.device = torch.device(device)
+        self.prefetch = prefetch
+        self._file = safe_open(ckpt_file, framework="pt", device="cpu")
+        self._keys = set(self._file.keys())
+        self._read_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="layer-prefetch")
+        self._pending: Dict[int, Future] = {}
+        layer_ids = [i for i, layer in enumerate(model.layers) if layer is not None]
+        self.layer_bytes = {
+            i: sum(p.numel() * p.element_size() for p in model.layers[i].parameters())
+            for i in layer_ids
+        }
+        window = prefetch + 1
+        largest = max(self.layer_bytes.values())
+        n_pinned = max(budget_bytes // largest - window, 0) if largest else len(layer_ids)
+        self.pinned: List[int] = layer_ids[:n_pinned]
+        self.streamed: List[int] = layer_ids[n_pinned:]
+        self.resident = set()
+        for layer_id in self.pinned:
+            self._install(layer_id, self._read(layer_id))
+        for layer_id in self.streamed:
+            layer = model.layers[layer_id]
+            layer.register_forward_pre_hook(lambda module, inputs, layer_id=layer_id: self.acquire(layer_id))
+            layer.register_forward_hook(lambda module, inputs, output, layer_id=layer_id: self.release(layer_id))
+
+    def _read(self, layer_id: int) -> Dict[str, torch.Tensor]:
+        prefix = f"layers.{layer_id}."
+        tensors = {}
+        for name, param in self.model.layers[layer_id].named_parameters():
+            with self._read_lock:
+                tensor = read_param(self._file.get_tensor, self._keys, prefix + name, param.dtype)
+            tensors[prefix + name] = tensor.to(self.device, non_blocking=True)
+        return tensors
+
+    def _install(self, layer_id: int, tensors: Dict[str, torch.Tensor]) -> None:
+        for name, tensor in tensors.items():
+            bind_parameter(self.model, name, tensor)
+        self.resident.add(layer_id)
+
+    def _drop(self, layer_id: int) -> None:
+        prefix = f"layers.{layer_id}."
+        for name, param in list(self.model.layers[layer_id].named_parameters()):
+            bind_parameter(self.model, prefix + name, torch.empty_like(param, device="meta"))
+        self.resident.discard(layer_id)
+
+    def _schedule(self, layer_id: int) -> None:
+        position = self.streamed.index(layer_id)
+        for offset in range(1, self.prefetch + 1):
+            nxt = self.streamed[(position + offset) % len(self.streamed)]
+            if nxt != layer_id and nxt not in self.resident and nxt not in self._pending:
+                self._pending[nxt] = self._pool.submit(self._read, nxt)
+
+    def acquire(self, layer_id: int) -> None:
+        """
+        Makes the weights of a streamed layer resident and schedules the next reads.
+
+        Args:
+            layer_id (int): Index of the layer about to run.
+        """
+        if layer_id not in self.resident:
+            future = self._pending.pop(layer_id, None)
+            tensors = future.result() if future is not None else self._read(layer_id)
+            self._install(layer_id, tensors)
+        self._schedule(layer_id)
+
+    def release(self, layer_id: int) -> None:
+        """
+        Drops the weights of a streamed layer after its forward pass.
+
+        Args:
+            layer_id (int): Index of the layer that just ran.
+        """
+        self._drop(layer_id)
+
+
+def build_streaming_model(args: ModelArgs, ckpt_file: str, budget_bytes: int, device: str = "cpu", prefetch: int = 2) -> Transformer:
+    """
+    Builds a `Transformer` whose layer weights are streamed from `ckpt_file`.
+
+    The model is constructed on the meta device, so no weight memory is
+    allocated up front. Buffers (KV caches, rotary tables) and the weights
+    outside `layers` are then materialized on `device`, and a `LayerStreamer`
+    takes care of the blocks.
+
+    Args:
+        args (ModelArgs): Model arguments.
+        ckpt_file (str): Path of the rank's safetensors shard.
+        budget_bytes (int): Maximum number of bytes of resident layer weights.
+        device (str, optional): Device to run on. Defaults to "cpu".
+        prefetch (int, optional): Number of streamed layers read ahead. Defaults to 2.
+
+    Returns:
+        Transformer: The model, ready for `generate`.
+    """
+    # imported here because mmap_loader imports bind_parameter from this module
+    from mmap_loader import materialize_buffers
+    with torch.device("meta"):
+        model = Transformer(args)
+    materialize_buffers(model, args, device)
+    with safe_open(ckpt_file, framework="pt", device="cpu") as f:
+        for name, _ in list(model.named_parameters()):
+            if not name.startswith("layers."):
+                bind_parameter(model, name, f.get_tensor(name).to(device))
+    model.streamer = LayerStreamer(model, ckpt_file, budget_bytes, device, prefetch)
+    return model
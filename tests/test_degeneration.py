@@ -0,0 +1,71 @@
+import random
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from degeneration import DegenerationCriteria, DegenerationDetector
+
+
+def run(detector, tokens, i=0, n=1):
+    for t in tokens:
+        row = [0] * n
+        row[i] = t
+        detector.step(row, [j == i for j in range(n)])
+
+
+def test_cycle_is_stopped_and_repeats_cut():
+    detector = DegenerationDetector(1, 256)
+    prefix = list(range(100, 140))
+    cycle = [1, 2, 3, 4, 5, 6, 7]
+    run(detector, prefix + cycle * 10)
+    assert detector.stopped == [True]
+    assert detector.reasons == ["cycle"]
+    assert len(prefix) + len(cycle) <= detector.keep[0] < len(prefix) + 3 * len(cycle)
+    assert detector.report()["tokens_saved"] == 256 - detector.keep[0]
+
+
+def test_varied_text_is_not_flagged():
+    detector = DegenerationDetector(1, 512)
+    rng = random.Random(0)
+    run(detector, [rng.randrange(5000) for _ in range(500)])
+    assert detector.stopped == [False]
+
+
+def test_low_entropy_run_is_stopped():
+    # n-grams as long as the sequence leave only the entropy check
+    detector = DegenerationDetector(1, 256, ngram=256, window=32, min_entropy=1.0)
+    rng = random.Random(0)
+    run(detector, [rng.choice((10, 11)) for _ in range(64)])
+    assert detector.reasons == ["low_entropy"]
+
+
+def test_resample_bans_the_next_cycle_token():
+    detector = DegenerationDetector(1, 256, action="resample", max_resamples=1)
+    cycle = [1, 2, 3, 4, 5]
+    for t in cycle * 6:
+        detector.step([t])
+        if detector.pop_bans():
+            break
+    else:
+        pytest.fail("no ban issued")
+    assert detector.stopped == [False]
+    run(detector, cycle * 10)
+    assert detector.stopped == [True]
+
+
+def test_criteria_skips_finished_rows_and_returns_per_row_flags():
+    eos = 0
+    detector = DegenerationDetector(2, 64)
+    criteria = DegenerationCriteria(detector, prompt_len=1, eos_token_id=eos)
+    ids = torch.zeros((2, 1), dtype=torch.long)
+    rng = random.Random(0)
+    row0 = [rng.randrange(1, 5000) for _ in range(3)] + [eos] + [eos] * 40  # EOS then padding
+    row1 = [1, 2, 3, 4] * 11
+    for a, b in zip(row0, row1):
+        ids = torch.cat([ids, torch.tensor([[a], [b]])], dim=-1)
+        done = criteria(ids, None)
+    assert done.dtype == torch.bool and done.shape == (2,)
+    assert done.tolist() == [False, True]
+    assert len(detector._states[0].tokens) == 4
@@ -0,0 +1,64 @@
+from detokenizer import IncrementalDetokenizer
+
+
+class ByteTokenizer:
+    """One token per UTF-8 byte; partial characters decode to U+FFFD like byte-fallback tokenizers."""
+    def encode(self, text):
+        return list(text.encode("utf-8"))
+
+    def decode(self, ids, skip_special_tokens=True):
+        return bytes(ids).decode("utf-8", errors="replace")
+
+
+def feed(detok, text, i=0):
+    return [detok.add(i, t) for t in ByteTokenizer().encode(text)]
+
+
+def test_multibyte_character_is_held_until_complete():
+    detok = IncrementalDetokenizer(ByteTokenizer(), 1)
+    first, second = feed(detok, "è")
+    assert first == ""
+    assert second == "è"
+    assert "\ufffd" not in detok.texts[0]
+
+
+def test_output_matches_full_decode():
+    text = "Caffè, città — 東京 🙂 fine."
+    detok = IncrementalDetokenizer(ByteTokenizer(), 1)
+    assert "".join(feed(detok, text)) == text
+    assert detok.finish() == [text]
+
+
+def test_finish_flushes_incomplete_character():
+    detok = IncrementalDetokenizer(ByteTokenizer(), 1)
+    feed(detok, "ok")
+    detok.add(0, "è".encode("utf-8")[0])
+    assert detok.texts[0] == "ok"
+    assert detok.finish() == ["ok\ufffd"]
+
+
+def test_stop_string_across_steps_is_cut_and_never_streamed():
+    streamed = []
+    detok = IncrementalDetokenizer(ByteTokenizer(), 1, stop=["END"], on_text=lambda i, t: streamed.append(t))
+    feed(detok, "abcEN")
+    assert "".join(streamed) == "abc"
+    feed(detok, "D and more")
+    assert detok.stopped[0]
+    assert detok.texts[0] == "abc"
+    assert "".join(streamed) == "abc"
+    assert detok.add(0, ord("x")) == ""
+
+
+def test_partial_stop_string_is_released_when_it_does_not_match():
+    streamed = []
+    detok = IncrementalDetokenizer(ByteTokenizer(), 1, stop=["END"], on_text=lambda i, t: streamed.append(t))
+    feed(detok, "abcEN")
+    feed(detok, "x")
+    assert not detok.stopped[0]
+    assert "".join(streamed) == "abcENx"
+
+
+def test_step_skips_inactive_sequences():
+    detok = IncrementalDetokenizer(ByteTokenizer(), 2)
+    assert detok.step([ord("a"), ord("b")], active=[True, False]) == ["a", ""]
+    assert detok.finish() == ["a", ""]
@@ -0,0 +1,109 @@
+import json
+import struct
+
+import pytest
+
+from manifest import MANIFEST_NAME, build_manifest, load_manifest, verify, verify_checkpoint, write_manifest
+
+
+def write_safetensors(path, tensors):
+    header, data = {}, b""
+    for name, payload in tensors.items():
+        header[name] = {"dtype": "U8", "shape": [len(payload)], "data_offsets": [len(data), len(data) + len(payload)]}
+        data += payload
+    raw = json.dumps(header).encode()
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(raw)) + raw + data)
+    return 8 + len(raw)
+
+
+def flip(path, offset):
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        byte = f.read(1)
+        f.seek(offset)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    data_start = write_safetensors(tmp_path / "model0-mp1.safetensors", {"a": b"\x01" * 64, "b": b"\x02" * 64})
+    (tmp_path / "config.json").write_text('{"dim": 8}')
+    write_manifest(str(tmp_path), workers=2)
+    return tmp_path, data_start
+
+
+def test_manifest_lists_files_and_tensors(checkpoint):
+    root, _ = checkpoint
+    manifest = load_manifest(str(root))
+    assert set(manifest["files"]) == {"model0-mp1.safetensors", "config.json"}
+    assert set(manifest["files"]["model0-mp1.safetensors"]["tensors"]) == {"a", "b"}
+    assert verify(str(root))["ok"]
+    assert verify(str(root), mode="fast")["ok"]
+
+
+def test_full_mode_catches_a_flipped_tensor_byte(checkpoint):
+    root, data_start = checkpoint
+    flip(root / "model0-mp1.safetensors", data_start + 70)  # inside "b"
+    report = verify(str(root), mode="full")
+    assert not report["ok"]
+    assert report["changed"] == ["model0-mp1.safetensors"]
+
+
+def test_fast_mode_on_a_directory_samples_tensors(checkpoint):
+    root, data_start = checkpoint
+    flip(root / "model0-mp1.safetensors", data_start + 10)  # inside "a"
+    report = verify(str(root), mode="fast", samples=1)  # only the last tensor, "b"
+    assert report["ok"]
+    assert report["bytes"] == len('{"dim": 8}') + 64
+    assert verify(str(root), mode="fast")["changed_tensors"] == {"model0-mp1.safetensors": ["a"]}
+
+
+def test_fast_mode_samples_chunks_of_large_files(tmp_path):
+    (tmp_path / "tokenizer.bin").write_bytes(bytes(range(100)))
+    manifest = build_manifest(str(tmp_path), chunk_bytes=16)
+    report = verify(str(tmp_path), manifest, mode="fast", samples=2)  # chunks 0 and 6 of 7
+    assert report["ok"]
+    assert report["bytes"] == 16 + 4
+    flip(tmp_path / "tokenizer.bin", 40)
+    assert verify(str(tmp_path), manifest, mode="fast", samples=2)["ok"]
+    assert not verify(str(tmp_path), manifest, mode="full")["ok"]
+    flip(tmp_path / "tokenizer.bin", 99)
+    assert verify(str(tmp_path), manifest, mode="fast", samples=2)["changed"] == ["tokenizer.bin"]
+
+
+def test_fast_mode_hashes_only_the_named_tensors(checkpoint):
+    root, data_start = checkpoint
+    flip(root / "model0-mp1.safetensors", data_start + 70)
+    shard = "model0-mp1.safetensors"
+    assert verify(str(root), mode="fast", files=[shard], tensors={shard: ["a"]})["ok"]
+    report = verify(str(root), mode="fast", files=[shard], tensors={shard: ["a", "b"]})
+    assert report["changed_tensors"] == {shard: ["b"]}
+    assert report["bytes"] == 128
+
+
+def test_fast_mode_catches_small_files_sizes_and_missing_files(checkpoint):
+    root, _ = checkpoint
+    (root / "config.json").write_text('{"dim": 9}')
+    assert verify(str(root), mode="fast")["changed"] == ["config.json"]
+    with open(root / "model0-mp1.safetensors", "ab") as f:
+        f.write(b"\x00")
+    assert "model0-mp1.safetensors" in verify(str(root), mode="fast")["changed"]
+    (root / "config.json").unlink()
+    assert verify(str(root), mode="fast")["missing"] == ["config.json"]
+
+
+def test_verify_checkpoint_raises_on_a_corrupted_shard(checkpoint):
+    root, data_start = checkpoint
+    shard = root / "model0-mp1.safetensors"
+    assert verify_checkpoint(str(shard), names=["a"])["ok"]
+    flip(shard, data_start + 10)  # inside "a"
+    with pytest.raises(ValueError):
+        verify_checkpoint(str(shard), names=["a"])
+    assert verify_checkpoint(str(shard), mode="off") is None
+
+
+def test_verify_checkpoint_without_manifest_is_a_no_op(checkpoint):
+    root, _ = checkpoint
+    (root / MANIFEST_NAME).unlink()
+    assert verify_checkpoint(str(root / "model0-mp1.safetensors")) is None
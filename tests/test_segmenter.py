@@ -0,0 +1,65 @@
+from segmenter import plan_chunks, split_paragraphs, stitch
+
+
+def words(text):
+    return len(text.split())
+
+
+def make_text(n, size=10):
+    return "\n\n".join(" ".join(f"p{i}w{j}" for j in range(size)) for i in range(n))
+
+
+def test_every_paragraph_is_rewritten_exactly_once():
+    text = make_text(12)
+    chunks = plan_chunks(text, words, budget=35)
+    assert len(chunks) > 1
+    assert [p for c in chunks for p in split_paragraphs(c.text)] == split_paragraphs(text)
+    assert stitch([c.text for c in chunks]) == text
+
+
+def test_chunks_respect_the_budget():
+    chunks = plan_chunks(make_text(12), words, budget=35)
+    assert all(c.tokens <= 35 for c in chunks)
+    assert all(words(c.text) <= 35 for c in chunks)
+
+
+def test_context_is_the_paragraphs_before_the_chunk():
+    paragraphs = split_paragraphs(make_text(12))
+    for overlap in (1, 2):
+        chunks = plan_chunks(make_text(12), words, budget=35, overlap=overlap)
+        assert chunks[0].context == ""
+        for chunk in chunks[1:]:
+            first = paragraphs.index(split_paragraphs(chunk.text)[0])
+            assert split_paragraphs(chunk.context) == paragraphs[max(first - overlap, 0):first]
+
+
+def test_no_overlap_gives_no_context():
+    assert all(c.context == "" for c in plan_chunks(make_text(12), words, budget=35, overlap=0))
+
+
+def test_oversized_paragraph_is_split_on_sentences_and_stitched_back():
+    paragraph = " ".join(f"Frase numero {i} qui." for i in range(20))
+    chunks = plan_chunks(paragraph, words, budget=12)
+    assert len(chunks) > 1
+    assert all(c.tokens <= 12 for c in chunks)
+    assert all(c.text.endswith(".") for c in chunks)
+    assert [c.continues for c in chunks] == [False] + [True] * (len(chunks) - 1)
+    assert stitch([c.text for c in chunks], [c.continues for c in chunks]) == paragraph
+
+
+def test_stitching_preserves_the_paragraphs_of_a_mixed_text():
+    long = " ".join(f"Frase numero {i} qui." for i in range(20))
+    text = "\n\n".join(["Breve inizio.", long, "Breve fine.", long])
+    chunks = plan_chunks(text, words, budget=12)
+    out = stitch([c.text for c in chunks], [c.continues for c in chunks])
+    assert split_paragraphs(out) == split_paragraphs(text)
+    assert out == text
+
+
+def test_last_piece_packed_with_the_next_paragraph():
+    long = " ".join(f"Frase {i}." for i in range(15))  # 30 words
+    chunks = plan_chunks(long + "\n\nFine.", words, budget=20)
+    assert len(chunks) == 2
+    assert chunks[1].continues
+    assert split_paragraphs(chunks[1].text)[-1] == "Fine."
+    assert split_paragraphs(stitch([c.text for c in chunks], [c.continues for c in chunks])) == [long, "Fine."]